@@ -16,16 +16,31 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import importlib
 import logging
 import sys
-from . import root_logger, application
+import time
+from . import root_logger, logqueue
 
 root_logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler(sys.stdout)
 ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s %(name)s/%(levelname)s - %(message)s')
+formatter = logging.Formatter(
+    '%(asctime)s %(name)s/%(levelname)s - %(message)s')
 ch.setFormatter(formatter)
-root_logger.addHandler(ch)
+# stdout may be a slow pipe, so write to it from a background thread rather
+# than from the event loop
+log_pipeline = logqueue.LogPipeline([ch])
+root_logger.addHandler(log_pipeline.handler)
+log_pipeline.start()
 
-app = application.Application()
-app.run()
+try:
+    # imported here, rather than at the top, so that the time it takes to
+    # load everything can be reported along with the rest of startup
+    imports_started = time.monotonic()
+    application = importlib.import_module('.application', __package__)
+    app = application.Application(
+        import_time=time.monotonic() - imports_started)
+    app.run()
+finally:
+    log_pipeline.stop()
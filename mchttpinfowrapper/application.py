@@ -17,44 +17,157 @@
 
 
 import asyncio
+import collections
 import configparser
 import logging
 import signal
-from . import minecraft, web
+import time
+from . import download, frontend, idle, minecraft, pregen, resources, \
+    scheduler, sessions, shutdown, snapshot, web
 
 _logger = logging.getLogger(__name__)
 
 
 class Application:
-    def __init__(self, config_file='config.ini'):
+    def __init__(self, config_file='config.ini', import_time=None):
+        setup_started = time.monotonic()
         _logger.info("Parsing config")
         self.config = configparser.ConfigParser()
         self.config.read(config_file)
-        self.mc_server = minecraft.ServerWrapper(self.config['minecraft'])
-        self.http_server = web.Server(self.config['http'], self.mc_server)
+        self.mc_server = minecraft.ServerWrapper(
+            self.config['minecraft'],
+            index_config=self.config['index']
+            if self.config.has_section('index') else None)
+        self.snapshots = None
+        if self.config.has_section('snapshots'):
+            self.snapshots = snapshot.SnapshotStore(self.config['snapshots'])
+        self.backups = scheduler.BackupScheduler(
+            self.config, self.mc_server, snapshots=self.snapshots)
+        self.downloads = download.DownloadScheduler(
+            self.config['downloads'] if self.config.has_section('downloads')
+            else {})
+        self.resources = resources.ResourceSampler(
+            self.mc_server,
+            self.config['resources'] if self.config.has_section('resources')
+            else {})
+        self.mc_server.telemetry.add_context(
+            'backups_running',
+            lambda: [n for n, j in self.backups.jobs.items() if j.running])
+        self.mc_server.telemetry.add_context(
+            'downloads_active', lambda: len(self.downloads.stats()['active']))
+        self.sessions = None
+        if self.config.has_section('sessions'):
+            self.sessions = sessions.SessionLog(self.mc_server,
+                                                self.config['sessions'])
+        self.pregen = None
+        if self.config.has_section('pregen'):
+            self.pregen = pregen.PregenRunner(self.mc_server,
+                                              self.config['pregen'])
+        self.idle = None
+        if self.config.has_section('idle'):
+            self.idle = idle.IdleMonitor(
+                self.mc_server, self.config['idle'],
+                self.config['minecraft'].get('WorkingDirectory', "."))
+        self.shared_snapshot = None
+        self.workers = None
+        if int(self.config['http'].get('Workers', "0")) > 0:
+            self.shared_snapshot = frontend.SharedSnapshot(
+                int(self.config['http'].get('SnapshotSize', "1048576")))
+            self.workers = frontend.WorkerPool(self.config['http'],
+                                               self.shared_snapshot)
+        self.http_server = web.Server(self.config['http'], self.mc_server,
+                                      snapshots=self.snapshots,
+                                      backups=self.backups,
+                                      downloads=self.downloads,
+                                      resources=self.resources,
+                                      sessions=self.sessions,
+                                      pregen=self.pregen,
+                                      shared_snapshot=self.shared_snapshot)
+        self.shutdown = shutdown.ShutdownSequencer(
+            self.config['shutdown'] if self.config.has_section('shutdown')
+            else {},
+            self.mc_server, self.http_server, downloads=self.downloads,
+            backups=self.backups, workers=self.workers)
+        self.startup_phases = collections.OrderedDict()
+        if import_time is not None:
+            self.startup_phases['imports'] = import_time
+        self.startup_phases['setup'] = time.monotonic() - setup_started
+
+    @asyncio.coroutine
+    def _timed(self, phase, coro):
+        started = time.monotonic()
+        result = yield from coro
+        self.startup_phases[phase] = time.monotonic() - started
+        return result
+
+    def _log_startup(self):
+        _logger.info("startup phases: %s", ", ".join(
+            "{0} {1:.1f}ms".format(phase, seconds * 1000)
+            for phase, seconds in self.startup_phases.items()))
 
     def run(self):
         _logger.info("Starting application")
+        if self.workers:
+            # fork before the event loop has anything to share
+            self.workers.start()
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.mc_server.start(loop))
-        loop.create_task(self.http_server.start(loop))
+        # bind first, so that the API is up and reporting 'starting' while
+        # the server process is spawned
+        bind = loop.create_task(
+            self._timed('bind', self.http_server.start(loop)))
+        spawn = loop.create_task(
+            self._timed('spawn', self.mc_server.start(loop)))
+        loop.run_until_complete(asyncio.gather(bind, spawn))
+        # the JVM takes far longer to load than this takes to scan, and any
+        # changes it makes in the meantime are caught by the watches
+        index_started = time.monotonic()
+        self.mc_server.world_index.start(loop)
+        self.startup_phases['index'] = time.monotonic() - index_started
+        self._log_startup()
+        self.backups.start(loop)
+        self.resources.start(loop)
+        if self.pregen:
+            self.pregen.start(loop)
+        if self.idle:
+            self.idle.start(loop)
 
         def stop(signal_name):
             def handler():
                 _logger.info('received signal %s', signal_name)
-                # relay signal to minecraft process
-                if self.mc_server.process:
-                    self.mc_server.process.send_signal(
-                        getattr(signal, signal_name))
-                loop.stop()
+                if self.shutdown.running:
+                    self.shutdown.hurry()
+                else:
+                    loop.stop()
             return handler
 
         for sig_name in ['SIGINT', 'SIGTERM']:
             loop.add_signal_handler(getattr(signal, sig_name), stop(sig_name))
 
+        def detach():
+            _logger.info('received signal SIGUSR1')
+            if not self.mc_server.can_detach:
+                _logger.warning("server is not running detached")
+                return
+            # leave the server running for the next wrapper to reattach to
+            self.mc_server.detach(loop)
+            loop.stop()
+
+        loop.add_signal_handler(signal.SIGUSR1, detach)
+
         try:
             loop.run_forever()
         finally:
-            loop.run_until_complete(self.mc_server.wait())
-            loop.run_until_complete(self.http_server.stop())
+            # stop anything which might start or stop the server itself
+            if self.idle:
+                loop.run_until_complete(self.idle.stop())
+            if self.pregen:
+                self.pregen.stop()
+            loop.run_until_complete(self.shutdown.run(loop))
+            self.backups.stop()
+            self.resources.stop()
+            self.mc_server.world_index.stop()
+            if self.workers:
+                self.workers.stop()
+            if self.sessions:
+                self.sessions.close()
             loop.close()
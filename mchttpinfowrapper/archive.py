@@ -18,15 +18,17 @@
 from abc import ABCMeta, abstractmethod
 import asyncio
 import os.path
-import tarfile
-import zipfile
-import zipstream
 import logging
 import io
 import shutil
+from . import lazy
 
 _logger = logging.getLogger(__name__)
 
+tarfile = lazy.LazyModule('tarfile')
+zipfile = lazy.LazyModule('zipfile')
+zipstream = lazy.LazyModule('zipstream')
+
 
 class ArchiveWriter(metaclass=ABCMeta):
     def __init__(self) -> None:
@@ -125,6 +127,10 @@ class TarWriter(ArchiveWriter):
         yield from self.fd.drain()
 
 
+class UnsupportedArchive(Exception):
+    pass
+
+
 class ArchiveReader(metaclass=ABCMeta):
     @abstractmethod
     def reset(self) -> None:
@@ -158,21 +164,34 @@ class ArchiveReader(metaclass=ABCMeta):
 
     @staticmethod
     def new(file):
-        sig = file.read(4)
+        """Guesses the format of an archive and returns a reader for it.
+
+        Raises UnsupportedArchive if the format isn't recognised."""
+        sig = file.read(262)
         file.seek(0)
         # try to guess what kind of file it is
-        if sig == bytes([0x50, 0x4b, 0x03, 0x04]):
+        if sig[:4] == bytes([0x50, 0x4b, 0x03, 0x04]):
             # is a ZIP file
             return ZipReader(file)
         elif sig[:3] == bytes([0x1f, 0x8b, 0x08]):
             # is a GZIP file
+            return TarReader(file, compression='gz')
+        elif sig[:6] == bytes([0xfd, 0x37, 0x7a, 0x58, 0x5a, 0x00]):
+            # is an XZ file
+            return TarReader(file, compression='xz')
+        elif sig[:3] == b'BZh':
+            # is a BZIP2 file
+            return TarReader(file, compression='bz2')
+        elif sig[257:262] == b'ustar':
+            # is an uncompressed tar file, which can be read in place
             return TarReader(file)
-        return None
+        raise UnsupportedArchive("unrecognised archive format")
 
 
 class TarReader(ArchiveReader):
-    def __init__(self, file: io.BytesIO) -> None:
-        self.archive = tarfile.open(fileobj=file)
+    def __init__(self, file: io.BytesIO, compression=None) -> None:
+        self.archive = tarfile.open(
+            fileobj=file, mode='r:' + (compression or ''))
         self.members = iter(self.archive.getmembers())
         self.current_info = None
 
@@ -220,3 +239,36 @@ class ZipReader(ArchiveReader):
                 raise
 
             return self.current_info.filename
+
+
+class DirectoryReader(ArchiveReader):
+    """Reads a directory tree on disk as though it were an archive."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.members = None
+        self.current_path = None
+        self.reset()
+
+    def _walk(self):
+        for dir_path, dirnames, filenames in os.walk(self.path):
+            for n in dirnames:
+                path = os.path.join(dir_path, n)
+                yield path, os.path.relpath(path, self.path) + '/'
+            for n in filenames:
+                path = os.path.join(dir_path, n)
+                yield path, os.path.relpath(path, self.path)
+
+    def reset(self) -> None:
+        self.members = self._walk()
+
+    def current_file(self) -> io.BufferedReader:
+        return open(self.current_path, 'rb')
+
+    def __next__(self) -> str:
+        try:
+            self.current_path, name = next(self.members)
+        except StopIteration:
+            self.current_path = None
+            raise
+        return name
@@ -0,0 +1,312 @@
+"""Classes for running the Minecraft process detached from the wrapper."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import errno
+import logging
+import os
+import stat
+import subprocess
+import sys
+import simplejson as json
+
+_logger = logging.getLogger(__name__)
+
+
+def process_start_time(pid):
+    """Returns the start time of a process in clock ticks since boot, or
+    None if there is no such process.
+
+    Together with the pid this identifies a process even if the pid is
+    later reused."""
+    try:
+        with open('/proc/{0}/stat'.format(pid), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # the command name may contain spaces, so split after it
+    fields = data[data.rindex(b')') + 2:].split()
+    if fields[0] == b'Z':
+        return None
+    return int(fields[19])
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def remove_checkpoint(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class FifoWriter:
+    """The writing end of the console FIFO, with the interface of a
+    StreamWriter."""
+
+    def __init__(self, path):
+        # fails with ENXIO unless the server already has the FIFO open
+        self._fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        os.set_blocking(self._fd, True)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def copy_to_log(in_fd, log_path, max_size):
+    """Appends everything read from `in_fd` to the log at `log_path`,
+    moving the log to `log_path`.1 and starting another whenever it has
+    grown to `max_size` bytes, or never if that is 0.
+
+    Logs are only moved at the end of a line, so that a reader can finish
+    the old one before going on to the new."""
+    out_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    size = os.fstat(out_fd).st_size
+    while True:
+        data = os.read(in_fd, 64 * 1024)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(out_fd, view):]
+        size += len(data)
+        if max_size and size >= max_size and data.endswith(b'\n'):
+            os.replace(log_path, log_path + '.1')
+            os.close(out_fd)
+            out_fd = os.open(log_path,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            size = 0
+    os.close(out_fd)
+
+
+class ConsoleTail:
+    """Reads lines from the end of the server's append-only console log,
+    with the interface of a StreamReader.
+
+    `offset` is the position of the first byte not yet returned in the log
+    with inode number `inode`, so a new ConsoleTail can carry on where an
+    old one left off. When the log is moved aside, the old one is read to
+    the end before going on to the new one."""
+
+    def __init__(self, path, offset, alive, poll_interval, inode=None):
+        self._path = path
+        self._file = open(path, 'rb')
+        if inode is not None and self.inode != inode:
+            self._file.close()
+            try:
+                self._file = open(path + '.1', 'rb')
+                if self.inode != inode:
+                    raise FileNotFoundError()
+            except FileNotFoundError:
+                # moved aside more than once; what's left is the newest
+                _logger.warning("missed the end of the console log")
+                self._file.close()
+                self._file = open(path, 'rb')
+                offset = 0
+        self.offset = offset
+        self._file.seek(offset)
+        self._alive = alive
+        self._poll_interval = poll_interval
+        self._moved = False
+
+    @property
+    def inode(self):
+        return os.fstat(self._file.fileno()).st_ino
+
+    def _has_moved(self):
+        try:
+            return os.stat(self._path).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+
+    def _reopen(self):
+        self._file.close()
+        self._file = open(self._path, 'rb')
+        self.offset = 0
+        self._moved = False
+
+    @asyncio.coroutine
+    def readline(self):
+        while True:
+            line = self._file.readline()
+            if line.endswith(b'\n'):
+                self.offset += len(line)
+                return line
+            if self._moved:
+                # nothing more will be written to this one
+                self._reopen()
+                if line:
+                    return line
+                continue
+            # don't hand out half a line; try again once there is more
+            self._file.seek(self.offset)
+            if os.fstat(self._file.fileno()).st_size < self.offset:
+                _logger.warning("console log was truncated")
+                self.offset = 0
+                self._file.seek(0)
+                continue
+            if self._has_moved():
+                # read to the end before letting go, in case more was
+                # written just before it moved
+                self._moved = True
+                continue
+            if not self._alive():
+                rest = self._file.read()
+                self.offset += len(rest)
+                return rest
+            yield from asyncio.sleep(self._poll_interval)
+
+    def close(self):
+        self._file.close()
+
+
+class DetachedProcess:
+    """A server process which is not tied to the wrapper.
+
+    The server reads its console from a FIFO, which it holds open for
+    writing as well so that it never sees end of file when a wrapper goes
+    away. Its output goes through a pipe to a detached logger process,
+    which appends it to a log file and moves the log aside once it reaches
+    `max_log_size` bytes. Both run in sessions of their own, so signals
+    meant for the wrapper don't reach them.
+
+    Has the parts of the asyncio Process interface that ServerWrapper
+    uses."""
+
+    def __init__(self, pid, start_time, fifo_path, log_path, log_offset,
+                 poll_interval, popen=None, log_inode=None):
+        self.pid = pid
+        self.start_time = start_time
+        self._popen = popen
+        self._poll_interval = poll_interval
+        self.stdin = FifoWriter(fifo_path)
+        self.stdout = ConsoleTail(log_path, log_offset, self.alive,
+                                  poll_interval, log_inode)
+
+    @staticmethod
+    def _make_fifo(fifo_path):
+        try:
+            if stat.S_ISFIFO(os.stat(fifo_path).st_mode):
+                return
+            os.unlink(fifo_path)
+        except FileNotFoundError:
+            pass
+        os.mkfifo(fifo_path, 0o600)
+
+    @classmethod
+    def spawn(cls, args, cwd, fifo_path, log_path, poll_interval,
+              max_log_size=0):
+        cls._make_fifo(fifo_path)
+        if os.path.exists(log_path):
+            os.replace(log_path, log_path + '.1')
+        # O_RDWR so the open neither blocks for a writer nor lets the
+        # server see end of file between wrappers
+        stdin_fd = os.open(fifo_path, os.O_RDWR)
+        # created here so that it's there for the tail straight away
+        os.close(os.open(log_path, os.O_WRONLY | os.O_CREAT, 0o644))
+        read_fd, write_fd = os.pipe()
+        try:
+            # this module only needs the standard library, so it runs as a
+            # script wherever the wrapper was installed
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), log_path,
+                 str(max_log_size)],
+                stdin=read_fd, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, start_new_session=True)
+            popen = subprocess.Popen(
+                args, cwd=cwd, stdin=stdin_fd, stdout=write_fd,
+                stderr=subprocess.STDOUT, start_new_session=True)
+        finally:
+            os.close(stdin_fd)
+            os.close(read_fd)
+            os.close(write_fd)
+        return cls(popen.pid, process_start_time(popen.pid), fifo_path,
+                   log_path, 0, poll_interval, popen=popen)
+
+    @classmethod
+    def reattach(cls, checkpoint, fifo_path, log_path, poll_interval):
+        """Returns the process described by `checkpoint`, or None if it is
+        no longer running."""
+        pid = checkpoint.get('pid')
+        start_time = checkpoint.get('start_time')
+        if not pid or process_start_time(pid) != start_time:
+            return None
+        try:
+            return cls(pid, start_time, fifo_path, log_path,
+                       checkpoint.get('log_offset', 0), poll_interval,
+                       log_inode=checkpoint.get('log_inode'))
+        except OSError as e:
+            if e.errno not in (errno.ENXIO, errno.ENOENT):
+                raise
+            _logger.warning("process %d is running but its console is "
+                            "gone: %s", pid, e)
+            return None
+
+    def alive(self):
+        if self._popen:
+            return self._popen.poll() is None
+        return process_start_time(self.pid) == self.start_time
+
+    @property
+    def returncode(self):
+        if self._popen:
+            return self._popen.poll()
+        # the exit status of a process which isn't our child is lost
+        return None if self.alive() else 0
+
+    def send_signal(self, sig):
+        if self.alive():
+            os.kill(self.pid, sig)
+
+    @asyncio.coroutine
+    def wait(self):
+        while self.alive():
+            yield from asyncio.sleep(self._poll_interval)
+        return self.returncode
+
+    def close(self):
+        self.stdin.close()
+        self.stdout.close()
+
+
+if __name__ == '__main__':
+    copy_to_log(sys.stdin.fileno(), sys.argv[1], int(sys.argv[2]))
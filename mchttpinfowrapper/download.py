@@ -0,0 +1,249 @@
+"""Classes for scheduling archive downloads."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import collections
+import logging
+import math
+import time
+from . import throttle
+
+_logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    def __init__(self, position, retry_after):
+        super().__init__("download queue is full")
+        self.position = position
+        self.retry_after = retry_after
+
+
+class BuildAbandoned(Exception):
+    pass
+
+
+class Build:
+    """An archive being built for one or more clients.
+
+    The build is the file object its archive writer writes to, and tees
+    everything written to every attached client. Clients may attach until
+    the build starts; anything the writer produced before then (such as a
+    gzip header) is replayed to each of them.
+
+    If given, `lock` is read-locked, with `lock_timeout`, for as long as
+    the build runs, rather than while it waits in the queue.
+    """
+
+    def __init__(self, key, make_writer, basename, files, global_bucket,
+                 lock=None, lock_timeout=None):
+        self.key = key
+        self.basename = basename
+        self.started = False
+        self.bytes_written = 0
+        self.done = asyncio.Future()
+        self._files = files
+        self._global_bucket = global_bucket
+        self._lock = lock
+        self._lock_timeout = lock_timeout
+        self._clients = []
+        self._prefix = []
+        self._pending = 0
+        self._writer = make_writer(self)
+        self._writer.basename = basename
+
+    @property
+    def mime_type(self):
+        return self._writer.mime_type
+
+    @property
+    def file_extension(self):
+        return self._writer.file_extension
+
+    @property
+    def clients(self):
+        return len(self._clients)
+
+    def attach(self, response, bucket):
+        if self.started:
+            raise RuntimeError("build has already started")
+        for chunk in self._prefix:
+            response.write(chunk)
+        self._clients.append((response, bucket))
+
+    def detach(self, response):
+        for client in self._clients:
+            if client[0] is response:
+                self._drop(client)
+                break
+
+    def _drop(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+            _logger.info("download client went away, %d left",
+                         len(self._clients))
+
+    def write(self, data):
+        data = bytes(data)
+        if not self.started:
+            self._prefix.append(data)
+            return
+        for client in list(self._clients):
+            try:
+                client[0].write(data)
+            except Exception:
+                self._drop(client)
+        self._pending += len(data)
+        self.bytes_written += len(data)
+
+    def flush(self):
+        pass
+
+    @asyncio.coroutine
+    def drain(self):
+        if not self.started:
+            return
+        n, self._pending = self._pending, 0
+        if n:
+            yield from self._global_bucket.wait(n * len(self._clients))
+        for client in list(self._clients):
+            response, bucket = client
+            try:
+                yield from bucket.wait(n)
+                yield from response.drain()
+            except Exception:
+                self._drop(client)
+        if not self._clients:
+            raise BuildAbandoned()
+
+    @asyncio.coroutine
+    def run(self):
+        self.started = True
+        self._prefix = None
+        try:
+            if self._lock:
+                yield from self._lock.acquire_read(self._lock_timeout)
+            try:
+                for filename, arcname in self._files:
+                    yield from self._writer.add(filename, arcname)
+                yield from self._writer.close()
+            finally:
+                if self._lock:
+                    yield from self._lock.release_read()
+        except Exception as e:
+            self.done.set_exception(e)
+        else:
+            self.done.set_result(None)
+
+    @asyncio.coroutine
+    def wait(self):
+        yield from asyncio.shield(self.done)
+
+
+class DownloadScheduler:
+    """Limits how many archives are built at once.
+
+    Builds beyond `MaxConcurrent` wait in a FIFO queue of at most
+    `MaxQueued` entries. Requests identical to one still in the queue share
+    its build. Output is paced per connection and globally.
+    """
+
+    def __init__(self, download_config):
+        self.max_builds = max(
+            1, int(download_config.get('MaxConcurrent', "2")))
+        self.max_queued = int(download_config.get('MaxQueued', "8"))
+        self._connection_rate = int(
+            download_config.get('ConnectionBandwidth', "0"))
+        self._global_bucket = throttle.TokenBucket(
+            int(download_config.get('GlobalBandwidth', "0")))
+        self._queue = collections.deque()
+        self._active = []
+        self._avg_duration = 30.0
+        self._completed = 0
+
+    def request(self, key, make_writer, basename, files, lock=None,
+                lock_timeout=None):
+        """Returns a build for `key`, joining a queued one if possible.
+
+        Raises QueueFull if the build would have to wait and the queue is
+        already full."""
+        for build in self._queue:
+            if build.key == key:
+                return build
+        if len(self._active) >= self.max_builds \
+                and len(self._queue) >= self.max_queued:
+            position = len(self._queue) + 1
+            raise QueueFull(position, self.retry_after(position))
+        build = Build(key, make_writer, basename, files, self._global_bucket,
+                      lock, lock_timeout)
+        self._queue.append(build)
+        return build
+
+    def position(self, build):
+        """Returns a build's place in the queue, or 0 if it is running."""
+        if build in self._queue:
+            return self._queue.index(build) + 1
+        return 0
+
+    def retry_after(self, position):
+        return int(math.ceil(self._avg_duration * position / self.max_builds))
+
+    @asyncio.coroutine
+    def download(self, build, response):
+        """Streams a build to an already started response."""
+        build.attach(response, throttle.TokenBucket(self._connection_rate))
+        self._pump()
+        try:
+            yield from build.wait()
+        except asyncio.CancelledError:
+            # the client went away
+            build.detach(response)
+            if not build.clients and build in self._queue:
+                self._queue.remove(build)
+            raise
+
+    def _pump(self):
+        while self._queue and len(self._active) < self.max_builds:
+            build = self._queue.popleft()
+            self._active.append(build)
+            asyncio.get_event_loop().create_task(self._run(build))
+
+    @asyncio.coroutine
+    def _run(self, build):
+        started = time.monotonic()
+        try:
+            yield from build.run()
+        finally:
+            self._active.remove(build)
+            self._completed += 1
+            # exponentially weighted, so estimates track recent builds
+            self._avg_duration += \
+                0.2 * (time.monotonic() - started - self._avg_duration)
+            self._pump()
+
+    @property
+    def busy(self):
+        return bool(self._active or self._queue)
+
+    def stats(self):
+        return {
+            'active': [{'clients': b.clients, 'bytes_written': b.bytes_written}
+                       for b in self._active],
+            'queued': len(self._queue),
+            'completed': self._completed,
+            'average_duration': self._avg_duration,
+        }
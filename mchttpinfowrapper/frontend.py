@@ -0,0 +1,387 @@
+"""Classes for serving HTTP from several worker processes."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import functools
+import logging
+import mmap
+import os
+import signal
+import socket
+import struct
+import time
+import aiohttp
+from aiohttp import web as aiohttp_web
+import simplejson as json
+from . import web
+
+_logger = logging.getLogger(__name__)
+
+# sequence number, format version, payload length
+_header = struct.Struct('<QII')
+_sequence = struct.Struct('<Q')
+
+# bump whenever the layout of the snapshot changes
+_format_version = 1
+
+_hop_by_hop = frozenset([
+    'CONNECTION', 'KEEP-ALIVE', 'PROXY-AUTHENTICATE', 'PROXY-AUTHORIZATION',
+    'TE', 'TRAILERS', 'TRANSFER-ENCODING', 'UPGRADE', 'HOST',
+])
+
+_chunk_size = 64 * 1024
+
+_poll_interval = 0.1
+
+
+class SnapshotTooLarge(ValueError):
+    pass
+
+
+class SharedSnapshot:
+    """A block of anonymous shared memory holding the latest snapshot of
+    the supervisor's state, as JSON.
+
+    Processes forked after it is created all see the same memory. One
+    process writes and any number read, using a sequence lock: the writer
+    makes the sequence number odd before it changes the data and even
+    again once it has finished, and a reader retries until it sees the
+    same even number before and after copying the data out.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._mmap = mmap.mmap(-1, size)
+        self._sequence = 0
+
+    def publish(self, data):
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        if len(payload) > self.size - _header.size:
+            raise SnapshotTooLarge(
+                "snapshot is {0} bytes, more than {1}".format(
+                    len(payload), self.size - _header.size))
+        m = self._mmap
+        _sequence.pack_into(m, 0, self._sequence + 1)
+        m[_header.size:_header.size + len(payload)] = payload
+        _header.pack_into(m, 0, self._sequence + 1, _format_version,
+                          len(payload))
+        self._sequence += 2
+        _sequence.pack_into(m, 0, self._sequence)
+
+    def read(self, since=0):
+        """Returns (sequence number, data), or None if nothing newer than
+        `since` has been published."""
+        m = self._mmap
+        while True:
+            sequence, version, length = _header.unpack_from(m, 0)
+            if sequence == since:
+                return None
+            if sequence & 1:
+                # mid-write; the writer never holds it for long
+                time.sleep(0)
+                continue
+            payload = m[_header.size:_header.size + length]
+            if _sequence.unpack_from(m, 0)[0] == sequence:
+                break
+        if version != _format_version:
+            _logger.warning("ignoring snapshot in format %d", version)
+            return None
+        return sequence, json.loads(payload.decode('utf-8'))
+
+
+def _reuse_port_sockets(host, port):
+    sockets = []
+    for family, type_, proto, _, address in socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE):
+        sock = socket.socket(family, type_, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.bind(address)
+        sock.setblocking(False)
+        sockets.append(sock)
+    return sockets
+
+
+class WorkerServer:
+    """The HTTP server run by each worker process.
+
+    Requests for routes in `web.Server.snapshot_routes` are answered from
+    the shared snapshot without talking to the supervisor, unless it is
+    more than `SnapshotMaxAge` seconds old. Everything else is forwarded to
+    the supervisor's own HTTP server.
+
+    When stopped, it stops accepting connections and gives requests under
+    way up to `DrainTimeout` seconds to finish.
+    """
+
+    def __init__(self, http_config, snapshot):
+        self._host = http_config.get('Host', None)
+        self._port = int(http_config.get('Port', "80"))
+        self._upstream = 'http://127.0.0.1:{0}'.format(
+            http_config.get('InternalPort', "8089"))
+        self._snapshot = snapshot
+        self._max_age = float(http_config.get('SnapshotMaxAge', "10"))
+        self._drain_timeout = float(http_config.get('DrainTimeout', "10"))
+        self._sequence = 0
+        self._data = None
+        self._servers = []
+        self._handler_factory = None
+        self._loop = None
+
+    def _current(self):
+        latest = self._snapshot.read(self._sequence)
+        if latest:
+            self._sequence, self._data = latest
+        return self._data
+
+    @asyncio.coroutine
+    def serve_snapshot(self, path, request):
+        data = self._current()
+        age = data and max(0, int(time.time() - data['published_at']))
+        if data is None or age > self._max_age:
+            # the supervisor has stopped publishing, or never has; it can
+            # still answer for itself
+            return (yield from self.forward(request))
+        route_data = data['routes'][path]
+        if route_data is None:
+            return (yield from web.Server.make_response(request, status=404))
+        return (yield from web.Server.make_response(
+            request, headers={'Age': str(age)}, data=route_data))
+
+    @asyncio.coroutine
+    def forward(self, request):
+        headers = {name: value for name, value in request.headers.items()
+                   if name.upper() not in _hop_by_hop}
+        body = None
+        chunked = None
+        if request.method == 'POST':
+            body = request.content
+            # a body without a length came chunked, and has to go on that
+            # way since we can't know its length up front either
+            chunked = 'CONTENT-LENGTH' not in request.headers or None
+        try:
+            upstream = yield from aiohttp.request(
+                request.method, self._upstream + request.path_qs,
+                headers=headers, data=body, chunked=chunked,
+                allow_redirects=False, loop=self._loop)
+        except (aiohttp.ClientError, OSError) as e:
+            # the supervisor is restarting or shutting down; say so rather
+            # than dropping the connection
+            _logger.warning("couldn't reach the supervisor: %s", e)
+            return (yield from web.Server.make_response(
+                request, status=503, headers={'Retry-After': '1'},
+                data={'reason': "supervisor unavailable",
+                      'detail': str(e)}))
+        try:
+            response = aiohttp_web.StreamResponse(status=upstream.status)
+            for name, value in upstream.headers.items():
+                if name.upper() not in _hop_by_hop:
+                    response.headers[name] = value
+            response.start(request)
+            while True:
+                chunk = yield from upstream.content.read(_chunk_size)
+                if not chunk:
+                    break
+                response.write(chunk)
+                yield from response.drain()
+            yield from response.write_eof()
+            return response
+        finally:
+            upstream.close()
+
+    @asyncio.coroutine
+    def start(self, loop):
+        self._loop = loop
+        app = aiohttp_web.Application(loop=loop)
+        for method, url, _ in web.Server.route_info.routes:
+            if method == 'GET' and url in web.Server.snapshot_routes:
+                handler = functools.partial(self.serve_snapshot, url)
+            else:
+                handler = self.forward
+            app.router.add_route(method, url, handler)
+        self._handler_factory = app.make_handler()
+        for sock in _reuse_port_sockets(self._host, self._port):
+            self._servers.append((yield from loop.create_server(
+                self._handler_factory, sock=sock)))
+
+    @asyncio.coroutine
+    def stop(self):
+        for server in self._servers:
+            server.close()
+            yield from server.wait_closed()
+        if self._handler_factory:
+            yield from self._handler_factory.finish_connections(
+                self._drain_timeout)
+
+
+_stop_signals = {signal.SIGINT, signal.SIGTERM}
+
+
+def _run_worker(http_config, snapshot):
+    for sig in _stop_signals:
+        # the pool's handlers and mask don't belong in a worker
+        signal.signal(sig, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, _stop_signals)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = WorkerServer(http_config, snapshot)
+    loop.run_until_complete(server.start(loop))
+    for sig in _stop_signals:
+        loop.add_signal_handler(sig, loop.stop)
+    _logger.info("HTTP worker %d started", os.getpid())
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(server.stop())
+        loop.close()
+
+
+def _fork(target, *args):
+    """Runs `target` in a child process, returning the child's pid."""
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            target(*args)
+            status = 0
+        except Exception:
+            _logger.exception("%s failed", target.__name__)
+        finally:
+            # never fall back into the parent's code
+            logging.shutdown()
+            os._exit(status)
+    return pid
+
+
+class _Stop(BaseException):
+    pass
+
+
+def _raise_stop(signum, frame):
+    raise _Stop()
+
+
+def _unblocked(f, *args):
+    """Calls `f`, letting the stop signals in only while it runs."""
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, _stop_signals)
+    try:
+        return f(*args)
+    finally:
+        signal.pthread_sigmask(signal.SIG_BLOCK, _stop_signals)
+
+
+class WorkerPool:
+    """Runs `Workers` HTTP worker processes, all listening on the public
+    port with SO_REUSEPORT so that the kernel spreads connections between
+    them.
+
+    The workers are forked by a manager process of their own, which starts
+    a new worker whenever one dies, waiting up to `MaxRespawnDelay` seconds
+    between attempts if they keep dying straight away. Forking from the
+    manager keeps the supervisor's threads and event loop out of it.
+
+    Must be started before the supervisor's event loop is running."""
+
+    def __init__(self, http_config, snapshot):
+        self._http_config = http_config
+        self._count = int(http_config.get('Workers', "0"))
+        self._max_respawn_delay = float(http_config.get('MaxRespawnDelay',
+                                                        "60"))
+        self._snapshot = snapshot
+        self.pid = None
+
+    def start(self):
+        self.pid = _fork(self._manage)
+        _logger.info("started %d HTTP workers", self._count)
+
+    def _manage(self):
+        # a stop signal between forking a worker and noting its pid would
+        # leave it running, so they're only let in while we wait
+        signal.pthread_sigmask(signal.SIG_BLOCK, _stop_signals)
+        for sig in _stop_signals:
+            signal.signal(sig, _raise_stop)
+        pids = dict()
+        delay = 0
+        try:
+            while True:
+                while len(pids) < self._count:
+                    pid = _fork(_run_worker, self._http_config,
+                                self._snapshot)
+                    pids[pid] = time.monotonic()
+                pid, status = _unblocked(os.wait)
+                lived = time.monotonic() - pids.pop(pid)
+                if os.WIFSIGNALED(status):
+                    how = "was killed by signal {0}".format(
+                        os.WTERMSIG(status))
+                else:
+                    how = "exited with status {0}".format(
+                        os.WEXITSTATUS(status))
+                _logger.warning("HTTP worker %d %s, restarting it", pid, how)
+                # back off while they die as soon as they start
+                if lived < 1:
+                    delay = min(self._max_respawn_delay, 2 * delay or 1)
+                    _unblocked(time.sleep, delay)
+                else:
+                    delay = 0
+        except _Stop:
+            pass
+        for sig in _stop_signals:
+            signal.signal(sig, signal.SIG_IGN)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def close(self):
+        """Tells the workers to stop accepting connections, and to exit
+        once the requests they have under way are done."""
+        if not self.pid:
+            return
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reaped(self, options):
+        try:
+            pid, _ = os.waitpid(self.pid, options)
+        except ChildProcessError:
+            pid = self.pid
+        if pid:
+            self.pid = None
+        return bool(pid)
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        # the workers may still be forwarding requests to us, so this
+        # mustn't block the loop
+        while self.pid and not self._reaped(os.WNOHANG):
+            yield from asyncio.sleep(_poll_interval)
+
+    def stop(self):
+        self.close()
+        if self.pid:
+            self._reaped(0)
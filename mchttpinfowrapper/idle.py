@@ -0,0 +1,280 @@
+"""Classes for stopping an idle server and waking it on connect."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import logging
+import os.path
+import re
+import struct
+from datetime import datetime
+import pytz
+import simplejson as json
+
+_logger = logging.getLogger(__name__)
+
+_server_version_re = re.compile(
+    r'''^Starting minecraft server version (?P<version>.+)$''')
+
+# the most we will buffer from a client before giving up on it
+_max_buffer = 4096
+
+
+def _pack_varint(value):
+    value &= 0xffffffff
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _unpack_varint(data, offset=0):
+    """Returns (value, new offset), or None if data is incomplete."""
+    value = 0
+    for i in range(5):
+        if offset + i >= len(data):
+            return None
+        byte = data[offset + i]
+        value |= (byte & 0x7f) << (7 * i)
+        if not byte & 0x80:
+            if value & 0x80000000:
+                value -= 1 << 32
+            return value, offset + i + 1
+    raise ValueError("VarInt too long")
+
+
+def _pack_string(s):
+    data = s.encode('utf-8')
+    return _pack_varint(len(data)) + data
+
+
+def _packet(packet_id, payload=b''):
+    body = _pack_varint(packet_id) + payload
+    return _pack_varint(len(body)) + body
+
+
+class _WakeProtocol(asyncio.Protocol):
+    """Speaks just enough of the Minecraft protocol to answer server list
+    pings and turn away logins while the real server is asleep."""
+
+    def __init__(self, monitor):
+        self._monitor = monitor
+        self._transport = None
+        self._buffer = b''
+        self._state = 'handshake'
+        self._protocol_version = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def connection_lost(self, exc):
+        self._transport = None
+
+    def _close(self):
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def data_received(self, data):
+        self._buffer += data
+        if len(self._buffer) > _max_buffer:
+            self._close()
+            return
+        if self._state == 'handshake' and self._buffer[:1] == b'\xfe':
+            self._legacy_ping()
+            return
+        try:
+            while self._transport:
+                packet = self._next_packet()
+                if packet is None:
+                    break
+                self._handle_packet(*packet)
+        except (ValueError, IndexError, TypeError):
+            self._close()
+
+    def _next_packet(self):
+        header = _unpack_varint(self._buffer)
+        if header is None:
+            return None
+        length, offset = header
+        if len(self._buffer) < offset + length:
+            return None
+        body = self._buffer[offset:offset + length]
+        self._buffer = self._buffer[offset + length:]
+        packet_id, offset = _unpack_varint(body)
+        return packet_id, body[offset:]
+
+    def _handle_packet(self, packet_id, payload):
+        if self._state == 'handshake' and packet_id == 0x00:
+            self._protocol_version, offset = _unpack_varint(payload)
+            length, offset = _unpack_varint(payload, offset)
+            offset += length + 2  # server address and port
+            next_state, _ = _unpack_varint(payload, offset)
+            self._state = {1: 'status', 2: 'login'}.get(next_state)
+            if self._state is None:
+                raise ValueError("bad next state")
+        elif self._state == 'status' and packet_id == 0x00:
+            status = self._monitor.status_response(self._protocol_version)
+            self._transport.write(_packet(0x00, _pack_string(
+                json.dumps(status))))
+        elif self._state == 'status' and packet_id == 0x01:
+            # ping; echo the payload back and hang up
+            self._transport.write(_packet(0x01, payload))
+            self._close()
+        elif self._state == 'login' and packet_id == 0x00:
+            self._transport.write(_packet(0x00, _pack_string(json.dumps({
+                'text': self._monitor.wake_message,
+            }))))
+            self._close()
+            self._monitor.wake()
+        else:
+            raise ValueError("unexpected packet")
+
+    def _legacy_ping(self):
+        fields = ['\xa71', '127', self._monitor.version or '',
+                  self._monitor.motd, '0', str(self._monitor.max_players)]
+        text = '\0'.join(fields)
+        self._transport.write(b'\xff' + struct.pack('>H', len(text)) +
+                              text.encode('utf-16-be'))
+        self._close()
+
+
+class IdleMonitor:
+    """Stops the server when nobody has played on it for a while.
+
+    While the server is stopped for being idle, a small listener holds the
+    game port, answers server list pings from cached server.properties
+    values, and starts the server when someone tries to log in.
+    """
+
+    def __init__(self, mc_server, idle_config, working_dir):
+        self._mc_server = mc_server
+        self._idle_timeout = float(idle_config.get('IdleMinutes', "30")) * 60
+        self._check_interval = float(idle_config.get('CheckInterval', "60"))
+        self.wake_message = idle_config.get(
+            'WakeMessage', "The server is starting, please reconnect in a "
+                           "minute.")
+        self._host = idle_config.get('Host', None)
+        properties = self._read_properties(
+            os.path.join(working_dir, 'server.properties'))
+        self._port = int(properties.get('server-port', "25565"))
+        self.motd = properties.get('motd', "A Minecraft Server")
+        self.max_players = int(properties.get('max-players', "20"))
+        self.version = None
+        self.asleep = False
+        self._listener = None
+        self._task = None
+        self._loop = None
+        mc_server.add_log_event(_server_version_re, self._server_version)
+        mc_server.add_start_callback(self._server_starting)
+        mc_server.add_stop_callback(self._server_stopped)
+
+    @staticmethod
+    def _read_properties(path):
+        properties = dict()
+        try:
+            with open(path, encoding='latin-1') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#') and '=' in line:
+                        key, _, value = line.partition('=')
+                        properties[key.strip()] = value.strip()
+        except OSError:
+            pass
+        return properties
+
+    def _server_version(self, m):
+        self.version = m.group('version')
+
+    def start(self, loop):
+        self._loop = loop
+        if self._idle_timeout > 0:
+            self._task = loop.create_task(self._run())
+
+    @asyncio.coroutine
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        yield from self._close_listener()
+
+    def idle_for(self):
+        """Returns how many seconds the server has been running empty."""
+        if self._mc_server.status != 'running' or self._mc_server.players:
+            return 0
+        since = self._mc_server.status_changed_at
+        last_part = self._mc_server.last_part_at
+        if last_part and last_part > since:
+            since = last_part
+        now = pytz.UTC.localize(datetime.utcnow())
+        return (now - since).total_seconds()
+
+    @asyncio.coroutine
+    def _run(self):
+        while True:
+            yield from asyncio.sleep(self._check_interval)
+            if self.idle_for() >= self._idle_timeout \
+                    and self._mc_server.can_stop:
+                _logger.info("server idle for %d minutes, stopping",
+                             self.idle_for() // 60)
+                self.asleep = True
+                yield from self._mc_server.stop()
+
+    @asyncio.coroutine
+    def _server_stopped(self):
+        if not self.asleep:
+            return
+        try:
+            self._listener = yield from self._loop.create_server(
+                lambda: _WakeProtocol(self), self._host, self._port)
+            _logger.info("listening for players on port %d", self._port)
+        except OSError:
+            _logger.exception("could not listen on port %d", self._port)
+
+    @asyncio.coroutine
+    def _server_starting(self):
+        # the server needs the port back, however it is being started
+        self.asleep = False
+        yield from self._close_listener()
+
+    @asyncio.coroutine
+    def _close_listener(self):
+        if self._listener:
+            self._listener.close()
+            yield from self._listener.wait_closed()
+            self._listener = None
+
+    def status_response(self, protocol_version):
+        return {
+            'version': {
+                'name': self.version or "sleeping",
+                'protocol': protocol_version,
+            },
+            'players': {'max': self.max_players, 'online': 0},
+            'description': {'text': self.motd},
+        }
+
+    def wake(self):
+        if self.asleep and self._mc_server.can_start:
+            _logger.info("player tried to connect, waking server")
+            self.asleep = False
+            self._loop.create_task(self._mc_server.start(self._loop))
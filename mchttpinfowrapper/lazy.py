@@ -0,0 +1,41 @@
+"""Helpers for deferring imports until they are needed."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module, which is imported the first time one of
+    its attributes is used.
+
+    For modules which are slow to import and not needed until well after
+    startup, such as the archive formats."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # only called for attributes which aren't our own
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module {0!r}{1}>'.format(
+            self._name, '' if self._module else ' (not imported)')
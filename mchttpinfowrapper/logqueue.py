@@ -0,0 +1,134 @@
+"""Classes for non-blocking log output."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records without ever blocking.
+
+    Records which arrive while the queue is full are dropped and counted;
+    once there is room again, a warning saying how many were lost is
+    enqueued ahead of the next record.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self._unreported = 0
+
+    def enqueue(self, record):
+        if self._unreported:
+            notice = logging.LogRecord(
+                __name__, logging.WARNING, __file__, 0,
+                "dropped %d log records because output was too slow",
+                (self._unreported,), None)
+            try:
+                self.queue.put_nowait(notice)
+                self._unreported = 0
+            except queue.Full:
+                pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._unreported += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits each logger to `rate` records per second, with bursts of up
+    to `burst` records.
+
+    The first record let through after some were suppressed says how many
+    were."""
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = dict()
+        self._unreported = collections.Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(record.name,
+                                                (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now)
+                self._unreported[record.name] += 1
+                return False
+            self._buckets[record.name] = (tokens - 1, now)
+            unreported = self._unreported.pop(record.name, 0)
+        if unreported:
+            record.args = (record.getMessage(), unreported)
+            record.msg = "%s [%d earlier messages suppressed]"
+        return True
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may well be full; the writer thread will make room
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Moves log output off the calling thread.
+
+    Records go into a bounded queue through a DroppingQueueHandler and are
+    written to `handlers` by a background thread, so a slow consumer of
+    the output can only ever cost dropped records, never a stalled caller.
+    """
+
+    def __init__(self, handlers, capacity=10000, rate=200, burst=1000):
+        self.queue = queue.Queue(capacity)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.rate_limit = None
+        if rate:
+            self.rate_limit = RateLimitFilter(rate, burst)
+            self.handler.addFilter(self.rate_limit)
+        self._handlers = handlers
+        self._capacity = capacity
+        self.listener = _Listener(self.queue, *handlers)
+        self._started = False
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # the writer thread doesn't survive a fork, and the queue's locks
+        # may have been held when it happened, so start again from scratch
+        self.queue = queue.Queue(self._capacity)
+        self.handler.queue = self.queue
+        self.listener = _Listener(self.queue, *self._handlers)
+        if self._started:
+            self.listener.start()
+
+    def start(self):
+        self.listener.start()
+        self._started = True
+
+    def stop(self):
+        """Stops the writer thread once everything queued is written."""
+        self.listener.stop()
+        self._started = False
@@ -25,8 +25,10 @@ import os.path
 import shutil
 import fcntl
 import sys
+import time
 from datetime import datetime
 import pytz
+from . import detach, rwlock, telemetry, worldindex
 
 _logger = logging.getLogger(__name__)
 
@@ -40,34 +42,80 @@ _player_joined_re = re.compile(r'''^(?P<name>\w*) joined the game$''')
 _player_left_re = re.compile(r'''^(?P<name>\w*) left the game$''')
 _server_started_re = re.compile(
     r'''^Done \((?P<time>.+)\)! For help, type "help" or "\?"$''')
+_server_lag_re = re.compile(
+    r'''^Can't keep up! .*Running (?P<ms>\d+)ms ''' +
+    r'''(?:behind, skipping|or) (?P<ticks>\d+) tick''')
+_world_saved_re = re.compile(r'''^Saved the (?:world|game)$''')
+_server_stopping_re = re.compile(r'''^Stopping (?:the )?server$''')
+
+# ioctl asking the filesystem for a copy-on-write clone of a file
+_FICLONE = 0x40049409
 
 # TODO: rewrite this as a subprocess protocol
 
 
+class ServerRunning(Exception):
+    pass
+
+
+class ServerNotRunning(Exception):
+    pass
+
+
+def _copy_file(src, dst):
+    """Copies a file, as a reflink where the filesystem supports it."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
 class ServerWrapper:
-    def __init__(self, mc_config):
+    def __init__(self, mc_config, index_config=None):
         self._server_jar = os.path.abspath(mc_config.get('ServerJar'))
         self._java_flags = mc_config.get('JavaFlags', "").split()
         self._server_flags = mc_config.get('ServerFlags', "").split()
         self._working_dir = mc_config.get('WorkingDirectory', ".")
+        self._detached = mc_config.get('Detached', "no") == 'yes'
+        self._console_fifo = os.path.abspath(os.path.join(
+            self._working_dir, mc_config.get('ConsoleFifo', "console.in")))
+        self._console_log = os.path.abspath(os.path.join(
+            self._working_dir, mc_config.get('ConsoleLog', "console.log")))
+        self._console_poll = float(mc_config.get('ConsolePollInterval',
+                                                 "0.1"))
+        self._console_log_max_size = int(mc_config.get('ConsoleLogMaxSize',
+                                                       "10485760"))
+        self._checkpoint_path = os.path.abspath(mc_config.get(
+            'StateFile', os.path.join(self._working_dir, "wrapper.json")))
+        self._checkpointed_at = 0
 
         self.process = None
         self._mc_logger = logging.getLogger(__name__ + '.process')
         self._input_stream = None
         self._input_task = None
         self._output_task = None
+        self._cleanup_task = None
 
-        self._world_reading = 0
-        self._world_read_cond = asyncio.Condition()
-        self._world_write_lock = asyncio.Lock()
+        self._world_lock = rwlock.RWLock()
+        self.world_index = worldindex.WorldIndex(
+            self.world_path, index_config or {})
 
         self._set_status('stopped')
         self._last_part = None
+        self._last_lag = None
+        self.telemetry = telemetry.ServerTelemetry()
+        self.telemetry.add_context('players', lambda: len(self._players))
         self._players = dict()
+        self._player_callbacks = []
+        self._start_callbacks = []
+        self._stop_callbacks = []
         self._log_events = []
         self.add_log_event(_player_joined_re, self._player_joined_callback)
         self.add_log_event(_player_left_re, self._player_left_callback)
         self.add_log_event(_server_started_re, self._server_started_callback)
+        self.add_log_event(_server_lag_re, self._server_lag_callback)
 
     @staticmethod
     def _now_tz():
@@ -85,7 +133,7 @@ class ServerWrapper:
     def parse_log_level(level):
         if level == 'ERROR':
             return 40
-        elif level == 'WARNING':
+        elif level in ('WARN', 'WARNING'):
             return 30
         elif level == 'INFO':
             return 20
@@ -98,12 +146,28 @@ class ServerWrapper:
         return e
 
     def remove_log_event(self, e):
-        self._log_events.remove(e)
+        if e in self._log_events:
+            self._log_events.remove(e)
+
+    def add_player_callback(self, callback):
+        """Registers a callback to be run with 'join' or 'leave' and the
+        player's name whenever a player joins or leaves."""
+        self._player_callbacks.append(callback)
+
+    def add_start_callback(self, callback):
+        """Registers a callback to be run just before the server process
+        is spawned."""
+        self._start_callbacks.append(callback)
+
+    def add_stop_callback(self, callback):
+        """Registers a callback to be run after the server process exits."""
+        self._stop_callbacks.append(callback)
 
     @asyncio.coroutine
     def trigger_log_events(self, msg):
         suppress = False
-        for pattern, callback in self._log_events:
+        # callbacks may remove themselves, so iterate over a copy
+        for pattern, callback in list(self._log_events):
             m = pattern.match(msg)
             if m:
                 result = callback(m)
@@ -133,42 +197,149 @@ class ServerWrapper:
             f.write("eula=true\n")
 
     @asyncio.coroutine
-    def start(self, loop=None):
-        yield from self.acquire_write()
+    def start(self, loop=None, lock_timeout=None):
+        """Starts the server process.
+
+        The world write lock is held for as long as the server runs. Raises
+        rwlock.LockTimeout if it can't be had within `lock_timeout` seconds."""
+        yield from self.acquire_write(lock_timeout)
+        if self._detached and self._reattach(loop):
+            return
         self._set_status('starting')
+        for callback in self._start_callbacks:
+            result = callback()
+            if asyncio.iscoroutine(result):
+                yield from result
         _logger.info("Preparing to start Minecraft server process")
         if not os.path.isdir(self._working_dir):
             _logger.info("working directory does not exist")
             os.mkdir(self._working_dir)
             _logger.info("created working directory '%s'", self._working_dir)
         yield from self.agree_to_eula()
-        old_wd = os.getcwd()
-        os.chdir(self._working_dir)
         _logger.info("Starting Minecraft server process")
-        self.process = yield from asyncio.create_subprocess_exec(
-            *self.get_server_cmd_line(),
-            stdout=asyncio.subprocess.PIPE,
-            stdin=asyncio.subprocess.PIPE)
-        os.chdir(old_wd)
+        if self._detached:
+            self.process = detach.DetachedProcess.spawn(
+                self.get_server_cmd_line(), self._working_dir,
+                self._console_fifo, self._console_log, self._console_poll,
+                self._console_log_max_size)
+        else:
+            # cwd rather than chdir, which would pull the directory out from
+            # under everything else running on the loop meanwhile
+            self.process = yield from asyncio.create_subprocess_exec(
+                *self.get_server_cmd_line(),
+                cwd=self._working_dir,
+                stdout=asyncio.subprocess.PIPE,
+                stdin=asyncio.subprocess.PIPE)
+        self.telemetry.record_spawn()
+        self._checkpoint()
         self.handle_io(loop)
-        loop.create_task(self._clean_up_after_stop(loop))
+        self._cleanup_task = loop.create_task(self._clean_up_after_stop(loop))
+
+    def _reattach(self, loop):
+        """Picks up a detached server process left running by an earlier
+        wrapper, if there is one."""
+        checkpoint = detach.load_checkpoint(self._checkpoint_path)
+        if not checkpoint:
+            return False
+        process = detach.DetachedProcess.reattach(
+            checkpoint, self._console_fifo, self._console_log,
+            self._console_poll)
+        if not process:
+            _logger.info("checkpointed server process is no longer running")
+            detach.remove_checkpoint(self._checkpoint_path)
+            return False
+        self.process = process
+        self._restore(checkpoint)
+        _logger.info("Reattached to Minecraft server process %d", process.pid)
+        self.handle_io(loop)
+        self._cleanup_task = loop.create_task(self._clean_up_after_stop(loop))
+        return True
+
+    @staticmethod
+    def _from_timestamp(t):
+        return datetime.fromtimestamp(t, pytz.UTC) if t else None
+
+    def _checkpoint(self):
+        if not isinstance(self.process, detach.DetachedProcess):
+            return
+        detach.save_checkpoint(self._checkpoint_path, {
+            'pid': self.process.pid,
+            'start_time': self.process.start_time,
+            'log_offset': self.process.stdout.offset,
+            'log_inode': self.process.stdout.inode,
+            'status': self._status,
+            'status_changed_at': self._status_changed_time.timestamp(),
+            'players': {name: joined.timestamp()
+                        for name, joined in self._players.items()},
+            'last_part': self._last_part and self._last_part.timestamp(),
+        })
+        self._checkpointed_at = time.monotonic()
+
+    def _restore(self, checkpoint):
+        self._status = checkpoint.get('status', 'running')
+        self._status_changed_time = self._from_timestamp(
+            checkpoint.get('status_changed_at')) or self._now_tz()
+        self._players = {name: self._from_timestamp(joined)
+                         for name, joined in checkpoint.get('players',
+                                                            {}).items()}
+        self._last_part = self._from_timestamp(checkpoint.get('last_part'))
+
+    @property
+    def can_detach(self):
+        return isinstance(self.process, detach.DetachedProcess)
+
+    def detach(self, loop=None):
+        """Lets go of a detached server process, leaving it running.
+
+        Its state is checkpointed so that the next wrapper to start can
+        carry on where this one left off."""
+        if not self.can_detach:
+            return
+        if not loop:
+            loop = asyncio.get_event_loop()
+        self._checkpoint()
+        self._stop_io(loop)
+        self._cleanup_task.cancel()
+        self.process.close()
+        _logger.info("Detached from Minecraft server process %d",
+                     self.process.pid)
+        self.process = None
+
+    def _stop_io(self, loop):
+        loop.remove_reader(sys.stdin.fileno())
+        self._input_task.cancel()
+        self._output_task.cancel()
 
     @asyncio.coroutine
     def _clean_up_after_stop(self, loop):
         yield from self.process.wait()
         self._set_status('stopped')
-        loop.remove_reader(sys.stdin.fileno())
-        self._input_task.cancel()
-        self._output_task.cancel()
+        self._players.clear()
+        self._stop_io(loop)
+        if isinstance(self.process, detach.DetachedProcess):
+            self.process.close()
+            detach.remove_checkpoint(self._checkpoint_path)
         self.process = None
         _logger.info("Minecraft server stopped")
+        self.world_index.refresh()
         yield from self.release_write()
+        for callback in self._stop_callbacks:
+            result = callback()
+            if asyncio.iscoroutine(result):
+                yield from result
 
     @asyncio.coroutine
     def wait(self):
         if self.process:
             yield from self.process.wait()
 
+    @asyncio.coroutine
+    def wait_stopped(self):
+        """Waits until the server process has exited and the stop
+        callbacks have run."""
+        if self._cleanup_task and not self._cleanup_task.cancelled():
+            yield from self._cleanup_task
+
     def handle_io(self, loop=None):
         if not loop:
             loop = asyncio.get_event_loop()
@@ -199,6 +370,10 @@ class ServerWrapper:
             data = yield from self.process.stdout.readline()
             line = data.decode('utf-8').rstrip()
             yield from self.handle_log_line(line)
+            # keep the log position in the checkpoint roughly current, so
+            # little is replayed if the wrapper dies without detaching
+            if time.monotonic() - self._checkpointed_at > 1:
+                self._checkpoint()
 
     @asyncio.coroutine
     def handle_input(self):
@@ -213,15 +388,23 @@ class ServerWrapper:
 
     @asyncio.coroutine
     def send_command(self, line):
-        """Sends a line to the server process."""
+        """Sends a line to the server process.
+
+        Raises ServerNotRunning if there is no server process."""
+        if not self.process:
+            raise ServerNotRunning("server is " + self.status)
         # because handle_input only sends input line-by-line, we can safely
         # send any lines we like without worrying about corrupting the stream
         self.process.stdin.write("{0}\n".format(line).encode())
         yield from self.process.stdin.drain()
 
     @asyncio.coroutine
-    def send_command_and_wait(self, line, pattern, suppress=True):
-        """Sends a line to the server, then waits for a response."""
+    def send_command_and_wait(self, line, pattern, suppress=True,
+                              timeout=None):
+        """Sends a line to the server, then waits for a response.
+
+        Raises asyncio.TimeoutError if no response arrives within `timeout`
+        seconds."""
         sem = asyncio.Semaphore(value=0)
         mm = None
         e = None
@@ -231,7 +414,7 @@ class ServerWrapper:
             nonlocal mm
             self.remove_log_event(e)
             mm = m
-            yield from sem.release()
+            sem.release()
             return suppress
 
         e = self.add_log_event(pattern, callback)
@@ -239,27 +422,75 @@ class ServerWrapper:
         # now that we're prepared for the response, we can send the command and
         # wait for the response without worrying about missing it
         yield from self.send_command(line)
-        yield from sem.acquire()
+        try:
+            yield from asyncio.wait_for(sem.acquire(), timeout)
+        finally:
+            self.remove_log_event(e)
         return mm
 
     @asyncio.coroutine
-    def stop(self):
+    def pause_saving(self, timeout=60):
+        """Flushes the world to disk and stops the server writing to it."""
+        yield from self.send_command('save-off')
+        try:
+            yield from self.send_command_and_wait(
+                'save-all flush', _world_saved_re, suppress=False,
+                timeout=timeout)
+        except asyncio.TimeoutError:
+            yield from self.resume_saving()
+            raise
+
+    @asyncio.coroutine
+    def resume_saving(self):
+        yield from self.send_command('save-on')
+
+    @asyncio.coroutine
+    def save(self):
+        """Asks the server to save the world, and waits until it has."""
+        yield from self.send_command_and_wait('save-all', _world_saved_re,
+                                              suppress=False)
+
+    @asyncio.coroutine
+    def stop(self, confirm=False):
         """Stops the server.
 
-        Functions by sending the string 'stop' to the server via stdin."""
+        Functions by sending the string 'stop' to the server via stdin. If
+        `confirm` is set, waits until the server says it is stopping."""
 
         self._set_status('stopping')
-        yield from self.send_command('stop')
+        if confirm:
+            yield from self.send_command_and_wait('stop', _server_stopping_re,
+                                                  suppress=False)
+        else:
+            yield from self.send_command('stop')
 
     def _player_joined_callback(self, m):
-        self._players[m.group('name')] = self._now_tz()
+        name = m.group('name')
+        # after reattaching, lines may be replayed from the last checkpoint
+        if name in self._players:
+            return
+        self._players[name] = self._now_tz()
+        self._checkpoint()
+        for callback in self._player_callbacks:
+            callback('join', name)
 
     def _player_left_callback(self, m):
-        del self._players[m.group('name')]
+        name = m.group('name')
+        if name not in self._players:
+            return
+        del self._players[name]
         self._last_part = self._now_tz()
+        self._checkpoint()
+        for callback in self._player_callbacks:
+            callback('leave', name)
 
-    def _server_started_callback(self, _):
+    def _server_started_callback(self, m):
         self._set_status('running')
+        self.telemetry.record_startup(m.group('time'))
+
+    def _server_lag_callback(self, m):
+        self._last_lag = self._now_tz()
+        self.telemetry.record_lag(int(m.group('ms')), int(m.group('ticks')))
 
     @property
     def players(self):
@@ -274,6 +505,10 @@ class ServerWrapper:
             return self._last_part
         return None
 
+    @property
+    def last_lag_at(self):
+        return self._last_lag
+
     @property
     def status(self):
         return self._status
@@ -281,6 +516,7 @@ class ServerWrapper:
     def _set_status(self, status):
         self._status = status
         self._status_changed_time = self._now_tz()
+        self._checkpoint()
 
     @property
     def status_changed_at(self):
@@ -294,22 +530,23 @@ class ServerWrapper:
     def can_stop(self):
         return self.status == 'running'
 
-    def world_files(self):
-        if self.status != 'stopped':
+    @property
+    def world_path(self):
+        return os.path.join(self._working_dir, 'world')
+
+    def world_files(self, allow_running=False, world_filter=None):
+        """Yields (path, relative path) pairs for everything in the world.
+
+        If given, `world_filter` decides which paths are included. Unless
+        `allow_running` is set, nothing is yielded while the server is
+        running; callers which set it should pause saving first."""
+        if self.status != 'stopped' and not allow_running:
             # TODO: raise an exception
             return
-        world_path = os.path.join(self._working_dir, 'world')
-        for dir_path, dirnames, filenames in os.walk(world_path):
-            for n in filenames + dirnames:
-                path = os.path.join(dir_path, n)
-                yield (os.path.abspath(path),
-                       os.path.relpath(path, world_path))
+        yield from self.world_index.files(world_filter)
 
     @asyncio.coroutine
     def world_extract(self, archive, dirname):
-        dirname = os.path.normcase(os.path.normpath(dirname))
-        if dirname == '.':
-            dirname = ''
         if self.status != 'stopped':
             # TODO: raise an exception
             return
@@ -317,6 +554,61 @@ class ServerWrapper:
         _logger.info("extracting world to '%s'", world_new_path)
         if os.path.exists(world_new_path):
             shutil.rmtree(world_new_path)
+        self._extract_members(archive, dirname, world_new_path)
+        self._swap_world(world_new_path)
+
+    @asyncio.coroutine
+    def world_apply_delta(self, archive, dirname, deleted=()):
+        """Replaces the world with a copy that has some files changed.
+
+        Everything in the current world except the paths in `deleted`, and
+        anything under them, is copied into the new world, as reflinks where
+        the filesystem supports them, then `archive` is extracted over the
+        top. As with world_extract, the old world is kept untouched as
+        world_old.
+
+        Raises ServerRunning unless the server is stopped.
+        """
+        if self.status != 'stopped':
+            raise ServerRunning("server is " + self.status)
+        deleted = set(os.path.normcase(os.path.normpath(d)) for d in deleted)
+        world_new_path = os.path.join(self._working_dir, 'world_new')
+        _logger.info("assembling world in '%s'", world_new_path)
+        if os.path.exists(world_new_path):
+            shutil.rmtree(world_new_path)
+        os.makedirs(world_new_path)
+        # the index is only touched from the event loop, so the list is
+        # taken here and the copying left to an executor
+        files = list(self.world_index.files())
+        copied = yield from asyncio.get_event_loop().run_in_executor(
+            None, self._copy_unchanged, files, deleted, world_new_path)
+        _logger.info("copied %d unchanged files", copied)
+        if archive:
+            self._extract_members(archive, dirname, world_new_path)
+        self._swap_world(world_new_path)
+
+    @staticmethod
+    def _copy_unchanged(files, deleted, world_new_path):
+        copied = 0
+        for path, rel in files:
+            parts = rel.split(os.sep)
+            if any(os.sep.join(parts[:i]) in deleted
+                   for i in range(1, len(parts) + 1)):
+                continue
+            out_path = os.path.join(world_new_path, rel)
+            if os.path.isdir(path):
+                os.makedirs(out_path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            _copy_file(path, out_path)
+            copied += 1
+        return copied
+
+    @staticmethod
+    def _extract_members(archive, dirname, world_new_path):
+        dirname = os.path.normcase(os.path.normpath(dirname))
+        if dirname == '.':
+            dirname = ''
         for member in archive:
             # gotta get this now because os.path.normpath() will remove it.
             is_dir = member.endswith('/')
@@ -340,43 +632,40 @@ class ServerWrapper:
                     _logger.debug("extracting file '%s'", out_path)
                     with open(out_path, 'wb') as file:
                         archive.extract_into(file)
+
+    def _swap_world(self, world_new_path):
         world_old_path = os.path.join(self._working_dir, 'world_old')
-        world_path = os.path.join(self._working_dir, 'world')
+        world_path = self.world_path
         if os.path.exists(world_old_path):
             shutil.rmtree(world_old_path)
         if os.path.exists(world_path):
             os.rename(world_path, world_old_path)
         os.rename(world_new_path, world_path)
+        self.world_index.rebuild()
 
     @asyncio.coroutine
-    def acquire_read(self):
-        yield from self._world_read_cond.acquire()
-        self._world_reading += 1
-        self._world_read_cond.release()
+    def acquire_read(self, timeout=None):
+        yield from self._world_lock.acquire_read(timeout)
 
     @asyncio.coroutine
     def release_read(self):
-        yield from self._world_read_cond.acquire()
-        self._world_reading = max(0, self._world_reading - 1)
-        self._world_read_cond.notify_all()
-        self._world_read_cond.release()
+        self._world_lock.release_read()
 
     @asyncio.coroutine
-    def acquire_write(self):
-        yield from self._world_read_cond.acquire()
-        yield from self._world_read_cond.wait_for(
-            lambda: self._world_reading == 0)
-        yield from self._world_write_lock.acquire()
+    def acquire_write(self, timeout=None):
+        yield from self._world_lock.acquire_write(timeout)
 
     @asyncio.coroutine
     def release_write(self):
-        self._world_write_lock.release()
-        self._world_read_cond.release()
+        self._world_lock.release_write()
 
     @property
     def can_read(self):
-        return not self._world_write_lock.locked()
+        return not self._world_lock.writing
 
     @property
     def can_write(self):
-        return self.can_read and self._world_reading == 0
+        return self.can_read and self._world_lock.readers == 0
+
+    def world_lock_stats(self):
+        return self._world_lock.stats()
@@ -0,0 +1,371 @@
+"""Classes for pre-generating terrain through the server console."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import logging
+import os
+import re
+import time
+import simplejson as json
+from . import minecraft
+
+_logger = logging.getLogger(__name__)
+
+# give up on a job after this many chunks in a row get no response
+_max_timeouts = 5
+
+# how long to wait before checking whether a stopped server is back
+_wait_interval = 5
+
+
+class JobRunning(Exception):
+    pass
+
+
+class PregenJob:
+    """A rectangle of chunks to generate, and how far through it we are.
+
+    Chunks are generated a row at a time, so the position is just the
+    number of chunks done. Chunks which have been loaded but not yet
+    unloaded are kept in `loaded` as [cx, cz, unload_at, checks]."""
+
+    def __init__(self, x0, z0, x1, z1):
+        self.x0, self.x1 = sorted((x0, x1))
+        self.z0, self.z1 = sorted((z0, z1))
+        self.done = 0
+        self.status = 'waiting'
+        self.rate = None
+        self.lag_events = 0
+        self.timeouts = 0
+        self.created_at = time.time()
+        self.finished_at = None
+        self.loaded = []
+
+    @property
+    def width(self):
+        return self.x1 - self.x0 + 1
+
+    @property
+    def total(self):
+        return self.width * (self.z1 - self.z0 + 1)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'cancelled', 'failed')
+
+    def chunk(self, n):
+        return self.x0 + n % self.width, self.z0 + n // self.width
+
+    def to_dict(self):
+        return {
+            'region': [self.x0, self.z0, self.x1, self.z1],
+            'done': self.done,
+            'status': self.status,
+            'rate': self.rate,
+            'lag_events': self.lag_events,
+            'timeouts': self.timeouts,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'loaded': self.loaded,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        job = cls(*d['region'])
+        job.done = d['done']
+        job.status = d['status']
+        job.rate = d['rate']
+        job.lag_events = d['lag_events']
+        job.timeouts = d['timeouts']
+        job.created_at = d['created_at']
+        job.finished_at = d['finished_at']
+        job.loaded = d.get('loaded', [])
+        return job
+
+    def progress(self):
+        progress = self.to_dict()
+        progress['total'] = self.total
+        progress['percent'] = 100 * self.done / self.total
+        progress['loaded'] = len(self.loaded)
+        progress['eta'] = None
+        if self.rate and not self.finished:
+            progress['eta'] = (self.total - self.done) / self.rate
+        return progress
+
+
+class PregenRunner:
+    """Generates chunks by issuing console commands, one chunk at a time.
+
+    `LoadCommand` is sent for each chunk, formatted with the chunk's block
+    coordinates as {x} and {z} and its chunk coordinates as {cx} and {cz}.
+    If `LoadResponse` is set, the runner waits for a console line matching
+    it before going on. `UnloadCommand`, if set, is sent `UnloadDelay`
+    seconds later, giving the server time to generate the chunk. If
+    `LoadedCommand` and `LoadedResponse` are set, the runner asks the
+    server whether the chunk has loaded before unloading it, and puts off
+    the unload if it hasn't; if `LoadedResponse` has a group named
+    `loaded`, the chunk only counts as loaded when that group matched.
+
+    The pace is set by additive increase, multiplicative decrease: every
+    chunk done without the server falling behind raises the rate by
+    `RateIncrease` chunks per second per second, and every chunk during
+    which the server logs "Can't keep up!" halves it and pauses for
+    `LagBackoff` seconds.
+
+    The job is saved to `StateFile` as it goes, so it carries on where it
+    left off when the wrapper restarts. If the server stops part way
+    through, the job waits for it to come back.
+    """
+
+    def __init__(self, mc_server, pregen_config):
+        self._mc_server = mc_server
+        self._state_file = pregen_config.get('StateFile',
+                                             "./server/pregen.json")
+        self._load_command = pregen_config.get('LoadCommand',
+                                               "forceload add {x} {z}")
+        self._unload_command = pregen_config.get('UnloadCommand',
+                                                 "forceload remove {x} {z}")
+        response = pregen_config.get('LoadResponse', "")
+        self._load_response = response and re.compile(response)
+        self._unload_delay = float(pregen_config.get('UnloadDelay', "10"))
+        self._loaded_command = pregen_config.get('LoadedCommand', "")
+        response = pregen_config.get('LoadedResponse', "")
+        self._loaded_response = response and re.compile(response)
+        self._response_timeout = float(pregen_config.get('ResponseTimeout',
+                                                         "30"))
+        self._min_rate = float(pregen_config.get('MinRate', "0.2"))
+        self._max_rate = float(pregen_config.get('MaxRate', "20"))
+        self._initial_rate = float(pregen_config.get('InitialRate', "2"))
+        self._rate_increase = float(pregen_config.get('RateIncrease', "0.5"))
+        self._lag_backoff = float(pregen_config.get('LagBackoff', "10"))
+        self._max_chunks = int(pregen_config.get('MaxChunks', "250000"))
+        self._save_every = int(pregen_config.get('SaveEvery', "50"))
+        self.job = None
+        self._task = None
+        self._loop = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self._state_file) as f:
+                self.job = PregenJob.from_dict(json.load(f))
+        except FileNotFoundError:
+            self.job = None
+        except (OSError, ValueError, KeyError, TypeError):
+            _logger.exception("couldn't read pre-generation state")
+            self.job = None
+
+    def save(self):
+        if not self.job:
+            return
+        tmp_path = self._state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.job.to_dict(), f)
+        os.rename(tmp_path, self._state_file)
+
+    def start(self, loop):
+        self._loop = loop
+        if self.job and not self.job.finished:
+            _logger.info("resuming pre-generation at chunk %d of %d",
+                         self.job.done, self.job.total)
+            self._task = loop.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.save()
+
+    def submit(self, x0, z0, x1, z1):
+        """Starts generating the chunks covering the given block
+        coordinates.
+
+        Raises JobRunning if a job is already under way, or ValueError if
+        the region has too many chunks."""
+        if self.job and not self.job.finished:
+            raise JobRunning()
+        job = PregenJob(x0 // 16, z0 // 16, x1 // 16, z1 // 16)
+        if job.total > self._max_chunks:
+            raise ValueError("region has {0} chunks, more than {1}".format(
+                job.total, self._max_chunks))
+        job.rate = self._initial_rate
+        self.job = job
+        self.save()
+        _logger.info("pre-generating %d chunks", job.total)
+        self._task = self._loop.create_task(self._run())
+        return job
+
+    def cancel(self):
+        if not self.job or self.job.finished:
+            return False
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._finish('cancelled')
+        if self.job.loaded:
+            self._loop.create_task(self._unload_all(self.job))
+        return True
+
+    def _finish(self, status):
+        self.job.status = status
+        self.job.finished_at = time.time()
+        self.save()
+        _logger.info("pre-generation %s after %d of %d chunks", status,
+                     self.job.done, self.job.total)
+
+    @asyncio.coroutine
+    def _generate(self, cx, cz):
+        """Loads one chunk, returning False if the server didn't respond in
+        time."""
+        job = self.job
+        entry = None
+        if self._unload_command:
+            # note the chunk before loading it, so it gets unloaded even if
+            # we're interrupted; a retry of the same chunk reuses the entry
+            if job.loaded and job.loaded[-1][:2] == [cx, cz]:
+                entry = job.loaded[-1]
+            else:
+                entry = [cx, cz, None, 0]
+                job.loaded.append(entry)
+            entry[2] = time.time() + self._unload_delay
+        command = self._format(self._load_command, cx, cz)
+        if self._load_response:
+            try:
+                yield from self._mc_server.send_command_and_wait(
+                    command, self._load_response,
+                    timeout=self._response_timeout)
+            except asyncio.TimeoutError:
+                return False
+        else:
+            yield from self._mc_server.send_command(command)
+        if entry:
+            entry[2] = time.time() + self._unload_delay
+        return True
+
+    @staticmethod
+    def _format(command, cx, cz):
+        return command.format(x=cx * 16, z=cz * 16, cx=cx, cz=cz)
+
+    @asyncio.coroutine
+    def _is_loaded(self, cx, cz):
+        if not (self._loaded_command and self._loaded_response):
+            return True
+        try:
+            m = yield from self._mc_server.send_command_and_wait(
+                self._format(self._loaded_command, cx, cz),
+                self._loaded_response, timeout=self._response_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return 'loaded' not in m.re.groupindex or bool(m.group('loaded'))
+
+    @asyncio.coroutine
+    def _unload_due(self, job, force=False):
+        """Unloads the chunks whose delay has passed, or all of them if
+        `force` is set."""
+        while job.loaded and (force or job.loaded[0][2] <= time.time()):
+            entry = job.loaded[0]
+            cx, cz = entry[:2]
+            if not force and not (yield from self._is_loaded(cx, cz)):
+                entry[3] += 1
+                if entry[3] < _max_timeouts:
+                    # later entries are due no later than this, so moving
+                    # it to the back keeps the list in order
+                    entry[2] = time.time() + self._unload_delay
+                    job.loaded.append(job.loaded.pop(0))
+                    continue
+                _logger.warning("chunk %d, %d still isn't loaded, "
+                                "unloading it anyway", cx, cz)
+            yield from self._mc_server.send_command(
+                self._format(self._unload_command, cx, cz))
+            job.loaded.pop(0)
+
+    @asyncio.coroutine
+    def _unload_all(self, job):
+        try:
+            yield from self._unload_due(job, force=True)
+        except (minecraft.ServerNotRunning, OSError):
+            _logger.warning("server stopped, leaving %d chunks loaded",
+                            len(job.loaded))
+        if job is self.job:
+            self.save()
+
+    @asyncio.coroutine
+    def _run(self):
+        try:
+            yield from self._pregenerate()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _logger.exception("pre-generation failed")
+            self._finish('failed')
+
+    @asyncio.coroutine
+    def _pregenerate(self):
+        job = self.job
+        telemetry = self._mc_server.telemetry
+        consecutive_timeouts = 0
+        while job.done < job.total or job.loaded:
+            if self._mc_server.status != 'running':
+                if job.status != 'waiting':
+                    job.status = 'waiting'
+                    self.save()
+                consecutive_timeouts = 0
+                yield from asyncio.sleep(_wait_interval)
+                continue
+            try:
+                yield from self._unload_due(job)
+                if job.done >= job.total:
+                    # everything's loaded; wait for the last unloads
+                    if job.loaded:
+                        yield from asyncio.sleep(
+                            max(0, job.loaded[0][2] - time.time()))
+                    continue
+                job.status = 'running'
+                lag_before = telemetry.lag_events_total
+                responded = yield from self._generate(*job.chunk(job.done))
+            except (minecraft.ServerNotRunning, OSError):
+                # the server went away under us; pick up again once it's
+                # back
+                _logger.info("server stopped during pre-generation")
+                job.status = 'waiting'
+                self.save()
+                yield from asyncio.sleep(_wait_interval)
+                continue
+            if not responded:
+                job.timeouts += 1
+                consecutive_timeouts += 1
+                if consecutive_timeouts >= _max_timeouts:
+                    yield from self._unload_all(job)
+                    self._finish('failed')
+                    return
+            else:
+                consecutive_timeouts = 0
+                job.done += 1
+                if job.done % self._save_every == 0:
+                    self.save()
+            if not responded or telemetry.lag_events_total != lag_before:
+                job.lag_events += telemetry.lag_events_total - lag_before
+                job.rate = max(self._min_rate, job.rate / 2)
+                _logger.info("server is lagging, pre-generating at %.2f "
+                             "chunks/s", job.rate)
+                yield from asyncio.sleep(self._lag_backoff)
+            else:
+                job.rate = min(self._max_rate,
+                               job.rate + self._rate_increase / job.rate)
+            yield from asyncio.sleep(1 / job.rate)
+        self._finish('done')
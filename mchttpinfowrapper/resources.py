@@ -0,0 +1,275 @@
+"""Classes for sampling the resource usage of the Minecraft process."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from array import array
+import logging
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+
+columns = ('time', 'cpu', 'rss', 'threads', 'read_rate', 'write_rate')
+_ncols = len(columns)
+
+
+def _skip_fields(buf, i, end, count):
+    """Returns the index of the field `count` fields on from the one
+    starting at buf[i], in a line of fields separated by single spaces."""
+    while count and i < end:
+        if buf[i] == 32:
+            count -= 1
+        i += 1
+    return i
+
+
+def _parse_int(buf, i, end):
+    """Parses the unsigned decimal number starting at buf[i]."""
+    value = 0
+    while i < end and 48 <= buf[i] <= 57:
+        value = value * 10 + buf[i] - 48
+        i += 1
+    return value
+
+
+class RingBuffer:
+    """A fixed-size table of floats, one array per column.
+
+    Appending overwrites the oldest row once the buffer is full, and never
+    allocates."""
+
+    def __init__(self, capacity, ncols):
+        self.capacity = capacity
+        self._data = [array('d', bytes(8 * capacity)) for _ in range(ncols)]
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values):
+        i = self._next
+        for c in range(len(self._data)):
+            self._data[c][i] = values[c]
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _indices(self):
+        start = (self._next - self._count) % self.capacity
+        for n in range(self._count):
+            yield (start + n) % self.capacity
+
+    @property
+    def oldest_time(self):
+        if not self._count:
+            return None
+        return self._data[0][(self._next - self._count) % self.capacity]
+
+    def since(self, t):
+        """Returns the rows whose first column is at least `t`, by column."""
+        times = self._data[0]
+        indices = [i for i in self._indices() if times[i] >= t]
+        return [[col[i] for i in indices] for col in self._data]
+
+
+class _Tier:
+    """A ring buffer fed with the mean of every `factor` samples."""
+
+    def __init__(self, factor, capacity, interval):
+        self.factor = factor
+        self.interval = interval * factor
+        self.buffer = RingBuffer(capacity, _ncols)
+        self._sums = array('d', bytes(8 * _ncols))
+        self._n = 0
+
+    def add(self, values):
+        if self.factor == 1:
+            self.buffer.append(values)
+            return
+        sums = self._sums
+        for c in range(_ncols):
+            sums[c] += values[c]
+        self._n += 1
+        if self._n == self.factor:
+            for c in range(_ncols):
+                sums[c] /= self._n
+            self.buffer.append(sums)
+            for c in range(_ncols):
+                sums[c] = 0.0
+            self._n = 0
+
+
+class ResourceSampler:
+    """Samples CPU, memory, thread count and disk I/O of the server process.
+
+    Samples are read from /proc every `Interval` seconds into a ring buffer
+    of raw samples, and averaged into per-minute and per-quarter-hour ring
+    buffers for longer histories. The /proc files are kept open between
+    samples, read into a preallocated buffer and parsed where they lie, so
+    a sample creates no objects beyond the ints and floats it computes
+    with.
+    """
+
+    def __init__(self, mc_server, resource_config):
+        self._mc_server = mc_server
+        self.interval = float(resource_config.get('Interval', "5"))
+        self.tiers = [
+            _Tier(1, int(resource_config.get('RawSamples', "720")),
+                  self.interval),
+            _Tier(max(1, int(round(60 / self.interval))),
+                  int(resource_config.get('MinuteSamples', "1440")),
+                  self.interval),
+            _Tier(max(1, int(round(900 / self.interval))),
+                  int(resource_config.get('QuarterHourSamples', "2880")),
+                  self.interval),
+        ]
+        self._clock_ticks = os.sysconf('SC_CLK_TCK')
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._buf = bytearray(4096)
+        self._values = array('d', bytes(8 * _ncols))
+        self._files = None
+        self._pid = None
+        self._last = array('d', bytes(8 * 4))
+        self._have_last = False
+        self._task = None
+
+    def start(self, loop):
+        self._task = loop.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._close()
+
+    @asyncio.coroutine
+    def _run(self):
+        while True:
+            yield from asyncio.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception:
+                # one bad sample mustn't stop us sampling
+                _logger.exception("couldn't sample server resources")
+
+    def _open(self, pid):
+        self._close()
+        proc = '/proc/{0}/'.format(pid)
+        files = []
+        for name in ('stat', 'statm', 'io'):
+            try:
+                files.append(open(proc + name, 'rb', buffering=0))
+            except OSError:
+                # /proc/<pid>/io needs the same user or CAP_SYS_PTRACE
+                files.append(None)
+        self._files = files
+        self._pid = pid
+        self._have_last = False
+
+    def _close(self):
+        if self._files:
+            for f in self._files:
+                if f:
+                    f.close()
+        self._files = None
+        self._pid = None
+
+    def _read(self, f):
+        """Reads a /proc file into the buffer, returning its length."""
+        f.seek(0)
+        return f.readinto(self._buf)
+
+    def _read_io_field(self, n, name):
+        i = self._buf.find(name, 0, n)
+        if i < 0:
+            return -1.0
+        return _parse_int(self._buf, i + len(name), n)
+
+    def sample(self):
+        process = self._mc_server.process
+        if not process:
+            self._close()
+            return
+        if process.pid != self._pid:
+            self._open(process.pid)
+        stat_file, statm_file, io_file = self._files
+        if not (stat_file and statm_file):
+            # the process has already gone
+            self._close()
+            return
+        buf = self._buf
+        try:
+            n = self._read(stat_file)
+            # the command name may contain spaces, so count fields after it
+            i = _skip_fields(buf, buf.rindex(b')', 0, n) + 2, n, 11)
+            cpu_ticks = _parse_int(buf, i, n)
+            i = _skip_fields(buf, i, n, 1)
+            cpu_ticks += _parse_int(buf, i, n)
+            i = _skip_fields(buf, i, n, 5)
+            threads = _parse_int(buf, i, n)
+            n = self._read(statm_file)
+            rss = _parse_int(buf, _skip_fields(buf, 0, n, 1), n) \
+                * self._page_size
+            read_bytes = write_bytes = -1.0
+            if io_file:
+                n = self._read(io_file)
+                read_bytes = self._read_io_field(n, b'\nread_bytes: ')
+                write_bytes = self._read_io_field(n, b'\nwrite_bytes: ')
+        except (OSError, ValueError):
+            self._close()
+            return
+        now = time.time()
+
+        last = self._last
+        if self._have_last:
+            elapsed = now - last[0]
+            v = self._values
+            v[0] = now
+            v[1] = (cpu_ticks - last[1]) / self._clock_ticks / elapsed
+            v[2] = rss
+            v[3] = threads
+            v[4] = (read_bytes - last[2]) / elapsed if read_bytes >= 0 else 0.0
+            v[5] = (write_bytes - last[3]) / elapsed \
+                if write_bytes >= 0 else 0.0
+            for tier in self.tiers:
+                tier.add(v)
+        last[0] = now
+        last[1] = cpu_ticks
+        last[2] = read_bytes
+        last[3] = write_bytes
+        self._have_last = True
+
+    def since(self, t):
+        """Returns samples since `t` from the finest tier that covers it."""
+        filled = [tier for tier in self.tiers if len(tier.buffer)]
+        if not filled:
+            return {
+                'interval': self.tiers[0].interval,
+                'samples': {column: [] for column in columns},
+            }
+        # failing that, whichever reaches furthest back
+        tier = min(filled, key=lambda tier: tier.buffer.oldest_time)
+        for candidate in filled:
+            if candidate.buffer.oldest_time <= t:
+                tier = candidate
+                break
+        data = tier.buffer.since(t)
+        return {
+            'interval': tier.interval,
+            'samples': dict(zip(columns, data)),
+        }
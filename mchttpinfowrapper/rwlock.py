@@ -0,0 +1,187 @@
+"""A fair reader-writer lock for asyncio."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import collections
+import time
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class _HoldStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max}
+
+
+class RWLock:
+    """A reader-writer lock which grants waiters in arrival order.
+
+    Readers only share the lock with readers which arrived before any
+    waiting writer, so a steady stream of readers cannot starve writers.
+    Acquire calls take an optional timeout, after which they give up their
+    place in the queue and raise LockTimeout.
+    """
+
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._waiters = collections.deque()
+        self._write_since = None
+        self._read_since = None
+        self._acquired = {'read': 0, 'write': 0}
+        self._timeouts = {'read': 0, 'write': 0}
+        self._wait_stats = {'read': _HoldStats(), 'write': _HoldStats()}
+        self._hold_stats = {'read': _HoldStats(), 'write': _HoldStats()}
+
+    @property
+    def readers(self):
+        return self._readers
+
+    @property
+    def writing(self):
+        return self._writer
+
+    def _waiting(self, is_writer):
+        return sum(1 for fut, w in self._waiters
+                   if w == is_writer and not fut.done())
+
+    def _grant(self, is_writer):
+        now = time.monotonic()
+        if is_writer:
+            self._writer = True
+            self._write_since = now
+            self._acquired['write'] += 1
+        else:
+            if self._readers == 0:
+                self._read_since = now
+            self._readers += 1
+            self._acquired['read'] += 1
+
+    def _wake(self):
+        while self._waiters:
+            fut, is_writer = self._waiters[0]
+            if fut.done():
+                # gave up waiting
+                self._waiters.popleft()
+                continue
+            if is_writer:
+                if self._writer or self._readers:
+                    break
+                self._waiters.popleft()
+                self._grant(True)
+                fut.set_result(None)
+                break
+            if self._writer:
+                break
+            self._waiters.popleft()
+            self._grant(False)
+            fut.set_result(None)
+
+    @asyncio.coroutine
+    def _acquire(self, is_writer, timeout):
+        kind = 'write' if is_writer else 'read'
+        free = not self._writer and not self._waiters \
+            and not (is_writer and self._readers)
+        if free:
+            self._grant(is_writer)
+            self._wait_stats[kind].record(0.0)
+            return
+        fut = asyncio.Future()
+        entry = (fut, is_writer)
+        self._waiters.append(entry)
+        started = time.monotonic()
+        try:
+            yield from asyncio.wait_for(fut, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # we were granted the lock just as we gave up on it
+                self._release(is_writer)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                # a writer leaving the queue may let readers behind it in
+                self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                self._timeouts[kind] += 1
+                raise LockTimeout("timed out waiting for {0} lock".format(
+                    kind)) from None
+            raise
+        self._wait_stats[kind].record(time.monotonic() - started)
+
+    def _release(self, is_writer):
+        now = time.monotonic()
+        if is_writer:
+            if not self._writer:
+                raise RuntimeError("write lock is not held")
+            self._writer = False
+            self._hold_stats['write'].record(now - self._write_since)
+        else:
+            if self._readers == 0:
+                raise RuntimeError("read lock is not held")
+            self._readers -= 1
+            if self._readers == 0:
+                self._hold_stats['read'].record(now - self._read_since)
+        self._wake()
+
+    @asyncio.coroutine
+    def acquire_read(self, timeout=None):
+        yield from self._acquire(False, timeout)
+
+    def release_read(self):
+        self._release(False)
+
+    @asyncio.coroutine
+    def acquire_write(self, timeout=None):
+        yield from self._acquire(True, timeout)
+
+    def release_write(self):
+        self._release(True)
+
+    def stats(self):
+        """Returns counters for waiters, acquisitions and hold times.
+
+        Read hold times cover the periods during which at least one reader
+        held the lock, rather than individual readers."""
+        now = time.monotonic()
+        return {
+            'readers': self._readers,
+            'writing': self._writer,
+            'held_for': {
+                'read': self._readers and now - self._read_since or 0.0,
+                'write': self._writer and now - self._write_since or 0.0,
+            },
+            'waiting': {
+                'read': self._waiting(False),
+                'write': self._waiting(True),
+            },
+            'acquired': dict(self._acquired),
+            'timeouts': dict(self._timeouts),
+            'wait_time': {k: v.as_dict() for k, v in self._wait_stats.items()},
+            'hold_time': {k: v.as_dict() for k, v in self._hold_stats.items()},
+        }
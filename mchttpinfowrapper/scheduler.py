@@ -0,0 +1,277 @@
+"""Classes for scheduled world backups."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import functools
+import logging
+import os
+import os.path
+import threading
+import time
+from datetime import datetime, timedelta
+import pytz
+from . import lazy, rwlock, throttle
+
+_logger = logging.getLogger(__name__)
+
+tarfile = lazy.LazyModule('tarfile')
+
+_section_prefix = 'backup:'
+_name_format = '%Y%m%dT%H%M%SZ'
+
+
+def _now_tz():
+    return pytz.UTC.localize(datetime.utcnow())
+
+
+def _is_archive_of(job_name, name):
+    """Tells whether `name` is one of the archives written for the job
+    called `job_name`, and not for another job whose name starts the same
+    way."""
+    prefix = job_name + '-'
+    if not (name.startswith(prefix) and name.endswith('.tar.gz')):
+        return False
+    try:
+        datetime.strptime(name[len(prefix):-len('.tar.gz')], _name_format)
+    except ValueError:
+        return False
+    return True
+
+
+def _set_thread_niceness(niceness):
+    """Lowers the CPU priority of the calling thread only.
+
+    On Linux, threads are scheduled individually, so setpriority() on a
+    thread id leaves the rest of the process alone."""
+    if not niceness or not hasattr(threading, 'get_native_id'):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except OSError:
+        _logger.warn("could not set backup thread niceness to %d", niceness)
+
+
+class BackupJob:
+    def __init__(self, name, job_config):
+        self.name = name
+        self.kind = job_config.get('Kind', "full")
+        if self.kind not in ('full', 'incremental'):
+            raise ValueError("unknown backup kind '{0}'".format(self.kind))
+        schedule = job_config.get('Schedule', "3600")
+        self.at_stop = schedule == 'stop'
+        self.interval = None if self.at_stop else int(schedule)
+        self.keep = int(job_config.get('Keep', "5"))
+        self.niceness = int(job_config.get('Niceness', "10"))
+        self.bucket = throttle.TokenBucket(
+            int(job_config.get('ReadBandwidth', "0")))
+        # one dedicated thread per job, so niceness never leaks into threads
+        # used for other work
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = False
+        self.next_run_at = None
+
+    @property
+    def schedule(self):
+        return 'stop' if self.at_stop else self.interval
+
+
+class BackupScheduler:
+    """Runs backup jobs periodically or whenever the server stops.
+
+    Jobs are configured in `[backup:<name>]` sections. While the server is
+    running, saving is paused for the duration of a job; while it is
+    stopped, the world read lock is held instead. Jobs pause reading while
+    the server has recently reported that it can't keep up, but since
+    saving stays off until a job finishes, only for `MaxLagHold` seconds
+    in all.
+    """
+
+    def __init__(self, config, mc_server, snapshots=None):
+        self._mc_server = mc_server
+        self._snapshots = snapshots
+        backup_config = config['backups'] if config.has_section('backups') \
+            else {}
+        self._path = os.path.abspath(
+            backup_config.get('Directory', "./backups/"))
+        self._lag_backoff = int(backup_config.get('LagBackoff', "30"))
+        self._max_lag_hold = float(backup_config.get('MaxLagHold', "120"))
+        self._lock_timeout = float(backup_config.get('LockTimeout', "10"))
+        self._history = collections.deque(
+            maxlen=int(backup_config.get('HistorySize', "50")))
+        self.jobs = collections.OrderedDict()
+        for section in config.sections():
+            if section.startswith(_section_prefix):
+                name = section[len(_section_prefix):]
+                job = BackupJob(name, config[section])
+                if job.kind == 'incremental' and not snapshots:
+                    raise ValueError(
+                        "backup job '{0}' needs a [snapshots] section".format(
+                            name))
+                self.jobs[name] = job
+        self._tasks = []
+        self._stop_tasks = []
+        self._loop = None
+
+    @property
+    def history(self):
+        return list(self._history)
+
+    def start(self, loop):
+        self._loop = loop
+        for job in self.jobs.values():
+            if job.at_stop:
+                continue
+            self._tasks.append(loop.create_task(self._run_periodically(job)))
+        self._mc_server.add_stop_callback(self._server_stopped)
+
+    def stop(self):
+        for task in self._tasks + self._stop_tasks:
+            task.cancel()
+        self._tasks = []
+        self._stop_tasks = []
+        for job in self.jobs.values():
+            job.executor.shutdown(wait=False)
+
+    def _server_stopped(self):
+        self._stop_tasks = [t for t in self._stop_tasks if not t.done()]
+        for job in self.jobs.values():
+            if job.at_stop:
+                self._stop_tasks.append(
+                    self._loop.create_task(self.run_job(job)))
+
+    @property
+    def busy(self):
+        """Whether any job is running, or about to because the server
+        stopped."""
+        return any(job.running for job in self.jobs.values()) \
+            or any(not task.done() for task in self._stop_tasks)
+
+    @asyncio.coroutine
+    def _run_periodically(self, job):
+        while True:
+            job.next_run_at = _now_tz() + timedelta(seconds=job.interval)
+            yield from asyncio.sleep(job.interval)
+            yield from self.run_job(job)
+
+    def _lagging(self):
+        last_lag = self._mc_server.last_lag_at
+        return bool(last_lag and (_now_tz() - last_lag).total_seconds()
+                    < self._lag_backoff)
+
+    @asyncio.coroutine
+    def run_job(self, job):
+        record = {
+            'job': job.name,
+            'kind': job.kind,
+            'started_at': _now_tz().isoformat(),
+            'server_status': self._mc_server.status,
+        }
+        started = time.monotonic()
+        online = self._mc_server.status == 'running'
+        if job.running:
+            record['result'] = 'skipped'
+            record['detail'] = "previous run still in progress"
+        elif not online and self._mc_server.status != 'stopped':
+            record['result'] = 'skipped'
+            record['detail'] = "server is " + self._mc_server.status
+        else:
+            job.running = True
+            try:
+                _logger.info("running backup job '%s'", job.name)
+                if online:
+                    yield from self._mc_server.pause_saving()
+                else:
+                    yield from self._mc_server.acquire_read(
+                        self._lock_timeout)
+                try:
+                    files = list(self._mc_server.world_files(
+                        allow_running=online))
+                    hold = throttle.LimitedHold(
+                        self._lagging, self._max_lag_hold if online else 0)
+                    detail = yield from self._loop.run_in_executor(
+                        job.executor, functools.partial(
+                            self._run_in_thread, job, files, hold))
+                finally:
+                    if online:
+                        yield from self._mc_server.resume_saving()
+                    else:
+                        yield from self._mc_server.release_read()
+                if hold.exhausted:
+                    _logger.warning("backup job '%s' stopped pausing for lag "
+                                    "after %.0fs", job.name, hold.held)
+                detail['held_for_lag'] = hold.held
+                record['result'] = 'ok'
+                record['detail'] = detail
+            except rwlock.LockTimeout:
+                record['result'] = 'skipped'
+                record['detail'] = "world is locked"
+            except Exception as e:
+                _logger.exception("backup job '%s' failed", job.name)
+                record['result'] = 'failed'
+                record['detail'] = str(e)
+            finally:
+                job.running = False
+        record['finished_at'] = _now_tz().isoformat()
+        record['duration'] = time.monotonic() - started
+        self._history.append(record)
+        _logger.info("backup job '%s' %s in %.1fs", job.name,
+                     record['result'], record['duration'])
+        return record
+
+    def _run_in_thread(self, job, files, hold):
+        _set_thread_niceness(job.niceness)
+        readers = []
+
+        def wrap_reader(file):
+            reader = throttle.ThrottledFile(file, job.bucket, hold=hold)
+            readers.append(reader)
+            return reader
+
+        if job.kind == 'incremental':
+            snapshot = self._snapshots.create(files, wrap_reader=wrap_reader)
+            detail = {'snapshot': snapshot.name}
+        else:
+            detail = {'archive': self._write_archive(job, files, wrap_reader)}
+        detail['bytes_read'] = sum(r.bytes_read for r in readers)
+        return detail
+
+    def _write_archive(self, job, files, wrap_reader):
+        os.makedirs(self._path, exist_ok=True)
+        name = '{0}-{1}.tar.gz'.format(job.name,
+                                       _now_tz().strftime(_name_format))
+        path = os.path.join(self._path, name)
+        partial_path = path + '.partial'
+        with tarfile.open(partial_path, 'w:gz') as tar:
+            for src, rel in files:
+                info = tar.gettarinfo(
+                    src, arcname=os.path.join('minecraft_world', rel))
+                if info.isreg():
+                    with open(src, 'rb') as f:
+                        tar.addfile(info, wrap_reader(f))
+                else:
+                    tar.addfile(info)
+        os.rename(partial_path, path)
+
+        old = sorted(n for n in os.listdir(self._path)
+                     if _is_archive_of(job.name, n))
+        for n in old[:max(0, len(old) - job.keep)]:
+            _logger.info("removing old backup '%s'", n)
+            os.remove(os.path.join(self._path, n))
+        return name
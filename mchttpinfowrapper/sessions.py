@@ -0,0 +1,287 @@
+"""Classes for recording the history of player sessions."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import collections
+import logging
+import math
+import os
+import os.path
+import struct
+import time
+
+_logger = logging.getLogger(__name__)
+
+# time, kind, player id
+_record = struct.Struct('<dBI')
+
+_LEAVE = 0
+_JOIN = 1
+# everyone left, because the server stopped
+_RESET = 2
+
+_read_size = 64 * 1024
+
+_IndexEntry = collections.namedtuple(
+    '_IndexEntry', ['time', 'segment', 'offset', 'online'])
+
+
+class SessionLog:
+    """An append-only log of players joining and leaving.
+
+    Events are written as fixed-size records to numbered segment files,
+    starting a new segment once the current one reaches `SegmentSize`
+    bytes. Player names are stored once each, in players.txt, and
+    referred to by line number.
+
+    A sparse index is kept in memory, with an entry at the start of each
+    segment and every `IndexInterval` records after that. Each entry holds
+    the time and position of a record, and who was online just before it,
+    so a query only reads the records between the nearest entry and the
+    end of the range it asks about.
+    """
+
+    def __init__(self, mc_server, session_config):
+        self._directory = os.path.abspath(
+            session_config.get('Directory', "./server/sessions/"))
+        self._segment_size = int(session_config.get('SegmentSize',
+                                                    "1048576"))
+        self._index_interval = int(session_config.get('IndexInterval',
+                                                      "256"))
+        self._names = []
+        self._ids = dict()
+        self._segments = []
+        self._index = []
+        self._index_times = []
+        self._online = dict()
+        self._records_in_segment = 0
+        self._fd = None
+        self.load()
+        mc_server.add_player_callback(self._player_event)
+        # whoever was online when the server last stopped, or when the
+        # wrapper last died, isn't any more
+        mc_server.add_start_callback(self._reset)
+        mc_server.add_stop_callback(self._reset)
+
+    def _segment_path(self, segment):
+        return os.path.join(self._directory, '{0:08d}.log'.format(segment))
+
+    @property
+    def _names_path(self):
+        return os.path.join(self._directory, 'players.txt')
+
+    def load(self):
+        """Reads the player names and builds the index from the segments."""
+        os.makedirs(self._directory, exist_ok=True)
+        try:
+            with open(self._names_path, encoding='utf-8') as f:
+                self._names = [line.rstrip('\n') for line in f]
+        except FileNotFoundError:
+            self._names = []
+        self._ids = {name: i for i, name in enumerate(self._names)}
+        self._segments = sorted(
+            int(name[:-4]) for name in os.listdir(self._directory)
+            if name.endswith('.log') and name[:-4].isdigit())
+        self._index = []
+        self._index_times = []
+        online = dict()
+        for segment in self._segments:
+            path = self._segment_path(segment)
+            size = os.path.getsize(path)
+            if size % _record.size:
+                # a record was being written when we last died
+                _logger.warning("truncating partial record in '%s'", path)
+                size -= size % _record.size
+                os.truncate(path, size)
+            self._records_in_segment = 0
+            for offset, record in self._read(segment, 0):
+                if self._records_in_segment % self._index_interval == 0:
+                    self._add_index(record[0], segment, offset, online)
+                self._records_in_segment += 1
+                self._apply(online, *record)
+        self._online = online
+        _logger.info("loaded %d session log segments with %d index entries",
+                     len(self._segments), len(self._index))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self, segment, offset):
+        """Yields (offset, record) pairs from a segment."""
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            while True:
+                data = f.read(_read_size - _read_size % _record.size)
+                if not data:
+                    return
+                for record in _record.iter_unpack(
+                        data[:len(data) - len(data) % _record.size]):
+                    yield offset, record
+                    offset += _record.size
+
+    @staticmethod
+    def _apply(online, t, kind, player):
+        if kind == _JOIN:
+            online.setdefault(player, t)
+        elif kind == _LEAVE:
+            online.pop(player, None)
+        else:
+            online.clear()
+
+    def _add_index(self, t, segment, offset, online):
+        self._index.append(_IndexEntry(t, segment, offset, dict(online)))
+        self._index_times.append(t)
+
+    def _player_id(self, name):
+        if name not in self._ids:
+            with open(self._names_path, 'a', encoding='utf-8') as f:
+                f.write(name + '\n')
+            self._ids[name] = len(self._names)
+            self._names.append(name)
+        return self._ids[name]
+
+    def _append(self, kind, player=0):
+        t = time.time()
+        if not self._segments or self._records_in_segment * _record.size \
+                >= self._segment_size:
+            self.close()
+            self._segments.append(self._segments[-1] + 1
+                                  if self._segments else 0)
+            self._records_in_segment = 0
+        if self._fd is None:
+            self._fd = os.open(self._segment_path(self._segments[-1]),
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if self._records_in_segment % self._index_interval == 0:
+            self._add_index(t, self._segments[-1],
+                            self._records_in_segment * _record.size,
+                            self._online)
+        os.write(self._fd, _record.pack(t, kind, player))
+        self._records_in_segment += 1
+        self._apply(self._online, t, kind, player)
+
+    def _player_event(self, event, name):
+        self._append(_JOIN if event == 'join' else _LEAVE,
+                     self._player_id(name))
+
+    def _reset(self):
+        if self._online:
+            self._append(_RESET)
+
+    def _replay(self, since):
+        """Returns who was online at the nearest index entry before
+        `since`, and an iterator over the records from there on."""
+        i = bisect.bisect_right(self._index_times, since) - 1
+        if i < 0:
+            if not self._index:
+                return dict(), iter(())
+            i = 0
+        entry = self._index[i]
+
+        def records():
+            offset = entry.offset
+            for segment in self._segments:
+                if segment < entry.segment:
+                    continue
+                for _, record in self._read(segment, offset):
+                    yield record
+                offset = 0
+        return dict(entry.online), records()
+
+    def sessions(self, since, until, player=None):
+        """Returns the sessions which overlap the time from `since` to
+        `until`, optionally only those of one player.
+
+        Sessions still going at `until` have no end."""
+        player_id = None
+        if player is not None:
+            player_id = self._ids.get(player)
+            if player_id is None:
+                return []
+        online, records = self._replay(since)
+        sessions = []
+
+        def end(player, start, t):
+            if t >= since and player_id in (None, player):
+                sessions.append((player, start, t))
+
+        for t, kind, player in records:
+            if t > until:
+                break
+            if kind == _LEAVE and player in online:
+                end(player, online[player], t)
+            elif kind == _RESET:
+                for p, start in online.items():
+                    end(p, start, t)
+            self._apply(online, t, kind, player)
+        for p, start in online.items():
+            if player_id in (None, p):
+                sessions.append((p, start, None))
+        sessions.sort(key=lambda s: s[1])
+        return [{
+            'player': self._names[p],
+            'joined_at': start,
+            'left_at': stop,
+            'duration': (stop if stop is not None else until) - start,
+        } for p, start, stop in sessions]
+
+    def concurrency(self, since, until, step):
+        """Returns how many players were online at the start of each `step`
+        seconds from `since` to `until`, and the most online at once during
+        each step."""
+        n = max(1, math.ceil((until - since) / step))
+        online_at = [0] * n
+        peak = [0] * n
+        online, records = self._replay(since)
+        online = set(online)
+        b = -1
+
+        def fill(last):
+            nonlocal b
+            while b < last:
+                b += 1
+                online_at[b] = peak[b] = len(online)
+
+        for t, kind, player in records:
+            if t > until:
+                break
+            if t >= since:
+                fill(min(n - 1, int((t - since) // step)))
+            if kind == _JOIN:
+                online.add(player)
+            elif kind == _LEAVE:
+                online.discard(player)
+            else:
+                online.clear()
+            if b >= 0:
+                peak[b] = max(peak[b], len(online))
+        fill(n - 1)
+        return {
+            'since': since,
+            'step': step,
+            'online': online_at,
+            'peak': peak,
+        }
+
+    def stats(self):
+        return {
+            'segments': len(self._segments),
+            'index_entries': len(self._index),
+            'players_seen': len(self._names),
+        }
@@ -0,0 +1,238 @@
+"""Classes for shutting the wrapper and server down within a time limit."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import collections
+import logging
+import os
+import signal
+import time
+import simplejson as json
+
+_logger = logging.getLogger(__name__)
+
+_poll_interval = 0.1
+
+
+class ShutdownSequencer:
+    """Shuts down in phases, each with its own time limit:
+
+    http       stop accepting connections, in the HTTP workers first
+    drain      let archive downloads and the workers' requests finish, for
+               up to `DrainTimeout`
+    save       save-all, waiting up to `SaveTimeout` for the server to save
+    stop       stop, waiting up to `StopTimeout` for the server to exit
+    terminate  SIGTERM, waiting up to `TermTimeout`
+    kill       SIGKILL, waiting up to `KillTimeout`
+    backups    let at-stop backups finish, for up to `BackupTimeout`
+
+    Phases with nothing to do are skipped, as is everything after the
+    server has exited. Calling `hurry`, as a second signal does, cuts the
+    current wait short.
+
+    How long each phase took and how it ended is logged, and written to
+    `ReportFile` if one is set, so that an orchestrator's grace period can
+    be set to match.
+    """
+
+    def __init__(self, shutdown_config, mc_server, http_server,
+                 downloads=None, backups=None, workers=None):
+        self._mc_server = mc_server
+        self._http_server = http_server
+        self._workers = workers
+        self._downloads = downloads
+        self._backups = backups
+        self._timeouts = {
+            'drain': float(shutdown_config.get('DrainTimeout', "10")),
+            'save': float(shutdown_config.get('SaveTimeout', "60")),
+            'stop': float(shutdown_config.get('StopTimeout', "60")),
+            'terminate': float(shutdown_config.get('TermTimeout', "30")),
+            'kill': float(shutdown_config.get('KillTimeout', "5")),
+            'backups': float(shutdown_config.get('BackupTimeout', "300")),
+        }
+        self._report_file = shutdown_config.get('ReportFile', "")
+        self.phases = collections.OrderedDict()
+        self.running = False
+        self._hurry = None
+        self._loop = None
+
+    def hurry(self):
+        if self._hurry and not self._hurry.is_set():
+            _logger.warning("hurrying shutdown")
+            self._hurry.set()
+
+    @asyncio.coroutine
+    def _wait(self, coro, timeout):
+        """Waits up to `timeout` seconds for `coro`, cancelling it if it
+        doesn't finish in time. Returns whether it finished."""
+        if self._hurry.is_set():
+            timeout = 0
+        task = self._loop.create_task(coro)
+        hurry = self._loop.create_task(self._hurry.wait())
+        try:
+            yield from asyncio.wait([task, hurry], timeout=timeout,
+                                    return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            hurry.cancel()
+        if not task.done():
+            task.cancel()
+            return False
+        if task.exception():
+            _logger.error("error during shutdown: %s", task.exception())
+            return False
+        return True
+
+    @asyncio.coroutine
+    def _wait_until(self, predicate, timeout):
+        @asyncio.coroutine
+        def poll():
+            while not predicate():
+                yield from asyncio.sleep(_poll_interval)
+        return (yield from self._wait(poll(), timeout))
+
+    def _alive(self):
+        process = self._mc_server.process
+        return bool(process) and process.returncode is None
+
+    @asyncio.coroutine
+    def _wait_for_exit(self, timeout):
+        return (yield from self._wait(self._mc_server.wait(), timeout))
+
+    @asyncio.coroutine
+    def _close_http(self):
+        # the workers hold the public port, and forward to our listener
+        if self._workers:
+            self._workers.close()
+        self._http_server.close()
+        return 'closed'
+
+    @asyncio.coroutine
+    def _drain(self):
+        deadline = time.monotonic() + self._timeouts['drain']
+        if self._downloads and self._downloads.busy:
+            if not (yield from self._wait_until(
+                    lambda: not self._downloads.busy,
+                    self._timeouts['drain'])):
+                _logger.warning("abandoning %d archive downloads",
+                                len(self._downloads.stats()['active']))
+        if self._workers and not (yield from self._wait(
+                self._workers.wait_closed(),
+                max(0, deadline - time.monotonic()))):
+            _logger.warning("HTTP workers are still finishing requests")
+        yield from self._wait(self._http_server.wait_closed(),
+                              max(0, deadline - time.monotonic()))
+        return 'idle' if not (self._downloads and self._downloads.busy) \
+            else 'timed out'
+
+    @asyncio.coroutine
+    def _save(self):
+        if self._mc_server.status != 'running' or not self._alive():
+            return None
+        saved = yield from self._wait(self._mc_server.save(),
+                                      self._timeouts['save'])
+        return 'saved' if saved else 'timed out'
+
+    @asyncio.coroutine
+    def _stop(self):
+        if not self._alive():
+            return None
+        deadline = time.monotonic() + self._timeouts['stop']
+        confirmed = True
+        if self._mc_server.status != 'stopping':
+            confirmed = yield from self._wait(
+                self._mc_server.stop(confirm=True), self._timeouts['stop'])
+        if (yield from self._wait_for_exit(
+                max(0, deadline - time.monotonic()))):
+            return 'exited'
+        return 'timed out' if confirmed else 'not confirmed'
+
+    @asyncio.coroutine
+    def _signal(self, phase, signal_name):
+        if not self._alive():
+            return None
+        _logger.warning("server still running, sending %s", signal_name)
+        self._mc_server.process.send_signal(getattr(signal, signal_name))
+        if (yield from self._wait_for_exit(self._timeouts[phase])):
+            return 'exited'
+        return 'timed out'
+
+    @asyncio.coroutine
+    def _terminate(self):
+        return (yield from self._signal('terminate', 'SIGTERM'))
+
+    @asyncio.coroutine
+    def _kill(self):
+        return (yield from self._signal('kill', 'SIGKILL'))
+
+    @asyncio.coroutine
+    def _finish_backups(self):
+        if self._alive():
+            return None
+        # the at-stop jobs are started by the stop callbacks
+        yield from self._wait(self._mc_server.wait_stopped(),
+                              self._timeouts['backups'])
+        if not self._backups or not self._backups.busy:
+            return None
+        if (yield from self._wait_until(lambda: not self._backups.busy,
+                                        self._timeouts['backups'])):
+            return 'finished'
+        return 'timed out'
+
+    @asyncio.coroutine
+    def run(self, loop):
+        self._loop = loop
+        self._hurry = asyncio.Event()
+        self.running = True
+        _logger.info("shutting down")
+        started = time.monotonic()
+        for name, phase in [('http', self._close_http),
+                            ('drain', self._drain),
+                            ('save', self._save),
+                            ('stop', self._stop),
+                            ('terminate', self._terminate),
+                            ('kill', self._kill),
+                            ('backups', self._finish_backups)]:
+            phase_started = time.monotonic()
+            outcome = yield from phase()
+            if outcome is None:
+                continue
+            self.phases[name] = {
+                'seconds': time.monotonic() - phase_started,
+                'outcome': outcome,
+            }
+        self.running = False
+        self._report(time.monotonic() - started)
+
+    def _report(self, total):
+        _logger.info("shutdown took %.1fs: %s", total, ", ".join(
+            "{0} {1:.1f}s ({2})".format(name, phase['seconds'],
+                                        phase['outcome'])
+            for name, phase in self.phases.items()))
+        if not self._report_file:
+            return
+        try:
+            tmp_path = self._report_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'finished_at': time.time(),
+                    'total': total,
+                    'phases': self.phases,
+                }, f)
+            os.rename(tmp_path, self._report_file)
+        except OSError:
+            _logger.exception("couldn't write shutdown report")
@@ -0,0 +1,281 @@
+"""Classes for incremental world snapshots."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import logging
+import os
+import os.path
+import shutil
+import threading
+from datetime import datetime
+import pytz
+import simplejson as json
+from . import archive
+
+_logger = logging.getLogger(__name__)
+
+_name_format = '%Y%m%dT%H%M%SZ'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """A single snapshot of the world directory.
+
+    Files which did not change since the previous snapshot are hardlinks to
+    that snapshot's copy, so each snapshot only costs as much disk space as
+    the files which changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.created_at = pytz.UTC.localize(
+            datetime.strptime(self.name, _name_format))
+        self._info = None
+
+    @staticmethod
+    def is_snapshot_name(name):
+        try:
+            datetime.strptime(name, _name_format)
+        except ValueError:
+            return False
+        return True
+
+    @property
+    def world_path(self):
+        return os.path.join(self.path, 'world')
+
+    @property
+    def info(self):
+        if self._info is None:
+            try:
+                with open(os.path.join(self.path, 'info.json')) as f:
+                    self._info = json.load(f)
+            except (OSError, ValueError):
+                self._info = {}
+        return self._info
+
+    def files(self):
+        for dir_path, dirnames, filenames in os.walk(self.world_path):
+            for n in filenames + dirnames:
+                path = os.path.join(dir_path, n)
+                yield (os.path.abspath(path),
+                       os.path.relpath(path, self.world_path))
+
+    def reader(self):
+        return archive.DirectoryReader(self.world_path)
+
+
+class RetentionPolicy:
+    """Decides which snapshots to keep.
+
+    The newest `last` snapshots are always kept. Beyond that, the newest
+    snapshot in each of the most recent `hourly` hours, `daily` days and
+    `weekly` ISO weeks is kept.
+    """
+
+    def __init__(self, last=1, hourly=0, daily=0, weekly=0):
+        self.last = max(1, last)
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+
+    @classmethod
+    def from_config(cls, snapshot_config):
+        return cls(last=int(snapshot_config.get('KeepLast', "1")),
+                   hourly=int(snapshot_config.get('KeepHourly', "0")),
+                   daily=int(snapshot_config.get('KeepDaily', "0")),
+                   weekly=int(snapshot_config.get('KeepWeekly', "0")))
+
+    @staticmethod
+    def _keep_buckets(snapshots, count, bucket):
+        kept = set()
+        seen = set()
+        for snapshot in snapshots:
+            if len(seen) >= count:
+                break
+            key = bucket(snapshot.created_at)
+            if key not in seen:
+                seen.add(key)
+                kept.add(snapshot.name)
+        return kept
+
+    def select(self, snapshots):
+        """Returns the names of the snapshots to keep.
+
+        `snapshots` must be sorted newest first."""
+        kept = set(s.name for s in snapshots[:self.last])
+        kept |= self._keep_buckets(
+            snapshots, self.hourly, lambda t: (t.date(), t.hour))
+        kept |= self._keep_buckets(
+            snapshots, self.daily, lambda t: t.date())
+        kept |= self._keep_buckets(
+            snapshots, self.weekly, lambda t: t.isocalendar()[:2])
+        return kept
+
+
+class SnapshotStore:
+    def __init__(self, snapshot_config):
+        self._path = os.path.abspath(
+            snapshot_config.get('Directory', "./snapshots/"))
+        self.retention = RetentionPolicy.from_config(snapshot_config)
+        # snapshots being downloaded, which prune() must leave alone
+        self._pins = collections.Counter()
+        self._pins_lock = threading.Lock()
+        # the last listing, and the directory's mtime when it was made
+        self._listing = None
+
+    @staticmethod
+    def _now_tz():
+        return pytz.UTC.localize(datetime.utcnow())
+
+    def snapshots(self):
+        """Returns all complete snapshots, newest first.
+
+        The listing is reused until the directory changes, so each
+        snapshot's info is only read once."""
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except OSError:
+            return []
+        listing = self._listing
+        if listing and listing[0] == mtime:
+            return list(listing[1])
+        names = [n for n in os.listdir(self._path)
+                 if Snapshot.is_snapshot_name(n)]
+        names.sort(reverse=True)
+        snapshots = [Snapshot(os.path.join(self._path, n)) for n in names]
+        self._listing = (mtime, snapshots)
+        return list(snapshots)
+
+    def get(self, name):
+        for snapshot in self.snapshots():
+            if snapshot.name == name:
+                return snapshot
+        return None
+
+    def pin(self, name):
+        """Returns the named snapshot, or None if there is no such snapshot.
+
+        The snapshot is not pruned until it has been unpinned as many times
+        as it was pinned."""
+        with self._pins_lock:
+            snapshot = self.get(name)
+            if snapshot:
+                self._pins[name] += 1
+            return snapshot
+
+    def unpin(self, name):
+        with self._pins_lock:
+            self._pins[name] -= 1
+            if self._pins[name] <= 0:
+                del self._pins[name]
+
+    def latest(self):
+        snapshots = self.snapshots()
+        return snapshots[0] if snapshots else None
+
+    @staticmethod
+    def _unchanged(st, prev_path):
+        try:
+            prev_st = os.stat(prev_path)
+        except OSError:
+            return False
+        return (st.st_size == prev_st.st_size
+                and st.st_mtime_ns == prev_st.st_mtime_ns)
+
+    def create(self, files, wrap_reader=None):
+        """Creates a new snapshot from (path, relative path) pairs.
+
+        If given, `wrap_reader` is called with each source file opened for
+        reading and must return a file-like object to copy from instead.
+        This does blocking disk I/O, so it is best run in an executor."""
+        name = self._now_tz().strftime(_name_format)
+        final_path = os.path.join(self._path, name)
+        if os.path.exists(final_path):
+            raise SnapshotError("snapshot '{0}' already exists".format(name))
+        partial_path = os.path.join(self._path, '.' + name + '.partial')
+        if os.path.exists(partial_path):
+            shutil.rmtree(partial_path)
+        world_path = os.path.join(partial_path, 'world')
+        os.makedirs(world_path)
+
+        latest = self.latest()
+        info = {'files': 0, 'linked': 0, 'bytes_total': 0, 'bytes_copied': 0}
+        _logger.info("creating snapshot '%s'", name)
+        for src, rel in files:
+            dst = os.path.join(world_path, rel)
+            if os.path.isdir(src):
+                os.makedirs(dst, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            st = os.stat(src)
+            info['files'] += 1
+            info['bytes_total'] += st.st_size
+            prev = latest and os.path.join(latest.world_path, rel)
+            if prev and self._unchanged(st, prev):
+                try:
+                    os.link(prev, dst)
+                    info['linked'] += 1
+                    continue
+                except OSError:
+                    # too many links, or a filesystem which doesn't do them
+                    _logger.debug("could not link '%s', copying", rel)
+            if wrap_reader:
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    shutil.copyfileobj(wrap_reader(fsrc), fdst)
+                shutil.copystat(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            info['bytes_copied'] += st.st_size
+
+        with open(os.path.join(partial_path, 'info.json'), 'w') as f:
+            json.dump(info, f)
+        os.rename(partial_path, final_path)
+        # in case the rename landed within the mtime's granularity
+        self._listing = None
+        _logger.info("snapshot '%s' done: %d files, %d linked, "
+                     "%d bytes copied", name, info['files'], info['linked'],
+                     info['bytes_copied'])
+        self.prune()
+        return Snapshot(final_path)
+
+    def prune(self):
+        snapshots = self.snapshots()
+        kept = self.retention.select(snapshots)
+        with self._pins_lock:
+            for snapshot in snapshots:
+                if snapshot.name in kept:
+                    continue
+                if self._pins[snapshot.name]:
+                    _logger.info("keeping snapshot '%s' until its downloads "
+                                 "finish", snapshot.name)
+                    continue
+                # moved out of sight first, so nothing can pin it meanwhile
+                removed_path = os.path.join(
+                    self._path, '.' + snapshot.name + '.removed')
+                os.rename(snapshot.path, removed_path)
+            self._listing = None
+        for name in os.listdir(self._path):
+            # including any left over from an earlier prune
+            if name.startswith('.') and name.endswith('.removed'):
+                _logger.info("removing snapshot '%s'", name[1:-8])
+                shutil.rmtree(os.path.join(self._path, name))
@@ -0,0 +1,118 @@
+"""Classes for server startup and lag telemetry."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import time
+from datetime import datetime
+import pytz
+
+_hour = 3600
+
+
+class ServerTelemetry:
+    """Keeps rolling statistics about server startups and lag.
+
+    Each lag event also records the value of every context callback added
+    with `add_context`, so lag can be correlated with whatever else the
+    wrapper was doing at the time.
+    """
+
+    def __init__(self, startup_history=20, lag_hours=24):
+        self.startups = collections.deque(maxlen=startup_history)
+        self._lag_hours = lag_hours
+        self._lag_events = collections.deque()
+        self._context = collections.OrderedDict()
+        self._spawned_at = None
+        self.lag_events_total = 0
+        self.worst_lag = None
+
+    @staticmethod
+    def _now_tz():
+        return pytz.UTC.localize(datetime.utcnow())
+
+    def add_context(self, name, callback):
+        self._context[name] = callback
+
+    def _snapshot_context(self):
+        return {name: callback() for name, callback in self._context.items()}
+
+    def record_spawn(self):
+        self._spawned_at = time.monotonic()
+
+    def record_startup(self, reported):
+        """Records a finished startup, given the time from the Done line."""
+        try:
+            reported = float(reported.rstrip('s').replace(',', '.'))
+        except ValueError:
+            reported = None
+        measured = None
+        if self._spawned_at is not None:
+            measured = time.monotonic() - self._spawned_at
+            self._spawned_at = None
+        self.startups.append({
+            'finished_at': self._now_tz().isoformat(),
+            'reported': reported,
+            'measured': measured,
+        })
+
+    def record_lag(self, behind_ms, skipped_ticks):
+        event = {
+            'at': self._now_tz().isoformat(),
+            'behind_ms': behind_ms,
+            'skipped_ticks': skipped_ticks,
+            'context': self._snapshot_context(),
+        }
+        self._lag_events.append((time.time(), event))
+        self.lag_events_total += 1
+        if not self.worst_lag \
+                or skipped_ticks > self.worst_lag['skipped_ticks']:
+            self.worst_lag = event
+        self._expire()
+
+    def _expire(self):
+        cutoff = time.time() - self._lag_hours * _hour
+        while self._lag_events and self._lag_events[0][0] < cutoff:
+            self._lag_events.popleft()
+
+    def lag_stats(self):
+        self._expire()
+        now = time.time()
+        per_hour = [0] * self._lag_hours
+        worst_last_hour = 0
+        for t, event in self._lag_events:
+            hours_ago = int((now - t) // _hour)
+            if hours_ago < self._lag_hours:
+                per_hour[hours_ago] += 1
+            if hours_ago == 0:
+                worst_last_hour = max(worst_last_hour, event['skipped_ticks'])
+        return {
+            'total': self.lag_events_total,
+            'per_hour': per_hour,
+            'worst_skipped_ticks_last_hour': worst_last_hour,
+            'worst': self.worst_lag,
+            'recent': [event for _, event in list(self._lag_events)[-20:]],
+        }
+
+    def startup_stats(self):
+        measured = [s['measured'] for s in self.startups
+                    if s['measured'] is not None]
+        return {
+            'history': list(self.startups),
+            'mean_measured': measured and sum(measured) / len(measured)
+            or None,
+        }
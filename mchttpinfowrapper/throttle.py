@@ -0,0 +1,133 @@
+"""Classes for bandwidth throttling."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """A token bucket limiting throughput to `rate` bytes per second.
+
+    A rate of zero or less means unlimited. The bucket is safe to share
+    between threads; use `throttle` from worker threads and `wait` from
+    coroutines.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 64 * 1024)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+    def _take(self, n):
+        """Takes n tokens, returning how long the caller must sleep."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def throttle(self, n):
+        """Blocks the calling thread until n bytes may pass."""
+        if self.unlimited:
+            return
+        delay = self._take(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    @asyncio.coroutine
+    def wait(self, n):
+        """Waits until n bytes may pass."""
+        if self.unlimited:
+            return
+        delay = self._take(n)
+        if delay > 0:
+            yield from asyncio.sleep(delay)
+
+
+class LimitedHold:
+    """Wraps a `hold` callable so that, across everything sharing it, it
+    holds for at most `limit` seconds in all. A limit of zero or less means
+    no limit.
+
+    Once the limit is reached it never holds again.
+    """
+
+    def __init__(self, hold, limit):
+        self._hold = hold
+        self._limit = limit
+        self._since = None
+        self._lock = threading.Lock()
+        self.held = 0.0
+        self.exhausted = False
+
+    def __call__(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._since is not None:
+                self.held += now - self._since
+                self._since = None
+            if self.exhausted or not self._hold():
+                return False
+            if 0 < self._limit <= self.held:
+                self.exhausted = True
+                return False
+            self._since = now
+            return True
+
+
+class ThrottledFile:
+    """Wraps a readable file so that reads are paced by a token bucket.
+
+    `hold` is an optional callable which is polled before each read; while
+    it returns true, reading is paused entirely.
+    """
+
+    def __init__(self, file, bucket, hold=None, poll_interval=1.0):
+        self._file = file
+        self._bucket = bucket
+        self._hold = hold
+        self._poll_interval = poll_interval
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        while self._hold and self._hold():
+            time.sleep(self._poll_interval)
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        self._bucket.throttle(len(data))
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
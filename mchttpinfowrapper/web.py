@@ -20,16 +20,26 @@ from abc import ABCMeta, abstractmethod
 import asyncio
 from aiohttp import web
 import functools
+import math
 import simplejson as json
 import random
+import time
 import base64
 import logging
 from . import archive
+from . import download
+from . import pregen
+from . import rwlock
+from . import snapshot as _snapshot
+from . import worldindex
 from . import version as _version
 import urllib.parse
 
 _logger = logging.getLogger(__name__)
 
+# the most steps a concurrency series may be split into
+_max_series_points = 10000
+
 
 class RouteInfo:
     def __init__(self):
@@ -53,19 +63,74 @@ class RouteInfo:
 
 
 class Server:
-    def __init__(self, http_config, mc_server):
+    def __init__(self, http_config, mc_server, snapshots=None,
+                 backups=None, downloads=None, resources=None,
+                 sessions=None, pregen=None, shared_snapshot=None):
         self._host = http_config.get('Host', None)
         self._port = int(http_config.get('Port', "80"))
+        self._shared_snapshot = shared_snapshot
+        self._publish_interval = float(http_config.get('PublishInterval',
+                                                       "1"))
+        self._publish_task = None
+        if shared_snapshot:
+            # the workers have the public port; they forward to us
+            self._host = '127.0.0.1'
+            self._port = int(http_config.get('InternalPort', "8089"))
         self._key = http_config.get('SecretKey', None)
         if self._key:
             self._key = b':' + self._key.encode('ascii')
         self._mc_server = mc_server
+        self._snapshots = snapshots
+        self._backups = backups
+        self._downloads = downloads or download.DownloadScheduler({})
+        self._resources = resources
+        self._sessions = sessions
+        self._pregen = pregen
         self._http_server = None
+        self._lock_timeout = float(http_config.get('LockTimeout', "5"))
         self._tokens = dict()
         self._loop = None
 
     route_info = RouteInfo()
 
+    # read-only routes which HTTP workers answer from the shared snapshot,
+    # and the methods which make their data
+    snapshot_routes = {
+        '/': '_root_data',
+        '/backups': '_backups_data',
+        '/server': '_server_data',
+        '/players': '_players_data',
+        '/world': '_world_data',
+        '/world/stats': '_world_stats_data',
+        '/world/snapshots': '_world_snapshots_data',
+        '/jobs/pregen': '_jobs_pregen_data',
+    }
+
+    def snapshot(self):
+        return {
+            'published_at': time.time(),
+            'routes': {url: getattr(self, method)()
+                       for url, method in self.snapshot_routes.items()},
+        }
+
+    @asyncio.coroutine
+    def _publish(self):
+        failing = False
+        while True:
+            try:
+                self._shared_snapshot.publish(self.snapshot())
+            except ValueError:
+                # the workers forward requests here once it goes stale, so
+                # this only costs speed; say so once, not every interval
+                if not failing:
+                    _logger.exception("couldn't publish snapshot")
+                failing = True
+            else:
+                if failing:
+                    _logger.info("publishing snapshots again")
+                failing = False
+            yield from asyncio.sleep(self._publish_interval)
+
     @staticmethod
     def make_token():
         return bytes(random.randint(0, 255) for _ in range(32))
@@ -121,6 +186,12 @@ class Server:
             }
         ))
 
+    @asyncio.coroutine
+    def data_response(self, request, data):
+        if data is None:
+            return (yield from self.make_response(request, status=404))
+        return (yield from self.make_response(request, data=data))
+
     @asyncio.coroutine
     def method_not_allowed(self, request, allowed, data=None):
         return (yield from self.make_response(
@@ -130,10 +201,31 @@ class Server:
             headers={'Allow': ", ".join(allowed)}
         ))
 
-    @route_info.handle_get('/')
     @asyncio.coroutine
-    def handle_get_root(self, request):
-        return (yield from self.make_response(request, data={
+    def world_busy(self, request, status=503):
+        return (yield from self.make_response(
+            request,
+            status=status,
+            headers={'Retry-After': str(max(1, int(self._lock_timeout)))},
+            data={
+                'reason': "world busy",
+                'lock': self._mc_server.world_lock_stats(),
+            }
+        ))
+
+    @asyncio.coroutine
+    def unsupported_archive(self, request):
+        return (yield from self.make_response(
+            request,
+            status=415,
+            data={
+                'reason': "unsupported archive format",
+                'detail': ['zip', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz'],
+            }
+        ))
+
+    def _root_data(self):
+        return {
             'version': _version,
             'endpoints': {
                 'players': {
@@ -148,13 +240,49 @@ class Server:
                     'method': 'GET',
                     'href': '/server',
                 },
+                'backups': {
+                    'method': 'GET',
+                    'href': '/backups',
+                },
             }
-        }))
+        }
 
-    @route_info.handle_get('/server')
+    @route_info.handle_get('/')
     @asyncio.coroutine
-    def handle_get_server(self, request):
+    def handle_get_root(self, request):
+        return (yield from self.data_response(request, self._root_data()))
+
+    def _backups_data(self):
+        if not self._backups:
+            return None
+        jobs = {}
+        for name, job in self._backups.jobs.items():
+            jobs[name] = {
+                'kind': job.kind,
+                'schedule': job.schedule,
+                'running': job.running,
+                'next_run_at': job.next_run_at and job.next_run_at.isoformat(),
+            }
+        return {
+            'jobs': jobs,
+            'history': self._backups.history,
+        }
+
+    @route_info.handle_get('/backups')
+    @asyncio.coroutine
+    def handle_get_backups(self, request):
+        return (yield from self.data_response(request, self._backups_data()))
+
+    def _server_data(self):
         actions = {}
+        if self._resources:
+            actions['resources'] = {
+                'method': 'GET',
+                'href': '/server/resources',
+                'params': {
+                    'since': {'type': 'timestamp'},
+                },
+            }
         if self._mc_server.can_start:
             actions['start_server'] = {
                 'method': 'POST',
@@ -165,18 +293,42 @@ class Server:
                 'method': 'POST',
                 'href': '/server/stop',
             }
-        return (yield from self.make_response(request, data={
+        return {
             'stats': {
                 'status_changed_at':
                     self._mc_server.status_changed_at.isoformat(),
                 'status': self._mc_server.status,
+                'startup': self._mc_server.telemetry.startup_stats(),
+                'lag': self._mc_server.telemetry.lag_stats(),
             },
             'endpoints': actions,
-        }))
+        }
 
-    @route_info.handle_get('/world')
+    @route_info.handle_get('/server')
     @asyncio.coroutine
-    def handle_get_world(self, request):
+    def handle_get_server(self, request):
+        return (yield from self.data_response(request, self._server_data()))
+
+    @route_info.handle_get('/server/resources')
+    @asyncio.coroutine
+    def handle_get_server_resources(self, request):
+        if not self._resources:
+            return (yield from self.make_response(request, status=404))
+        try:
+            since = float(request.GET.get('since', time.time() - 3600))
+        except ValueError:
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "invalid parameter",
+                    'detail': 'since',
+                }
+            ))
+        return (yield from self.make_response(
+            request, data=self._resources.since(since)))
+
+    def _world_data(self):
         endpoints = {}
         if self._mc_server.status == 'stopped':
             endpoints['download_world'] = {
@@ -186,7 +338,10 @@ class Server:
                     'format': {
                         'type': 'options',
                         'range': ['tar', 'zip']
-                    }
+                    },
+                    'dimension': {'type': 'list'},
+                    'region': {'type': 'bounding_box'},
+                    'exclude': {'type': 'list'},
                 }
             }
             endpoints['upload_world'] = {
@@ -196,23 +351,286 @@ class Server:
                     'archive': {'type': 'file'}
                 }
             }
-        return (yield from self.make_response(
-            request, data={'endpoints': endpoints}))
+            endpoints['world_manifest'] = {
+                'method': 'GET',
+                'href': '/world/manifest',
+            }
+            endpoints['upload_world_delta'] = {
+                'method': 'POST',
+                'href': '/world/delta',
+                'params': {
+                    'archive': {'type': 'file'},
+                    'deleted': {'type': 'json'},
+                    'base': {'type': 'string'},
+                    'root': {'type': 'string'},
+                }
+            }
+        endpoints['stats'] = {
+            'method': 'GET',
+            'href': '/world/stats',
+        }
+        if self._snapshots:
+            endpoints['snapshots'] = {
+                'method': 'GET',
+                'href': '/world/snapshots',
+            }
+        return {
+            'lock': self._mc_server.world_lock_stats(),
+            'downloads': self._downloads.stats(),
+            'endpoints': endpoints,
+        }
 
-    @route_info.handle_get('/players')
+    @route_info.handle_get('/world')
     @asyncio.coroutine
-    def handle_get_players(self, request):
+    def handle_get_world(self, request):
+        return (yield from self.data_response(request, self._world_data()))
+
+    def _world_stats_data(self):
+        return self._mc_server.world_index.stats()
+
+    @route_info.handle_get('/world/stats')
+    @asyncio.coroutine
+    def handle_get_world_stats(self, request):
+        return (yield from self.data_response(
+            request, self._world_stats_data()))
+
+    def _world_snapshots_data(self):
+        if not self._snapshots:
+            return None
+        snapshots = []
+        for snapshot in self._snapshots.snapshots():
+            href = '/world/snapshots/{0}'.format(snapshot.name)
+            snapshots.append({
+                'name': snapshot.name,
+                'created_at': snapshot.created_at.isoformat(),
+                'stats': snapshot.info,
+                'endpoints': {
+                    'download_snapshot': {
+                        'method': 'GET',
+                        'href': href + '/archive',
+                        'params': {
+                            'format': {
+                                'type': 'options',
+                                'range': ['tar', 'zip']
+                            }
+                        }
+                    },
+                    'restore_snapshot': {
+                        'method': 'POST',
+                        'href': href + '/restore',
+                    },
+                },
+            })
+        endpoints = {}
+        if self._mc_server.status == 'stopped':
+            endpoints['create_snapshot'] = {
+                'method': 'POST',
+                'href': '/world/snapshots',
+            }
+        return {
+            'snapshots': snapshots,
+            'endpoints': endpoints,
+        }
+
+    @route_info.handle_get('/world/snapshots')
+    @asyncio.coroutine
+    def handle_get_world_snapshots(self, request):
+        return (yield from self.data_response(
+            request, self._world_snapshots_data()))
+
+    @route_info.handle_post('/world/snapshots')
+    @asyncio.coroutine
+    def handle_post_world_snapshots(self, request):
+        auth_request = yield from self.require_authentication(request)
+        if auth_request:
+            return auth_request
+        if not self._snapshots:
+            return (yield from self.make_response(request, status=404))
+        if self._mc_server.status != 'stopped':
+            return (
+                yield from self.method_not_allowed(
+                    request,
+                    allowed=[],
+                    data={'server_status': self._mc_server.status}
+                )
+            )
+        try:
+            yield from self._mc_server.acquire_read(self._lock_timeout)
+        except rwlock.LockTimeout:
+            return (yield from self.world_busy(request))
+        try:
+            files = list(self._mc_server.world_files())
+            try:
+                created = yield from self._loop.run_in_executor(
+                    None, self._snapshots.create, files)
+            except _snapshot.SnapshotError as e:
+                return (yield from self.make_response(
+                    request,
+                    status=409,
+                    data={
+                        'reason': "snapshot exists",
+                        'detail': str(e),
+                    }
+                ))
+            return (yield from self.make_response(request, data={
+                'name': created.name,
+                'stats': created.info,
+            }))
+        finally:
+            yield from self._mc_server.release_read()
+
+    @route_info.handle_get('/world/snapshots/{name}/archive')
+    @asyncio.coroutine
+    def handle_get_world_snapshot_archive(self, request):
+        # pinned, so that it isn't pruned out from under the download
+        pinned = self._snapshots and \
+            self._snapshots.pin(request.match_info['name'])
+        if not pinned:
+            return (yield from self.make_response(request, status=404))
+        try:
+            return (yield from self._stream_archive(
+                request, ('snapshot', pinned.name),
+                'minecraft_world_' + pinned.name, pinned.files()))
+        finally:
+            self._snapshots.unpin(pinned.name)
+
+    @route_info.handle_post('/world/snapshots/{name}/restore')
+    @asyncio.coroutine
+    def handle_post_world_snapshot_restore(self, request):
+        auth_request = yield from self.require_authentication(request)
+        if auth_request:
+            return auth_request
+        snapshot = self._snapshots and \
+            self._snapshots.get(request.match_info['name'])
+        if not snapshot:
+            return (yield from self.make_response(request, status=404))
+        if self._mc_server.status != 'stopped':
+            return (
+                yield from self.method_not_allowed(
+                    request,
+                    allowed=[],
+                    data={'server_status': self._mc_server.status}
+                )
+            )
+        try:
+            yield from self._mc_server.acquire_write(self._lock_timeout)
+        except rwlock.LockTimeout:
+            return (yield from self.world_busy(request, status=409))
+        try:
+            _logger.info("restoring snapshot '%s'", snapshot.name)
+            yield from self._mc_server.world_extract(snapshot.reader(), '')
+            return (yield from self.make_response(request))
+        finally:
+            yield from self._mc_server.release_write()
+
+    def _players_data(self):
         player_info = dict()
         for player in self._mc_server.players:
             player_info[player] = {
                 'joined_at': self._mc_server.joined_at(player).isoformat()
             }
         last_part = self._mc_server.last_part_at
-        return (yield from self.make_response(request, data={
+        endpoints = {}
+        if self._sessions:
+            endpoints['history'] = {
+                'method': 'GET',
+                'href': '/players/history',
+                'params': {
+                    'since': {'type': 'timestamp'},
+                    'until': {'type': 'timestamp'},
+                    'player': {'type': 'string'},
+                },
+            }
+            endpoints['concurrency'] = {
+                'method': 'GET',
+                'href': '/players/concurrency',
+                'params': {
+                    'since': {'type': 'timestamp'},
+                    'until': {'type': 'timestamp'},
+                    'step': {'type': 'seconds'},
+                },
+            }
+        return {
             'last_part_at': last_part and last_part.isoformat(),
             'players': player_info,
+            'endpoints': endpoints,
+        }
+
+    @route_info.handle_get('/players')
+    @asyncio.coroutine
+    def handle_get_players(self, request):
+        return (yield from self.data_response(request, self._players_data()))
+
+    @staticmethod
+    def _time_range(request, default_span):
+        """Returns (since, until) from the request, or the name of the
+        parameter which is invalid."""
+        now = time.time()
+        try:
+            until = float(request.GET.get('until', now))
+        except ValueError:
+            return 'until'
+        if not math.isfinite(until):
+            return 'until'
+        try:
+            since = float(request.GET.get('since', until - default_span))
+        except ValueError:
+            return 'since'
+        if not math.isfinite(since) or since > until:
+            return 'since'
+        return since, until
+
+    @route_info.handle_get('/players/history')
+    @asyncio.coroutine
+    def handle_get_players_history(self, request):
+        if not self._sessions:
+            return (yield from self.make_response(request, status=404))
+        time_range = self._time_range(request, 7 * 24 * 3600)
+        if isinstance(time_range, str):
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "invalid parameter",
+                    'detail': time_range,
+                }
+            ))
+        since, until = time_range
+        return (yield from self.make_response(request, data={
+            'since': since,
+            'until': until,
+            'sessions': self._sessions.sessions(
+                since, until, request.GET.get('player')),
         }))
 
+    @route_info.handle_get('/players/concurrency')
+    @asyncio.coroutine
+    def handle_get_players_concurrency(self, request):
+        if not self._sessions:
+            return (yield from self.make_response(request, status=404))
+        time_range = self._time_range(request, 7 * 24 * 3600)
+        invalid = time_range if isinstance(time_range, str) else None
+        try:
+            step = float(request.GET.get('step', 3600))
+        except ValueError:
+            step = 0
+        if not invalid and (not math.isfinite(step) or step <= 0
+                            or (time_range[1] - time_range[0]) / step
+                            > _max_series_points):
+            invalid = 'step'
+        if invalid:
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "invalid parameter",
+                    'detail': invalid,
+                }
+            ))
+        since, until = time_range
+        return (yield from self.make_response(
+            request, data=self._sessions.concurrency(since, until, step)))
+
     @route_info.handle_post('/server/start')
     @asyncio.coroutine
     def handle_post_server_start(self, request):
@@ -227,7 +645,11 @@ class Server:
                     data={'server_status': self._mc_server.status},
                 )
             )
-        yield from self._mc_server.start(self._loop)
+        try:
+            yield from self._mc_server.start(
+                self._loop, lock_timeout=self._lock_timeout)
+        except rwlock.LockTimeout:
+            return (yield from self.world_busy(request, status=409))
         return (yield from self.make_response(request))
 
     @route_info.handle_post('/server/stop')
@@ -247,6 +669,98 @@ class Server:
         yield from self._mc_server.stop()
         return (yield from self.make_response(request))
 
+    def _jobs_pregen_data(self):
+        if not self._pregen:
+            return None
+        job = self._pregen.job
+        endpoints = {}
+        if job and not job.finished:
+            endpoints['cancel'] = {
+                'method': 'POST',
+                'href': '/jobs/pregen/cancel',
+            }
+        else:
+            endpoints['submit'] = {
+                'method': 'POST',
+                'href': '/jobs/pregen',
+                'params': {
+                    'x0': {'type': 'integer'},
+                    'z0': {'type': 'integer'},
+                    'x1': {'type': 'integer'},
+                    'z1': {'type': 'integer'},
+                },
+            }
+        return {
+            'job': job and job.progress(),
+            'endpoints': endpoints,
+        }
+
+    @route_info.handle_get('/jobs/pregen')
+    @asyncio.coroutine
+    def handle_get_jobs_pregen(self, request):
+        return (yield from self.data_response(
+            request, self._jobs_pregen_data()))
+
+    @route_info.handle_post('/jobs/pregen')
+    @asyncio.coroutine
+    def handle_post_jobs_pregen(self, request):
+        auth_request = yield from self.require_authentication(request)
+        if auth_request:
+            return auth_request
+        if not self._pregen:
+            return (yield from self.make_response(request, status=404))
+        post_data = yield from request.post()
+        region = []
+        for param in ('x0', 'z0', 'x1', 'z1'):
+            try:
+                region.append(int(post_data[param]))
+            except (KeyError, ValueError):
+                return (yield from self.make_response(
+                    request,
+                    status=403,
+                    data={
+                        'reason': "missing or invalid parameter",
+                        'detail': param,
+                    }
+                ))
+        try:
+            job = self._pregen.submit(*region)
+        except pregen.JobRunning:
+            return (yield from self.make_response(
+                request,
+                status=409,
+                data={
+                    'reason': "job running",
+                    'job': self._pregen.job.progress(),
+                }
+            ))
+        except ValueError as e:
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "region too large",
+                    'detail': str(e),
+                }
+            ))
+        return (yield from self.make_response(request, data={
+            'job': job.progress(),
+        }))
+
+    @route_info.handle_post('/jobs/pregen/cancel')
+    @asyncio.coroutine
+    def handle_post_jobs_pregen_cancel(self, request):
+        auth_request = yield from self.require_authentication(request)
+        if auth_request:
+            return auth_request
+        if not self._pregen:
+            return (yield from self.make_response(request, status=404))
+        if not self._pregen.cancel():
+            return (yield from self.method_not_allowed(request, allowed=[]))
+        return (yield from self.make_response(request, data={
+            'job': self._pregen.job.progress(),
+        }))
+
     @route_info.handle_get('/world/archive')
     @asyncio.coroutine
     def handle_get_world_archive(self, request):
@@ -259,25 +773,75 @@ class Server:
                 )
             )
         try:
-            yield from self._mc_server.acquire_read()
-            if 'format' not in request.GET:
-                return (yield from self.make_response(
-                    request,
-                    status=403,
-                    data={
-                        'reason': "missing parameter",
-                        'detail': 'format',
-                    }
-                ))
-            response = ArchiveResponse.new(request.GET['format'])
-            response.basename = 'minecraft_world'
-            response.start(request)
-            for filename, arcname in self._mc_server.world_files():
-                yield from response.add(filename, arcname)
-            yield from response.write_eof()
+            world_filter = worldindex.WorldFilter.from_query(request.GET)
+        except ValueError as e:
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "invalid parameter",
+                    'detail': str(e),
+                }
+            ))
+        if not self._mc_server.can_read:
+            return (yield from self.world_busy(request))
+        # the world is only read-locked once the build leaves the queue
+        return (yield from self._stream_archive(
+            request, ('world', world_filter.key), 'minecraft_world',
+            self._mc_server.world_files(world_filter=world_filter),
+            lock=self._mc_server))
+
+    @asyncio.coroutine
+    def _stream_archive(self, request, key, basename, files, lock=None):
+        if 'format' not in request.GET:
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "missing parameter",
+                    'detail': 'format',
+                }
+            ))
+        archive_format = request.GET['format']
+        make_writer = ArchiveResponse.writer_factory(archive_format)
+        if not make_writer:
+            return (yield from self.make_response(
+                request,
+                status=403,
+                data={
+                    'reason': "invalid parameter",
+                    'detail': 'format',
+                }
+            ))
+        try:
+            build = self._downloads.request(
+                key + (archive_format,), make_writer, basename, files,
+                lock=lock, lock_timeout=self._lock_timeout)
+        except download.QueueFull as e:
+            return (yield from self.make_response(
+                request,
+                status=503,
+                headers={'Retry-After': str(e.retry_after)},
+                data={
+                    'reason': "download queue full",
+                    'queue_position': e.position,
+                }
+            ))
+        response = ArchiveResponse(build)
+        response.headers['X-Queue-Position'] = \
+            str(self._downloads.position(build))
+        response.start(request)
+        try:
+            yield from self._downloads.download(build, response)
+        except download.BuildAbandoned:
+            pass
+        except rwlock.LockTimeout:
+            # too late for a 503, so cut the response short instead
+            _logger.warning("world busy, abandoning queued download")
+            request.transport.close()
             return response
-        finally:
-            yield from self._mc_server.release_read()
+        yield from response.write_eof()
+        return response
 
     @route_info.handle_post('/world/archive')
     @asyncio.coroutine
@@ -294,7 +858,10 @@ class Server:
                 )
             )
         try:
-            yield from self._mc_server.acquire_write()
+            yield from self._mc_server.acquire_write(self._lock_timeout)
+        except rwlock.LockTimeout:
+            return (yield from self.world_busy(request, status=409))
+        try:
             post_data = yield from request.post()
             if 'archive' not in post_data:
                 return (yield from self.make_response(
@@ -305,7 +872,10 @@ class Server:
                         'detail': 'archive',
                     }
                 ))
-            reader = archive.ArchiveReader.new(post_data['archive'].file)
+            try:
+                reader = archive.ArchiveReader.new(post_data['archive'].file)
+            except archive.UnsupportedArchive:
+                return (yield from self.unsupported_archive(request))
             dirname = reader.find('level.dat')
             _logger.info("found level.dat in '%s'", dirname)
             yield from self._mc_server.world_extract(reader, dirname)
@@ -313,6 +883,89 @@ class Server:
         finally:
             yield from self._mc_server.release_write()
 
+    @route_info.handle_get('/world/manifest')
+    @asyncio.coroutine
+    def handle_get_world_manifest(self, request):
+        if self._mc_server.status != 'stopped':
+            return (
+                yield from self.method_not_allowed(
+                    request,
+                    allowed=[],
+                    data={'server_status': self._mc_server.status}
+                )
+            )
+        try:
+            yield from self._mc_server.acquire_read(self._lock_timeout)
+        except rwlock.LockTimeout:
+            return (yield from self.world_busy(request))
+        try:
+            manifest = yield from self._mc_server.world_index.manifest()
+            return (yield from self.make_response(request, data=manifest))
+        finally:
+            yield from self._mc_server.release_read()
+
+    @route_info.handle_post('/world/delta')
+    @asyncio.coroutine
+    def handle_post_world_delta(self, request):
+        auth_request = yield from self.require_authentication(request)
+        if auth_request:
+            return auth_request
+        if self._mc_server.status != 'stopped':
+            return (
+                yield from self.method_not_allowed(
+                    request,
+                    allowed=[],
+                    data={'server_status': self._mc_server.status}
+                )
+            )
+        try:
+            yield from self._mc_server.acquire_write(self._lock_timeout)
+        except rwlock.LockTimeout:
+            return (yield from self.world_busy(request, status=409))
+        try:
+            post_data = yield from request.post()
+            if 'base' in post_data:
+                manifest = yield from self._mc_server.world_index.manifest()
+                if manifest['id'] != post_data['base']:
+                    return (yield from self.make_response(
+                        request,
+                        status=409,
+                        data={
+                            'reason': "world changed",
+                            'detail': manifest['id'],
+                        }
+                    ))
+            deleted = []
+            if 'deleted' in post_data:
+                try:
+                    deleted = json.loads(post_data['deleted'])
+                    if not all(isinstance(d, str) for d in deleted):
+                        raise ValueError()
+                except (ValueError, TypeError):
+                    return (yield from self.make_response(
+                        request,
+                        status=403,
+                        data={
+                            'reason': "invalid parameter",
+                            'detail': 'deleted',
+                        }
+                    ))
+            reader = None
+            dirname = ''
+            if 'archive' in post_data:
+                try:
+                    reader = archive.ArchiveReader.new(
+                        post_data['archive'].file)
+                except archive.UnsupportedArchive:
+                    return (yield from self.unsupported_archive(request))
+                dirname = post_data.get('root') \
+                    or reader.find('level.dat') or ''
+            yield from self._mc_server.world_apply_delta(
+                reader, dirname, deleted)
+            return (yield from self.make_response(request))
+        finally:
+            yield from self._mc_server.release_write()
+
     @asyncio.coroutine
     def start(self, loop):
         app = web.Application(loop=loop)
@@ -321,46 +974,40 @@ class Server:
             app.make_handler(),
             self._host, self._port)
         self._loop = loop
+        if self._shared_snapshot:
+            self._publish_task = loop.create_task(self._publish())
+
+    def close(self):
+        """Stops accepting connections, leaving open ones to finish."""
+        if self._publish_task:
+            self._publish_task.cancel()
+            self._publish_task = None
+        self._http_server.close()
 
     @asyncio.coroutine
-    def stop(self):
-        self._http_server.close()
+    def wait_closed(self):
         yield from self._http_server.wait_closed()
 
+    @asyncio.coroutine
+    def stop(self):
+        self.close()
+        yield from self.wait_closed()
+
 
 class ArchiveResponse(web.StreamResponse):
-    def __init__(self, make_archive_writer, status=200, headers=None):
+    def __init__(self, build, status=200, headers=None):
         super().__init__(status=status)
         if headers:
             self.headers.extend(headers)
-        self.__archive_writer = make_archive_writer(self)
-        self.content_type = self.__archive_writer.mime_type
-
-    @classmethod
-    def new(cls, archive_format, status=200, headers=None):
-        make_writer = None
-        if archive_format == 'tar':
-            make_writer = lambda fd: archive.TarWriter(fd, compression='gz')
-        elif archive_format == 'zip':
-            make_writer = lambda fd: archive.ZipWriter(fd)
-        return cls(make_writer, status=status, headers=headers)
-
-    @property
-    def basename(self):
-        return self.__archive_writer.basename
-
-    @basename.setter
-    def basename(self, basename):
-        self.__archive_writer.basename = basename
+        self.content_type = build.mime_type
         self.headers['Content-Disposition'] = \
             'attachment; filename={0}.{1}'.format(
-                basename, self.__archive_writer.file_extension)
-
-    @asyncio.coroutine
-    def add(self, filename, arcname=None):
-        yield from self.__archive_writer.add(filename, arcname)
+                build.basename, build.file_extension)
 
-    @asyncio.coroutine
-    def write_eof(self):
-        yield from self.__archive_writer.close()
-        yield from super().write_eof()
+    @staticmethod
+    def writer_factory(archive_format):
+        if archive_format == 'tar':
+            return lambda fd: archive.TarWriter(fd, compression='gz')
+        elif archive_format == 'zip':
+            return lambda fd: archive.ZipWriter(fd)
+        return None
@@ -0,0 +1,572 @@
+"""Classes for keeping an index of the files in the world directory."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import os.path
+import re
+import struct
+import time
+import simplejson as json
+
+_logger = logging.getLogger(__name__)
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_watch_mask = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF | _IN_ONLYDIR)
+_event_header = struct.Struct('iIII')
+
+_index_version = 2
+
+# directory mtimes are only so fine-grained, so one changed this close to
+# when the index was saved may have changed after it was listed
+_racy_window_ns = 2 * 10 ** 9
+
+_region_name_re = re.compile(r'''^r\.(?P<x>-?\d+)\.(?P<z>-?\d+)\.mc[ar]$''')
+
+
+def split_dimension(rel):
+    """Splits a relative world path into its dimension and the rest.
+
+    Paths outside any dimension directory belong to the overworld."""
+    parts = rel.split(os.sep)
+    if parts[0].startswith('DIM'):
+        return parts[0], parts[1:]
+    elif parts[0] == 'dimensions' and len(parts) >= 3:
+        return '/'.join(parts[:3]), parts[3:]
+    return 'overworld', parts
+
+
+class WorldFilter:
+    """Selects part of the world by dimension, region bounding box and
+    file class.
+
+    The file class of a path is its first directory inside its dimension,
+    such as 'region', 'playerdata' or 'stats'. Files at the top level of
+    the world, such as level.dat, are always selected, whatever is
+    excluded. Directories are selected if they are in a selected dimension
+    or lead to one. The bounding box is in region coordinates, inclusive,
+    and applies to any file named like a region file.
+    """
+
+    def __init__(self, dimensions=None, region_box=None, exclude=None):
+        self.dimensions = dimensions and frozenset(dimensions)
+        self.region_box = region_box
+        self.exclude = frozenset(exclude or ())
+
+    @classmethod
+    def from_query(cls, query):
+        """Builds a filter from query parameters.
+
+        Raises ValueError naming the offending parameter."""
+        dimensions = None
+        if query.get('dimension'):
+            dimensions = query['dimension'].split(',')
+        region_box = None
+        if query.get('region'):
+            try:
+                x1, z1, x2, z2 = (int(v) for v in query['region'].split(','))
+            except ValueError:
+                raise ValueError('region')
+            region_box = (min(x1, x2), min(z1, z2), max(x1, x2), max(z1, z2))
+        exclude = None
+        if query.get('exclude'):
+            exclude = query['exclude'].split(',')
+        return cls(dimensions, region_box, exclude)
+
+    @property
+    def key(self):
+        return (self.dimensions and tuple(sorted(self.dimensions)),
+                self.region_box, tuple(sorted(self.exclude)))
+
+    def __call__(self, rel, is_dir=False):
+        dimension, rest = split_dimension(rel)
+        if dimension == 'overworld' and len(rest) == 1 and not is_dir:
+            return True
+        if self.dimensions is not None and dimension not in self.dimensions:
+            prefix = rel.replace(os.sep, '/') + '/'
+            return is_dir and any(d.startswith(prefix)
+                                  for d in self.dimensions)
+        if rest and rest[0] in self.exclude:
+            return False
+        if self.region_box and rest:
+            m = _region_name_re.match(rest[-1])
+            if m:
+                x, z = int(m.group('x')), int(m.group('z'))
+                x1, z1, x2, z2 = self.region_box
+                if not (x1 <= x <= x2 and z1 <= z <= z2):
+                    return False
+        return True
+
+
+class _Inotify:
+    """A minimal inotify binding using ctypes."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails harmlessly if the kernel already dropped the watch
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WorldIndex:
+    """An in-memory index of the world directory.
+
+    Entries map relative paths to [size, mtime_ns, sha1] for files, with
+    the hash filled in lazily. The index is kept current with inotify where
+    available; otherwise it is rescanned by size and mtime whenever its
+    files are listed. It is saved to disk on shutdown so that hashes
+    survive restarts, along with each directory's mtime as of when it was
+    last listed, so that on start only the directories which changed
+    meanwhile need listing again.
+    """
+
+    def __init__(self, world_path, index_config):
+        self._root = os.path.abspath(world_path)
+        self._state_path = os.path.abspath(index_config.get(
+            'StateFile', os.path.join(os.path.dirname(self._root),
+                                      'world_index.json')))
+        self._use_inotify = index_config.get('Inotify', "yes") == 'yes'
+        self._settle_delay = float(index_config.get('SettleDelay', "0.5"))
+        self._files = dict()
+        self._dirs = set()
+        self._dir_mtimes = dict()
+        self._saved_at_ns = 0
+        self._inotify = None
+        self._watches = dict()
+        self._pending = set()
+        self._pending_handle = None
+        self._loop = None
+        # bumped on every change, so stats() knows when to recount
+        self._generation = 0
+        self._stats = None
+
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def watching(self):
+        return bool(self._watches)
+
+    def start(self, loop):
+        self._loop = loop
+        loaded = self.load()
+        if self._use_inotify:
+            try:
+                self._inotify = _Inotify()
+                loop.add_reader(self._inotify.fd, self._handle_events)
+            except (OSError, AttributeError):
+                _logger.warn("inotify unavailable, falling back to rescans")
+                self._inotify = None
+        if loaded:
+            self._resume()
+        else:
+            self.rebuild()
+
+    def stop(self):
+        if self._inotify:
+            self._loop.remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+            self._watches.clear()
+        self.save()
+
+    def _root_id(self):
+        try:
+            st = os.stat(self._root)
+        except OSError:
+            return None
+        return [st.st_dev, st.st_ino]
+
+    def load(self):
+        """Reads the saved index, returning whether it can be trusted.
+
+        It can't if it was saved for a different world directory, including
+        one since swapped out for another at the same path."""
+        try:
+            with open(self._state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get('version') != _index_version \
+                or state.get('root') != self._root \
+                or state.get('root_id') != self._root_id():
+            return False
+        self._files = state['files']
+        self._dirs = set(state['dirs'])
+        self._dir_mtimes = state['dir_mtimes']
+        self._saved_at_ns = state['saved_at_ns']
+        self._generation += 1
+        _logger.info("loaded index of %d files", len(self._files))
+        return True
+
+    def save(self):
+        state = {
+            'version': _index_version,
+            'root': self._root,
+            'root_id': self._root_id(),
+            'files': self._files,
+            'dirs': sorted(self._dirs),
+            'dir_mtimes': self._dir_mtimes,
+            'saved_at_ns': int(time.time() * 10 ** 9),
+        }
+        tmp_path = self._state_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self._state_path)
+        except OSError:
+            _logger.exception("could not save world index")
+
+    def rebuild(self):
+        """Rescans the whole world directory.
+
+        Hashes are kept for files whose size and mtime have not changed."""
+        old_files = self._files
+        self._files = dict()
+        self._dirs = set()
+        self._dir_mtimes = dict()
+        self._generation += 1
+        self._pending.clear()
+        for wd in list(self._watches):
+            self._unwatch(wd)
+        self._note_dir(self._root, '')
+        for dir_path, dirnames, filenames in os.walk(self._root):
+            rel_dir = os.path.relpath(dir_path, self._root)
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            for n in dirnames:
+                rel = os.path.join(rel_dir, n)
+                self._dirs.add(rel)
+                self._note_dir(os.path.join(dir_path, n), rel)
+            for n in filenames:
+                rel = os.path.join(rel_dir, n)
+                self._update_file(rel, old_files.get(rel))
+        _logger.debug("indexed %d files in %d directories",
+                      len(self._files), len(self._dirs))
+
+    def _resume(self):
+        """Brings a loaded index up to date without walking the world.
+
+        Directories whose mtime has changed since they were last listed are
+        listed again, and every file is checked by size and mtime."""
+        self._generation += 1
+        children = dict()
+        for rel in self._dirs | set(self._files):
+            parent, name = os.path.split(rel)
+            children.setdefault(parent, set()).add(name)
+        changed = []
+        for rel in [''] + sorted(self._dirs):
+            path = os.path.join(self._root, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                # gone, so its parent has changed and will drop it
+                continue
+            self._watch(path, rel)
+            if self._dir_mtimes.get(rel) != mtime \
+                    or mtime >= self._saved_at_ns - _racy_window_ns:
+                changed.append(rel)
+        for rel in changed:
+            if rel == '' or rel in self._dirs:
+                self._relist(rel, children.get(rel, set()))
+        for rel, entry in list(self._files.items()):
+            self._update_file(rel, entry)
+        _logger.debug("resumed index, listed %d changed directories",
+                      len(changed))
+
+    def _relist(self, rel_dir, known):
+        """Updates the index for the entries of one directory, given the
+        names it had before."""
+        path = os.path.join(self._root, rel_dir)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            names = set(os.listdir(path))
+        except OSError:
+            return
+        self._dir_mtimes[rel_dir] = mtime
+        for n in known - names:
+            self._remove_tree(os.path.join(rel_dir, n))
+        for n in names:
+            rel = os.path.join(rel_dir, n)
+            if os.path.isdir(os.path.join(path, n)):
+                if rel not in self._dirs:
+                    self._files.pop(rel, None)
+                    self._add_tree(rel)
+            elif rel in self._dirs:
+                self._remove_tree(rel)
+                self._update_file(rel)
+            elif rel not in self._files:
+                self._update_file(rel)
+
+    def refresh(self):
+        """Brings the index up to date, rescanning if inotify isn't keeping
+        it so."""
+        if self.watching:
+            self._flush_pending()
+        else:
+            self.rebuild()
+
+    def _watch(self, path, rel):
+        if not self._inotify:
+            return
+        try:
+            wd = self._inotify.add_watch(path, _watch_mask)
+        except OSError:
+            return
+        self._watches[wd] = rel
+
+    def _note_dir(self, path, rel):
+        """Watches a directory and notes its mtime, before it is listed."""
+        self._watch(path, rel)
+        try:
+            self._dir_mtimes[rel] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+
+    def _unwatch(self, wd):
+        del self._watches[wd]
+        if self._inotify:
+            self._inotify.rm_watch(wd)
+
+    def _update_file(self, rel, old=None):
+        self._generation += 1
+        try:
+            st = os.stat(os.path.join(self._root, rel))
+        except OSError:
+            self._files.pop(rel, None)
+            return
+        if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            self._files[rel] = old
+        else:
+            self._files[rel] = [st.st_size, st.st_mtime_ns, None]
+
+    def _remove_tree(self, rel):
+        self._generation += 1
+        prefix = rel + os.sep
+        self._dirs.discard(rel)
+        self._dir_mtimes.pop(rel, None)
+        self._files.pop(rel, None)
+        for d in [d for d in self._dirs if d.startswith(prefix)]:
+            self._dirs.discard(d)
+            self._dir_mtimes.pop(d, None)
+        for f in [f for f in self._files if f.startswith(prefix)]:
+            del self._files[f]
+        for wd in [wd for wd, d in self._watches.items()
+                   if d == rel or d.startswith(prefix)]:
+            # a directory moved elsewhere would otherwise stay watched
+            self._unwatch(wd)
+
+    def _add_tree(self, rel):
+        self._generation += 1
+        path = os.path.join(self._root, rel)
+        self._dirs.add(rel)
+        self._note_dir(path, rel)
+        for dir_path, dirnames, filenames in os.walk(path):
+            rel_dir = os.path.relpath(dir_path, self._root)
+            for n in dirnames:
+                self._dirs.add(os.path.join(rel_dir, n))
+                self._note_dir(os.path.join(dir_path, n),
+                               os.path.join(rel_dir, n))
+            for n in filenames:
+                self._update_file(os.path.join(rel_dir, n))
+
+    def _handle_events(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & _IN_Q_OVERFLOW:
+                _logger.warn("inotify queue overflowed, rescanning")
+                self._loop.call_soon(self.rebuild)
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & _IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                if rel_dir == '':
+                    # the whole world was swapped out from under us
+                    self._loop.call_soon(self.rebuild)
+                continue
+            rel = os.path.join(rel_dir, name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._add_tree(rel)
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    self._remove_tree(rel)
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                self._pending.discard(rel)
+                self._files.pop(rel, None)
+                self._generation += 1
+            else:
+                # writes come in bursts, so stat each file once they settle
+                self._pending.add(rel)
+                if not self._pending_handle:
+                    self._pending_handle = self._loop.call_later(
+                        self._settle_delay, self._flush_pending)
+
+    def _flush_pending(self):
+        if self._pending_handle:
+            self._pending_handle.cancel()
+            self._pending_handle = None
+        pending, self._pending = self._pending, set()
+        for rel in pending:
+            self._update_file(rel, self._files.get(rel))
+
+    def files(self, world_filter=None):
+        """Yields (path, relative path) pairs, directories before contents.
+
+        If `world_filter` is given, only paths it accepts are yielded."""
+        self.refresh()
+        for rel in sorted(self._dirs | set(self._files)):
+            if world_filter is None or world_filter(rel, rel in self._dirs):
+                yield os.path.join(self._root, rel), rel
+
+    def entry(self, rel):
+        return self._files.get(rel)
+
+    def _hash_files(self, rels):
+        """Returns the SHA-1 of each file, or None for any which is gone.
+
+        This reads every file, so it is run in an executor; it doesn't touch
+        the index."""
+        digests = []
+        for rel in rels:
+            h = hashlib.sha1()
+            try:
+                with open(os.path.join(self._root, rel), 'rb') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        h.update(chunk)
+            except OSError:
+                digests.append(None)
+                continue
+            digests.append(h.hexdigest())
+        return digests
+
+    @asyncio.coroutine
+    def manifest(self):
+        """Returns every file's size and hash, plus an id for the whole set.
+
+        Files not hashed yet are hashed in an executor, and their hashes
+        cached unless they changed meanwhile."""
+        self.refresh()
+        entries = sorted(self._files.items(), key=lambda item: item[0])
+        directories = sorted(self._dirs)
+        unhashed = [rel for rel, entry in entries if entry[2] is None]
+        hashed = yield from self._loop.run_in_executor(
+            None, self._hash_files, unhashed)
+        digests = dict(zip(unhashed, hashed))
+        files = dict()
+        h = hashlib.sha1()
+        for rel, entry in entries:
+            digest = entry[2] or digests.get(rel)
+            if digest is None:
+                continue
+            if entry[2] is None and self._files.get(rel) is entry:
+                entry[2] = digest
+            files[rel] = {'size': entry[0], 'sha1': digest}
+            h.update('{0}\0{1}\n'.format(rel, digest).encode('utf-8'))
+        return {
+            'id': h.hexdigest(),
+            'files': files,
+            'directories': directories,
+        }
+
+    @staticmethod
+    def dimension_of(rel):
+        """Returns the dimension a region file belongs to, or None."""
+        dimension, rest = split_dimension(rel)
+        if len(rest) != 2 or rest[0] != 'region' \
+                or not rest[1].endswith('.mca'):
+            return None
+        return dimension
+
+    def stats(self):
+        """Returns totals for the world, counted again only when the index
+        has changed since last time."""
+        self._flush_pending()
+        if not self._stats or self._stats[0] != self._generation:
+            self._stats = (self._generation, self._count())
+        stats = dict(self._stats[1])
+        stats['watching'] = self.watching
+        return stats
+
+    def _count(self):
+        dimensions = dict()
+        total_size = 0
+        for rel, (size, _, _) in self._files.items():
+            total_size += size
+            dimension = self.dimension_of(rel)
+            if dimension:
+                d = dimensions.setdefault(dimension, {'regions': 0, 'size': 0})
+                d['regions'] += 1
+                d['size'] += size
+        return {
+            'total_size': total_size,
+            'files': len(self._files),
+            'directories': len(self._dirs),
+            'dimensions': dimensions,
+        }
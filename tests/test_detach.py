@@ -0,0 +1,118 @@
+"""Tests for running the server detached from the wrapper."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from mchttpinfowrapper import detach
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class CopyToLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'console.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def copy(self, data, max_size):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data)
+        os.close(write_fd)
+        detach.copy_to_log(read_fd, self.log, max_size)
+        os.close(read_fd)
+
+    def test_moves_the_log_aside_at_the_end_of_a_line(self):
+        self.copy(b'one\ntwo\n', 4)
+        self.assertEqual(read_file(self.log + '.1'), b'one\ntwo\n')
+        self.assertEqual(read_file(self.log), b'')
+
+    def test_unlimited(self):
+        self.copy(b'one\ntwo\n', 0)
+        self.assertEqual(read_file(self.log), b'one\ntwo\n')
+        self.assertFalse(os.path.exists(self.log + '.1'))
+
+
+class ConsoleTailTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'console.log')
+        self.append(b'one\n')
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def append(self, data):
+        with open(self.log, 'ab') as f:
+            f.write(data)
+
+    def readline(self, tail):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(tail.readline(), 5))
+
+    def make_tail(self, offset=0, inode=None):
+        return detach.ConsoleTail(self.log, offset, lambda: True, 0.01,
+                                  inode)
+
+    def test_follows_the_log_when_it_moves(self):
+        tail = self.make_tail()
+        self.assertEqual(self.readline(tail), b'one\n')
+        self.append(b'two\n')
+        os.replace(self.log, self.log + '.1')
+        self.append(b'three\n')
+        self.assertEqual(self.readline(tail), b'two\n')
+        self.assertEqual(self.readline(tail), b'three\n')
+        self.assertEqual(tail.offset, len(b'three\n'))
+        tail.close()
+
+    def test_carries_on_in_the_moved_log(self):
+        tail = self.make_tail()
+        self.readline(tail)
+        offset, inode = tail.offset, tail.inode
+        tail.close()
+        self.append(b'two\n')
+        os.replace(self.log, self.log + '.1')
+        self.append(b'three\n')
+        tail = self.make_tail(offset, inode)
+        self.assertEqual(self.readline(tail), b'two\n')
+        self.assertEqual(self.readline(tail), b'three\n')
+        tail.close()
+
+    def test_starts_again_when_truncated(self):
+        tail = self.make_tail()
+        self.readline(tail)
+        open(self.log, 'wb').close()
+        line = asyncio.ensure_future(tail.readline(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.append(b'new\n')
+        self.assertEqual(self.loop.run_until_complete(
+            asyncio.wait_for(line, 5, loop=self.loop)), b'new\n')
+        tail.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
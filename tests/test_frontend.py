@@ -0,0 +1,269 @@
+"""Tests for the HTTP worker processes and their shared snapshot."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import signal
+import socket
+import threading
+import time
+import unittest
+import aiohttp
+from aiohttp import web as aiohttp_web
+from mchttpinfowrapper import frontend
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SharedSnapshotTest(unittest.TestCase):
+    def test_publish_and_read(self):
+        snapshot = frontend.SharedSnapshot(4096)
+        self.assertIsNone(snapshot.read())
+        snapshot.publish({'a': 1})
+        sequence, data = snapshot.read()
+        self.assertEqual(data, {'a': 1})
+        self.assertEqual(sequence % 2, 0)
+
+    def test_read_since(self):
+        snapshot = frontend.SharedSnapshot(4096)
+        snapshot.publish({'a': 1})
+        sequence, _ = snapshot.read()
+        self.assertIsNone(snapshot.read(sequence))
+        snapshot.publish({'a': 2})
+        self.assertEqual(snapshot.read(sequence)[1], {'a': 2})
+
+    def test_shorter_payload_replaces_longer(self):
+        snapshot = frontend.SharedSnapshot(4096)
+        snapshot.publish({'a': 'x' * 1000})
+        snapshot.publish({'a': 'y'})
+        self.assertEqual(snapshot.read()[1], {'a': 'y'})
+
+    def test_too_large(self):
+        snapshot = frontend.SharedSnapshot(64)
+        snapshot.publish({'a': 1})
+        with self.assertRaises(frontend.SnapshotTooLarge):
+            snapshot.publish({'a': 'x' * 64})
+        # the last snapshot that fitted is left alone
+        self.assertEqual(snapshot.read()[1], {'a': 1})
+
+    def test_ignores_other_format_versions(self):
+        snapshot = frontend.SharedSnapshot(4096)
+        snapshot.publish({'a': 1})
+        sequence, version, length = frontend._header.unpack_from(
+            snapshot._mmap, 0)
+        frontend._header.pack_into(snapshot._mmap, 0, sequence, version + 1,
+                                   length)
+        self.assertIsNone(snapshot.read())
+
+    def test_waits_out_a_write(self):
+        snapshot = frontend.SharedSnapshot(4096)
+        snapshot.publish({'a': 1})
+        sequence, _ = snapshot.read()
+        # a writer which has started but not finished
+        frontend._sequence.pack_into(snapshot._mmap, 0, sequence + 1)
+        timer = threading.Timer(0.1, frontend._sequence.pack_into,
+                                (snapshot._mmap, 0, sequence))
+        timer.start()
+        self.assertEqual(snapshot.read(), (sequence, {'a': 1}))
+        timer.join()
+
+    def test_visible_after_fork(self):
+        snapshot = frontend.SharedSnapshot(4096)
+        pid = os.fork()
+        if pid == 0:
+            snapshot.publish({'from': 'child'})
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(snapshot.read()[1], {'from': 'child'})
+
+
+class WorkerServerTest(unittest.TestCase):
+    """Runs a worker in front of a stand-in for the supervisor's server."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.snapshot = frontend.SharedSnapshot(4096)
+        self.seen = []
+        upstream_port = free_port()
+        self.port = free_port()
+        app = aiohttp_web.Application(loop=self.loop)
+        app.router.add_route('POST', '/world/archive', self.upstream_post)
+        app.router.add_route('GET', '/world/archive', self.upstream_archive)
+        app.router.add_route('GET', '/players', self.upstream_players)
+        self.upstream = self.loop.run_until_complete(self.loop.create_server(
+            app.make_handler(), '127.0.0.1', upstream_port))
+        self.worker = frontend.WorkerServer({
+            'Host': '127.0.0.1',
+            'Port': str(self.port),
+            'InternalPort': str(upstream_port),
+            'SnapshotMaxAge': "5",
+        }, self.snapshot)
+        self.loop.run_until_complete(self.worker.start(self.loop))
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.worker.stop())
+        self.stop_upstream()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def stop_upstream(self):
+        self.upstream.close()
+        self.loop.run_until_complete(self.upstream.wait_closed())
+
+    @asyncio.coroutine
+    def upstream_post(self, request):
+        body = yield from request.read()
+        self.seen.append((request.path_qs, dict(request.headers), body))
+        return aiohttp_web.Response(status=201, body=b'stored',
+                                    headers={'X-Stored': str(len(body))})
+
+    @asyncio.coroutine
+    def upstream_archive(self, request):
+        response = aiohttp_web.StreamResponse()
+        response.headers['Content-Type'] = 'application/x-tar'
+        response.start(request)
+        for i in range(32):
+            response.write(bytes([i]) * frontend._chunk_size)
+            yield from response.drain()
+        yield from response.write_eof()
+        return response
+
+    @asyncio.coroutine
+    def upstream_players(self, request):
+        return aiohttp_web.Response(body=b'"upstream"')
+
+    def request(self, method, path, **kwargs):
+        @asyncio.coroutine
+        def go():
+            response = yield from aiohttp.request(
+                method, 'http://127.0.0.1:{0}{1}'.format(self.port, path),
+                loop=self.loop, **kwargs)
+            body = yield from response.read()
+            return response, body
+        return self.loop.run_until_complete(asyncio.wait_for(go(), 10))
+
+    def test_forwards_a_body_with_its_length(self):
+        body = os.urandom(300000)
+        response, reply = self.request('POST', '/world/archive?format=tar',
+                                       data=body)
+        self.assertEqual(response.status, 201)
+        self.assertEqual(reply, b'stored')
+        self.assertEqual(response.headers['X-STORED'], '300000')
+        path, headers, seen_body = self.seen[0]
+        self.assertEqual(path, '/world/archive?format=tar')
+        self.assertEqual(headers['CONTENT-LENGTH'], '300000')
+        self.assertEqual(seen_body, body)
+
+    def test_forwards_a_chunked_body(self):
+        @asyncio.coroutine
+        def chunks():
+            for i in range(5):
+                yield bytes([i]) * 1000
+
+        response, reply = self.request('POST', '/world/archive',
+                                       data=chunks(), chunked=True)
+        self.assertEqual(response.status, 201)
+        _, headers, seen_body = self.seen[0]
+        self.assertNotIn('CONTENT-LENGTH', headers)
+        self.assertEqual(seen_body,
+                         b''.join(bytes([i]) * 1000 for i in range(5)))
+
+    def test_streams_the_response_back(self):
+        response, body = self.request('GET', '/world/archive')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['CONTENT-TYPE'],
+                         'application/x-tar')
+        self.assertEqual(len(body), 32 * frontend._chunk_size)
+        self.assertEqual(body[-1], 31)
+
+    def test_answers_from_the_snapshot(self):
+        self.snapshot.publish({
+            'published_at': time.time(),
+            'routes': {'/players': 'snapshot'},
+        })
+        response, body = self.request('GET', '/players')
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'"snapshot"', body)
+        self.assertIn('AGE', response.headers)
+
+    def test_stale_snapshot_is_passed_over(self):
+        self.snapshot.publish({
+            'published_at': time.time() - 60,
+            'routes': {'/players': 'snapshot'},
+        })
+        response, body = self.request('GET', '/players')
+        self.assertEqual(body, b'"upstream"')
+
+    def test_missing_snapshot_is_passed_over(self):
+        response, body = self.request('GET', '/players')
+        self.assertEqual(body, b'"upstream"')
+
+    def test_supervisor_unavailable(self):
+        self.stop_upstream()
+        response, body = self.request('GET', '/players')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.headers['RETRY-AFTER'], '1')
+        self.assertIn(b'"supervisor unavailable"', body)
+
+
+def children(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def wait_for_workers(self, pid, count):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            workers = children(pid)
+            if len(workers) == count:
+                return workers
+            time.sleep(0.05)
+        self.fail("expected {0} workers, have {1}".format(count, workers))
+
+    def test_replaces_dead_workers(self):
+        pool = frontend.WorkerPool({
+            'Host': '127.0.0.1',
+            'Port': str(free_port()),
+            'Workers': "2",
+        }, frontend.SharedSnapshot(4096))
+        pool.start()
+        replaced = []
+        try:
+            workers = self.wait_for_workers(pool.pid, 2)
+            os.kill(workers[0], signal.SIGKILL)
+            deadline = time.monotonic() + 5
+            while workers[0] in children(pool.pid):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+            replaced = self.wait_for_workers(pool.pid, 2)
+            self.assertNotIn(workers[0], replaced)
+            self.assertIn(workers[1], replaced)
+        finally:
+            pool.stop()
+        for worker in replaced:
+            self.assertFalse(os.path.exists('/proc/{0}'.format(worker)))
+
+
+if __name__ == '__main__':
+    unittest.main()
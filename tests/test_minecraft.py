@@ -0,0 +1,125 @@
+"""Tests for world replacement in the server wrapper."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from mchttpinfowrapper import archive, minecraft
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class WorldApplyDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dir = tempfile.mkdtemp()
+        self.world = os.path.join(self.dir, 'world')
+        write_file(os.path.join(self.world, 'level.dat'), b'level')
+        write_file(os.path.join(self.world, 'region', 'r.0.0.mca'), b'r00')
+        write_file(os.path.join(self.world, 'region', 'r.1.0.mca'), b'r10')
+        write_file(os.path.join(self.world, 'DIM-1', 'region', 'r.0.0.mca'),
+                   b'nether')
+        self.mc_server = minecraft.ServerWrapper(
+            {'ServerJar': 'minecraft_server.jar',
+             'WorkingDirectory': self.dir},
+            {'Inotify': 'no'})
+        self.mc_server.world_index.start(self.loop)
+
+    def tearDown(self):
+        self.mc_server.world_index.stop()
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def apply_delta(self, files=None, deleted=()):
+        reader = None
+        if files:
+            staging = os.path.join(self.dir, 'staging')
+            for rel, data in files.items():
+                write_file(os.path.join(staging, rel), data)
+            reader = archive.DirectoryReader(staging)
+        self.loop.run_until_complete(
+            self.mc_server.world_apply_delta(reader, '', deleted))
+
+    def test_replaces_changed_files(self):
+        self.apply_delta({os.path.join('region', 'r.0.0.mca'): b'new'})
+        self.assertEqual(
+            read_file(os.path.join(self.world, 'region', 'r.0.0.mca')),
+            b'new')
+        self.assertEqual(
+            read_file(os.path.join(self.world, 'region', 'r.1.0.mca')),
+            b'r10')
+        self.assertEqual(
+            read_file(os.path.join(self.dir, 'world_old', 'region',
+                                   'r.0.0.mca')),
+            b'r00')
+
+    def test_old_world_is_not_shared(self):
+        self.apply_delta()
+        path = os.path.join(self.world, 'region', 'r.1.0.mca')
+        old_path = os.path.join(self.dir, 'world_old', 'region', 'r.1.0.mca')
+        self.assertNotEqual(os.stat(path).st_ino, os.stat(old_path).st_ino)
+        # the server rewrites region files in place
+        with open(path, 'r+b') as f:
+            f.write(b'XXX')
+        self.assertEqual(read_file(old_path), b'r10')
+
+    def test_deletes_files(self):
+        self.apply_delta(deleted=[os.path.join('region', 'r.1.0.mca')])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.world, 'region', 'r.1.0.mca')))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.world, 'region', 'r.0.0.mca')))
+
+    def test_deletes_directories_with_their_contents(self):
+        self.apply_delta(deleted=['DIM-1'])
+        self.assertFalse(os.path.exists(os.path.join(self.world, 'DIM-1')))
+        self.assertTrue(os.path.exists(os.path.join(self.world, 'level.dat')))
+
+    def test_index_follows_the_new_world(self):
+        self.apply_delta({'data/villages.dat': b'v'}, deleted=['DIM-1'])
+        manifest = self.loop.run_until_complete(
+            self.mc_server.world_index.manifest())
+        self.assertEqual(sorted(manifest['files']), [
+            os.path.join('data', 'villages.dat'),
+            'level.dat',
+            os.path.join('region', 'r.0.0.mca'),
+            os.path.join('region', 'r.1.0.mca'),
+        ])
+
+    def test_refuses_while_running(self):
+        self.mc_server._set_status('running')
+        with self.assertRaises(minecraft.ServerRunning):
+            self.apply_delta()
+        self.assertEqual(read_file(os.path.join(self.world, 'level.dat')),
+                         b'level')
+
+
+if __name__ == '__main__':
+    unittest.main()
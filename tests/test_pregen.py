@@ -0,0 +1,268 @@
+"""Tests for terrain pre-generation."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os.path
+import shutil
+import tempfile
+import time
+import types
+import unittest
+import unittest.mock
+from mchttpinfowrapper import minecraft, pregen
+
+
+class PregenJobTest(unittest.TestCase):
+    def test_chunks_go_a_row_at_a_time(self):
+        job = pregen.PregenJob(1, 5, -1, 4)
+        self.assertEqual(job.total, 6)
+        self.assertEqual([job.chunk(n) for n in range(job.total)],
+                         [(-1, 4), (0, 4), (1, 4), (-1, 5), (0, 5), (1, 5)])
+
+    def test_round_trip(self):
+        job = pregen.PregenJob(0, 0, 3, 3)
+        job.done = 7
+        job.rate = 1.5
+        job.loaded = [[3, 1, 100.0, 0]]
+        copy = pregen.PregenJob.from_dict(job.to_dict())
+        self.assertEqual(copy.to_dict(), job.to_dict())
+
+    def test_progress(self):
+        job = pregen.PregenJob(0, 0, 9, 9)
+        job.status = 'running'
+        job.done = 25
+        job.rate = 5
+        progress = job.progress()
+        self.assertEqual(progress['total'], 100)
+        self.assertEqual(progress['percent'], 25)
+        self.assertEqual(progress['eta'], 15)
+        job.status = 'done'
+        self.assertIsNone(job.progress()['eta'])
+
+
+class FakeServer:
+    """Answers console commands the way a server with /forceload would."""
+
+    def __init__(self):
+        self.status = 'running'
+        self.process = object()
+        self.telemetry = types.SimpleNamespace(lag_events_total=0)
+        self.commands = []
+        self.on_command = None
+        self.reply = lambda line: "Marked chunk"
+
+    @asyncio.coroutine
+    def send_command(self, line):
+        if not self.process:
+            raise minecraft.ServerNotRunning()
+        self.commands.append((time.monotonic(), line))
+        if self.on_command:
+            self.on_command(line)
+
+    @asyncio.coroutine
+    def send_command_and_wait(self, line, pattern, suppress=True,
+                              timeout=None):
+        yield from self.send_command(line)
+        m = pattern.match(self.reply(line) or "")
+        if not m:
+            raise asyncio.TimeoutError()
+        return m
+
+    def sent(self, prefix):
+        return [(t, line[len(prefix):]) for t, line in self.commands
+                if line.startswith(prefix)]
+
+
+class PregenRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+        self.mc_server = FakeServer()
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def make_runner(self, **config):
+        settings = {
+            'StateFile': os.path.join(self.dir, 'pregen.json'),
+            'LoadResponse': "^Marked chunk",
+            'InitialRate': "100",
+            'MaxRate': "1000",
+            'LagBackoff': "0",
+            'UnloadDelay': "0",
+        }
+        settings.update(config)
+        runner = pregen.PregenRunner(self.mc_server, settings)
+        runner.start(self.loop)
+        return runner
+
+    def run_job(self, runner, x1=31, z1=15):
+        runner.submit(0, 0, x1, z1)
+        self.loop.run_until_complete(
+            asyncio.wait_for(runner._task, 5))
+        return runner.job
+
+    def run_until(self, condition):
+        @asyncio.coroutine
+        def poll():
+            while not condition():
+                yield from asyncio.sleep(0.01)
+        self.loop.run_until_complete(asyncio.wait_for(poll(), 5))
+
+    def record_rates(self, runner, lag_at=()):
+        rates = []
+
+        def on_command(line):
+            if line.startswith("forceload add"):
+                if len(rates) in lag_at:
+                    self.mc_server.telemetry.lag_events_total += 1
+                rates.append(runner.job.rate)
+        self.mc_server.on_command = on_command
+        return rates
+
+    def test_loads_and_unloads_every_chunk(self):
+        runner = self.make_runner()
+        job = self.run_job(runner)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.done, 2)
+        self.assertEqual(job.loaded, [])
+        self.assertEqual([line for t, line in
+                          self.mc_server.sent("forceload add ")],
+                         ["0 0", "16 0"])
+        self.assertEqual([line for t, line in
+                          self.mc_server.sent("forceload remove ")],
+                         ["0 0", "16 0"])
+
+    def test_rate_increases_without_lag(self):
+        runner = self.make_runner(RateIncrease="200", MaxRate="103")
+        rates = self.record_rates(runner)
+        self.run_job(runner, x1=63)
+        self.assertEqual(rates, [100, 102, 103, 103])
+
+    def test_rate_halves_on_lag(self):
+        runner = self.make_runner(RateIncrease="100", MinRate="30")
+        rates = self.record_rates(runner, lag_at=(1, 2))
+        job = self.run_job(runner, x1=63)
+        self.assertEqual(rates, [100, 101, 50.5, 30])
+        self.assertEqual(job.lag_events, 2)
+
+    def test_fails_after_repeated_timeouts(self):
+        self.mc_server.reply = lambda line: None
+        runner = self.make_runner(UnloadDelay="100")
+        job = self.run_job(runner)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.done, 0)
+        self.assertEqual(job.timeouts, pregen._max_timeouts)
+        # the chunk we were trying to load is released
+        self.assertEqual([line for t, line in
+                          self.mc_server.sent("forceload remove ")],
+                         ["0 0"])
+        self.assertEqual(job.loaded, [])
+
+    def test_unloads_after_the_delay(self):
+        runner = self.make_runner(UnloadDelay="0.2")
+        self.run_job(runner)
+        loads = self.mc_server.sent("forceload add ")
+        unloads = self.mc_server.sent("forceload remove ")
+        self.assertEqual(len(unloads), len(loads))
+        for (loaded_at, chunk), (unloaded_at, same) in zip(loads, unloads):
+            self.assertEqual(chunk, same)
+            self.assertGreaterEqual(unloaded_at - loaded_at, 0.19)
+
+    def test_waits_for_the_chunk_to_load(self):
+        answers = ["Test failed", "Test failed", "Test passed"]
+
+        def reply(line):
+            if line.startswith("execute"):
+                return answers.pop(0) if answers else "Test passed"
+            return "Marked chunk"
+        self.mc_server.reply = reply
+        runner = self.make_runner(
+            LoadedCommand="execute if loaded {x} 0 {z}",
+            LoadedResponse="^Test (?:(?P<loaded>passed)|failed)")
+        self.run_job(runner, x1=15)
+        self.assertEqual([line for t, line in self.mc_server.commands],
+                         ["forceload add 0 0",
+                          "execute if loaded 0 0 0",
+                          "execute if loaded 0 0 0",
+                          "execute if loaded 0 0 0",
+                          "forceload remove 0 0"])
+
+    def test_waits_when_the_server_stops_mid_chunk(self):
+        def on_command(line):
+            # the process goes away before the status catches up
+            if line == "forceload add 16 0":
+                self.mc_server.process = None
+        self.mc_server.on_command = on_command
+        with unittest.mock.patch.object(pregen, '_wait_interval', 0.05):
+            runner = self.make_runner(UnloadDelay="0")
+            runner.submit(0, 0, 47, 15)
+            self.run_until(lambda: runner.job.status == 'waiting')
+            self.assertFalse(runner._task.done())
+            self.mc_server.on_command = None
+            self.mc_server.process = object()
+            self.loop.run_until_complete(asyncio.wait_for(runner._task, 5))
+        job = runner.job
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.loaded, [])
+        self.assertEqual(
+            sorted(set(line for t, line in
+                       self.mc_server.sent("forceload remove "))),
+            ["0 0", "16 0", "32 0"])
+
+    def test_submit_refuses_while_running(self):
+        runner = self.make_runner(UnloadDelay="100")
+        runner.submit(0, 0, 15, 15)
+        with self.assertRaises(pregen.JobRunning):
+            runner.submit(0, 0, 15, 15)
+        runner.stop()
+
+    def test_submit_refuses_large_regions(self):
+        runner = self.make_runner(MaxChunks="10")
+        with self.assertRaises(ValueError):
+            runner.submit(0, 0, 16 * 10, 0)
+
+    def test_cancel_unloads_loaded_chunks(self):
+        runner = self.make_runner(UnloadDelay="100")
+        runner.submit(0, 0, 16 * 9, 0)
+        self.run_until(lambda: runner.job.done >= 3)
+        self.assertTrue(runner.cancel())
+        self.run_until(lambda: not runner.job.loaded)
+        self.assertEqual(runner.job.status, 'cancelled')
+        loaded = [line for t, line in self.mc_server.sent("forceload add ")]
+        unloaded = [line for t, line in
+                    self.mc_server.sent("forceload remove ")]
+        self.assertEqual(sorted(unloaded), sorted(loaded))
+
+    def test_resumes_from_the_state_file(self):
+        runner = self.make_runner(UnloadDelay="100")
+        runner.submit(0, 0, 16 * 9, 0)
+        self.run_until(lambda: runner.job.done >= 3)
+        runner.stop()
+        job = pregen.PregenRunner(self.mc_server, {
+            'StateFile': os.path.join(self.dir, 'pregen.json'),
+        }).job
+        self.assertEqual(job.done, runner.job.done)
+        self.assertEqual(job.loaded, runner.job.loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
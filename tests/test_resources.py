@@ -0,0 +1,152 @@
+"""Tests for the process resource sampler."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import subprocess
+import types
+import unittest
+import unittest.mock
+from mchttpinfowrapper import resources
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_keeps_the_newest_rows(self):
+        buffer = resources.RingBuffer(3, 2)
+        for t in range(5):
+            buffer.append((t, t * 10))
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.oldest_time, 2)
+        self.assertEqual(buffer.since(0), [[2, 3, 4], [20, 30, 40]])
+
+    def test_since(self):
+        buffer = resources.RingBuffer(4, 1)
+        for t in (10, 20, 30):
+            buffer.append((t,))
+        self.assertEqual(buffer.since(20), [[20, 30]])
+        self.assertEqual(buffer.since(31), [[]])
+
+    def test_empty(self):
+        buffer = resources.RingBuffer(4, 1)
+        self.assertIsNone(buffer.oldest_time)
+        self.assertEqual(buffer.since(0), [[]])
+
+
+class ParseTest(unittest.TestCase):
+    # pid (comm) state ppid ... utime stime ... num_threads ...
+    stat = (b'42 (a (weird) name) S 1 42 42 0 -1 4194560 100 0 0 0 '
+            b'250 125 0 0 20 0 17 0 1000 2000000 3000 0\n')
+
+    def test_skips_to_fields_after_the_command(self):
+        buf = bytearray(self.stat)
+        end = len(buf)
+        i = resources._skip_fields(buf, buf.rindex(b')') + 2, end, 11)
+        self.assertEqual(resources._parse_int(buf, i, end), 250)
+        i = resources._skip_fields(buf, i, end, 1)
+        self.assertEqual(resources._parse_int(buf, i, end), 125)
+        i = resources._skip_fields(buf, i, end, 5)
+        self.assertEqual(resources._parse_int(buf, i, end), 17)
+
+    def test_parse_stops_at_the_end(self):
+        buf = bytearray(b'12345')
+        self.assertEqual(resources._parse_int(buf, 0, 3), 123)
+
+
+class ResourceSamplerTest(unittest.TestCase):
+    def make_sampler(self, process=None):
+        mc_server = types.SimpleNamespace(process=process)
+        return resources.ResourceSampler(mc_server, {'Interval': "5"})
+
+    def test_since_without_samples(self):
+        sampler = self.make_sampler()
+        sampler.sample()
+        data = sampler.since(0)
+        self.assertEqual(data['interval'], 5)
+        self.assertEqual(data['samples'],
+                         {column: [] for column in resources.columns})
+
+    def test_since_uses_the_finest_tier_reaching_back(self):
+        sampler = self.make_sampler()
+        raw, minutes = sampler.tiers[0].buffer, sampler.tiers[1].buffer
+        for t in range(1000, 1100, 60):
+            minutes.append((t, 0, 0, 0, 0, 0))
+        for t in range(1050, 1100, 5):
+            raw.append((t, 0, 0, 0, 0, 0))
+        self.assertEqual(sampler.since(1050)['interval'], 5)
+        self.assertEqual(sampler.since(1050)['samples']['time'][0], 1050)
+        self.assertEqual(sampler.since(1000)['interval'], 60)
+
+    def test_falls_back_to_the_longest_tier(self):
+        sampler = self.make_sampler()
+        sampler.tiers[0].buffer.append((2000, 0, 0, 0, 0, 0))
+        sampler.tiers[2].buffer.append((1000, 0, 0, 0, 0, 0))
+        self.assertEqual(sampler.since(0)['interval'], 900)
+
+    def test_tier_averages(self):
+        tier = resources._Tier(4, 10, 5)
+        for t in range(8):
+            tier.add((t, t, 0, 0, 0, 0))
+        self.assertEqual(tier.buffer.since(0)[1], [1.5, 5.5])
+
+    def test_samples_own_process(self):
+        sampler = self.make_sampler(types.SimpleNamespace(pid=os.getpid()))
+        sampler.sample()
+        sampler.sample()
+        samples = sampler.since(0)['samples']
+        self.assertEqual(len(samples['time']), 1)
+        self.assertGreater(samples['rss'][0], 0)
+        self.assertGreaterEqual(samples['threads'][0], 1)
+        sampler.stop()
+
+    def test_process_already_gone(self):
+        child = subprocess.Popen(['true'])
+        child.wait()
+        sampler = self.make_sampler(types.SimpleNamespace(pid=child.pid))
+        sampler.sample()
+        sampler.sample()
+        self.assertIsNone(sampler._files)
+        self.assertEqual(sampler.since(0)['samples']['time'], [])
+
+    def test_keeps_sampling_after_an_error(self):
+        sampler = self.make_sampler()
+        sampler.interval = 0
+        calls = []
+
+        def sample():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RuntimeError("bad sample")
+            if len(calls) == 3:
+                sampler.stop()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with unittest.mock.patch.object(sampler, 'sample', sample):
+                sampler.start(loop)
+                task = sampler._task
+                with self.assertLogs(resources._logger, 'ERROR'):
+                    with self.assertRaises(asyncio.CancelledError):
+                        loop.run_until_complete(task)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertEqual(len(calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
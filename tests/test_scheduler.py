@@ -0,0 +1,66 @@
+"""Tests for the backup scheduler."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import configparser
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from mchttpinfowrapper import scheduler
+
+
+class PruneTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'backups': {'Directory': self.dir},
+            'backup:daily': {'Keep': "1"},
+            'backup:daily-full': {'Keep': "1"},
+        })
+        self.scheduler = scheduler.BackupScheduler(config, None)
+
+    def tearDown(self):
+        for job in self.scheduler.jobs.values():
+            job.executor.shutdown()
+        shutil.rmtree(self.dir)
+
+    def touch(self, name):
+        open(os.path.join(self.dir, name), 'wb').close()
+
+    def test_is_archive_of(self):
+        self.assertTrue(scheduler._is_archive_of(
+            'daily', 'daily-20150101T000000Z.tar.gz'))
+        self.assertFalse(scheduler._is_archive_of(
+            'daily', 'daily-full-20150101T000000Z.tar.gz'))
+        self.assertFalse(scheduler._is_archive_of(
+            'daily', 'daily-20150101T000000Z.tar.gz.partial'))
+
+    def test_leaves_other_jobs_archives_alone(self):
+        others = ['daily-full-20150101T000000Z.tar.gz',
+                  'daily-full-20150102T000000Z.tar.gz']
+        for name in others + ['daily-20150101T000000Z.tar.gz']:
+            self.touch(name)
+        name = self.scheduler._write_archive(
+            self.scheduler.jobs['daily'], [], lambda f: f)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         sorted(others + [name]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Tests for the player session log."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import types
+import unittest
+import unittest.mock
+from mchttpinfowrapper import sessions
+
+
+class SessionLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        ignore = lambda callback: None
+        mc_server = types.SimpleNamespace(add_player_callback=ignore,
+                                          add_start_callback=ignore,
+                                          add_stop_callback=ignore)
+        self.log = sessions.SessionLog(mc_server, {'Directory': self.dir})
+        for t, event, name in [(100.0, 'join', 'alice'),
+                               (100.6, 'join', 'bob'),
+                               (101.2, 'leave', 'alice')]:
+            with unittest.mock.patch.object(sessions.time, 'time',
+                                            lambda: t):
+                self.log._player_event(event, name)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.dir)
+
+    def test_concurrency(self):
+        data = self.log.concurrency(99, 103, 1)
+        self.assertEqual(data['online'], [0, 0, 2, 1])
+        self.assertEqual(data['peak'], [0, 2, 2, 1])
+
+    def test_concurrency_with_a_fractional_step(self):
+        data = self.log.concurrency(100, 101, 0.5)
+        self.assertEqual(data['online'], [0, 1])
+        self.assertEqual(data['peak'], [1, 2])
+
+    def test_concurrency_with_a_fractional_span(self):
+        data = self.log.concurrency(100, 101.5, 1)
+        self.assertEqual(data['online'], [0, 2])
+        self.assertEqual(data['peak'], [2, 2])
+
+    def test_sessions(self):
+        found = self.log.sessions(100, 102)
+        self.assertEqual([(s['player'], s['joined_at'], s['left_at'])
+                          for s in found],
+                         [('alice', 100.0, 101.2), ('bob', 100.6, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
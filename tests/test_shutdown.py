@@ -0,0 +1,151 @@
+"""Tests for the shutdown sequence."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import socket
+import time
+import unittest
+import aiohttp
+from aiohttp import web as aiohttp_web
+from mchttpinfowrapper import frontend, shutdown
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def accepting(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), 0.5).close()
+    except OSError:
+        return False
+    return True
+
+
+class StoppedServer:
+    """A Minecraft server which has already exited."""
+
+    process = None
+    status = 'stopped'
+
+    @asyncio.coroutine
+    def wait_stopped(self):
+        pass
+
+
+class UpstreamServer:
+    """Stands in for the supervisor's own HTTP server."""
+
+    def __init__(self, loop, port, events):
+        self._loop = loop
+        self._port = port
+        self._events = events
+        self._server = None
+
+    @asyncio.coroutine
+    def start(self):
+        app = aiohttp_web.Application(loop=self._loop)
+        app.router.add_route('GET', '/world/archive', self.slow_archive)
+        self._server = yield from self._loop.create_server(
+            app.make_handler(), '127.0.0.1', self._port)
+
+    @asyncio.coroutine
+    def slow_archive(self, request):
+        yield from asyncio.sleep(0.5)
+        return aiohttp_web.Response(body=b'archive')
+
+    def close(self):
+        self._events.append('http')
+        self._server.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        yield from self._server.wait_closed()
+
+
+class ShutdownWithWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.port = free_port()
+        upstream_port = free_port()
+        self.workers = frontend.WorkerPool({
+            'Host': '127.0.0.1',
+            'Port': str(self.port),
+            'InternalPort': str(upstream_port),
+            'Workers': "1",
+        }, frontend.SharedSnapshot(4096))
+        self.workers.start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.upstream = UpstreamServer(self.loop, upstream_port, self.events)
+        self.loop.run_until_complete(self.upstream.start())
+        deadline = time.monotonic() + 5
+        while not accepting(self.port):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.workers.stop()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def make_sequencer(self):
+        close = self.workers.close
+
+        def close_workers():
+            self.events.append('workers')
+            close()
+        self.workers.close = close_workers
+        return shutdown.ShutdownSequencer(
+            {'DrainTimeout': "5"}, StoppedServer(), self.upstream,
+            workers=self.workers)
+
+    def test_workers_stop_accepting_first(self):
+        sequencer = self.make_sequencer()
+        self.loop.run_until_complete(sequencer.run(self.loop))
+        self.assertEqual(self.events, ['workers', 'http'])
+        self.assertIsNone(self.workers.pid)
+        self.assertFalse(accepting(self.port))
+        self.assertEqual(sequencer.phases['drain']['outcome'], 'idle')
+
+    def test_requests_under_way_finish(self):
+        @asyncio.coroutine
+        def download():
+            response = yield from aiohttp.request(
+                'GET', 'http://127.0.0.1:{0}/world/archive'.format(self.port),
+                loop=self.loop)
+            return response.status, (yield from response.read())
+
+        @asyncio.coroutine
+        def shut_down_during_download():
+            task = self.loop.create_task(download())
+            # let the request reach the supervisor
+            yield from asyncio.sleep(0.2)
+            yield from self.make_sequencer().run(self.loop)
+            return (yield from task)
+
+        status, body = self.loop.run_until_complete(asyncio.wait_for(
+            shut_down_during_download(), 10))
+        self.assertEqual((status, body), (200, b'archive'))
+        self.assertIsNone(self.workers.pid)
+
+
+if __name__ == '__main__':
+    unittest.main()
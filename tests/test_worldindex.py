@@ -0,0 +1,107 @@
+"""Tests for the world directory index."""
+
+# Copyright (C) 2015  Jonathan David Page
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+from mchttpinfowrapper import worldindex
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class WorldIndexResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dir = tempfile.mkdtemp()
+        self.world = os.path.join(self.dir, 'world')
+        write_file(os.path.join(self.world, 'level.dat'), b'level')
+        write_file(os.path.join(self.world, 'region', 'r.0.0.mca'), b'r00')
+        write_file(os.path.join(self.world, 'DIM-1', 'region', 'r.0.0.mca'),
+                   b'nether')
+        index = self.make_index()
+        index.start(self.loop)
+        self.manifest = self.loop.run_until_complete(index.manifest())
+        index.stop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def make_index(self):
+        return worldindex.WorldIndex(self.world, {'Inotify': 'no'})
+
+    def resume(self):
+        index = self.make_index()
+        with unittest.mock.patch.object(index, 'rebuild',
+                                        side_effect=AssertionError):
+            index.start(self.loop)
+        return index
+
+    def test_keeps_hashes_without_rebuilding(self):
+        index = self.resume()
+        rel = os.path.join('region', 'r.0.0.mca')
+        self.assertEqual(index.entry(rel)[2],
+                         self.manifest['files'][rel]['sha1'])
+        self.assertEqual(index.stats()['files'], 3)
+
+    def test_lists_only_changed_directories(self):
+        index = self.make_index()
+        self.assertTrue(index.load())
+        # as if saved long enough after the listings that no directory's
+        # mtime is in doubt
+        index._saved_at_ns += 2 * worldindex._racy_window_ns
+        with unittest.mock.patch.object(worldindex.os, 'listdir',
+                                        side_effect=AssertionError):
+            index._resume()
+        self.assertEqual(index.stats()['files'], 3)
+
+    def test_picks_up_changes_made_while_stopped(self):
+        write_file(os.path.join(self.world, 'level.dat'), b'changed')
+        write_file(os.path.join(self.world, 'region', 'r.1.0.mca'), b'r10')
+        write_file(os.path.join(self.world, 'DIM1', 'region', 'r.0.0.mca'),
+                   b'end')
+        shutil.rmtree(os.path.join(self.world, 'DIM-1'))
+        index = self.resume()
+        self.assertEqual(index.entry('level.dat')[:1], [7])
+        self.assertIsNone(index.entry('level.dat')[2])
+        self.assertIsNotNone(index.entry(os.path.join('region',
+                                                      'r.1.0.mca')))
+        self.assertIsNotNone(index.entry(os.path.join('DIM1', 'region',
+                                                      'r.0.0.mca')))
+        self.assertIsNone(index.entry(os.path.join('DIM-1', 'region',
+                                                   'r.0.0.mca')))
+        self.assertEqual(index.stats()['directories'], 3)
+
+    def test_rebuilds_a_swapped_world(self):
+        os.rename(self.world, os.path.join(self.dir, 'world_old'))
+        write_file(os.path.join(self.world, 'level.dat'), b'level')
+        index = self.make_index()
+        self.assertFalse(index.load())
+        index.start(self.loop)
+        self.assertEqual(index.stats()['files'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()